@@ -0,0 +1,212 @@
+"""
+Offline benchmark for detection.py (no drone or camera needed)
+
+Replays a video file (or synthetic frames with moving AprilTags and boxes) through the detectors and trackers,
+prints the latency of every stage, and saves the results as JSON (to compare between commits and computers).
+
+Examples:
+    python benchmark_detection.py                                   # synthetic frames, all stages
+    python benchmark_detection.py --video flight.mp4 --frames 500   # replay a video
+    python benchmark_detection.py --stages apriltag tracker_state --output results/laptop.json
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import subprocess
+import sys
+from time import perf_counter, strftime
+
+import cv2
+import numpy as np
+import pupil_apriltags as apriltags
+
+import detection
+
+
+STAGES = ("apriltag", "face", "update_tracker", "tracker_state")
+
+
+def synthetic_frames(count, width=640, height=480, tag_ids=(0, 1, 2), tag_size=96, seed=0):
+    """
+    Make video frames with tag36h11 AprilTags and colored boxes moving around on a noisy background
+    :return: generator of (frame, {"tags": [(tag_id, x, y, size)], "boxes": [(x, y, w, h)]}) pairs
+    """
+    rng = np.random.default_rng(seed)
+    dictionary = cv2.aruco.getPredefinedDictionary(cv2.aruco.DICT_APRILTAG_36h11)
+    tag_images = {}
+    for tag_id in tag_ids:
+        tag = cv2.aruco.generateImageMarker(dictionary, tag_id, tag_size, borderBits=1)
+        tag_images[tag_id] = cv2.copyMakeBorder(tag, 8, 8, 8, 8, cv2.BORDER_CONSTANT, value=255)  # white margin
+    background = rng.integers(90, 160, size=(height, width, 3), dtype=np.uint8)
+    background = cv2.GaussianBlur(background, (7, 7), 0)
+
+    # every object moves along its own ellipse
+    tags = [(tag_id, rng.uniform(0, 2 * np.pi), rng.uniform(0.01, 0.03)) for tag_id in tag_ids]
+    boxes = [(rng.uniform(0, 2 * np.pi), rng.uniform(0.01, 0.03), tuple(int(c) for c in rng.integers(0, 255, 3)))
+             for _ in range(2)]
+
+    for index in range(count):
+        frame = background.copy()
+        truth = {"tags": [], "boxes": []}
+        for phase, speed, color in boxes:
+            w, h = 80, 60
+            x = int((width - w) * (0.5 + 0.45 * np.cos(phase + speed * index)))
+            y = int((height - h) * (0.5 + 0.45 * np.sin(phase + 1.3 * speed * index)))
+            cv2.rectangle(frame, (x, y), (x + w, y + h), color, thickness=-1)
+            truth["boxes"].append((x, y, w, h))
+        for tag_id, phase, speed in tags:
+            image = tag_images[tag_id]
+            size = image.shape[0]
+            x = int((width - size) * (0.5 + 0.45 * np.sin(phase + speed * index)))
+            y = int((height - size) * (0.5 + 0.45 * np.cos(phase + 0.7 * speed * index)))
+            frame[y:y + size, x:x + size] = image[:, :, None]
+            truth["tags"].append((tag_id, x, y, size))
+        yield frame, truth
+
+
+def video_frames(path, count):
+    camera = cv2.VideoCapture(path)
+    assert camera.isOpened(), f"cannot read from {path}"
+    for _ in range(count):
+        success, frame = camera.read()
+        if not success:
+            break
+        yield frame, None
+    camera.release()
+
+
+def latency_summary(seconds):
+    """
+    :param seconds: list of latencies of one stage (in seconds)
+    :return: dictionary with percentiles (in milliseconds) and frames per second
+    """
+    if len(seconds) == 0:
+        return {"count": 0}
+    ms = 1000 * np.asarray(seconds)
+    return {
+        "count": len(ms),
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p90_ms": float(np.percentile(ms, 90)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "max_ms": float(ms.max()),
+        "fps": float(1000 / ms.mean()) if ms.mean() > 0 else None,
+    }
+
+
+def run(frames, stages, tracker_reinit_interval=40):
+    tag_detector = apriltags.Detector(families="tag36h11", quad_sigma=0.2)
+    face_detector = cv2.CascadeClassifier('resources/haarcascade_frontalface_default.xml') if "face" in stages else None
+    raw_tracker = detection.create_vit_tracker() if "update_tracker" in stages else None
+    tracker_state = None
+    if "tracker_state" in stages:
+        tracker_state = detection.TrackerState(
+            detection.create_vit_tracker(), display_confidence=False, tracker_reinit_interval=tracker_reinit_interval)
+
+    latencies = collections.defaultdict(list)
+    found = collections.Counter()
+    raw_tracker_started = False
+
+    for frame, truth in frames:
+        if "apriltag" in stages:
+            t = perf_counter()
+            x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame)
+            latencies["apriltag"].append(perf_counter() - t)
+            found["apriltag"] += x is not None
+
+        if "face" in stages:
+            t = perf_counter()
+            x, y, w, h = detection.detect_biggest_face(face_detector, frame)
+            latencies["face"].append(perf_counter() - t)
+            found["face"] += x is not None
+
+        if "update_tracker" in stages:
+            if not raw_tracker_started:
+                # start tracking the first moving box (or the middle of the video, if replaying a video)
+                h, w = frame.shape[:2]
+                bbox = truth["boxes"][0] if truth is not None else (w // 2 - 40, h // 2 - 40, 80, 80)
+                raw_tracker.init(frame, bbox)
+                raw_tracker_started = True
+            else:
+                t = perf_counter()
+                x, y, w, h, _ = detection.update_tracker(raw_tracker, frame)
+                latencies["update_tracker"].append(perf_counter() - t)
+                found["update_tracker"] += x is not None
+
+        if "tracker_state" in stages:
+            t = perf_counter()
+            x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, tracker=tracker_state)
+            latencies["tracker_state"].append(perf_counter() - t)
+            found["tracker_state"] += x is not None
+
+    results = {}
+    for stage in stages:
+        results[stage] = latency_summary(latencies[stage])
+        results[stage]["found"] = found[stage]
+    if "tracker_state" in stages:
+        results["tracker_state"]["full_detection_reasons"] = dict(tracker_state.full_detection_counts)
+    return results
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "time": strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": commit,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "platform": platform.platform(),
+        "python": sys.version.split()[0],
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark detection.py without a drone or camera")
+    parser.add_argument("--video", help="video file to replay (if not given, synthetic frames are used)")
+    parser.add_argument("--frames", type=int, default=300, help="how many frames to process")
+    parser.add_argument("--width", type=int, default=640, help="width of synthetic frames")
+    parser.add_argument("--height", type=int, default=480, help="height of synthetic frames")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES, help="which stages to measure")
+    parser.add_argument("--reinit-interval", type=int, default=40, help="tracker_reinit_interval for TrackerState")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to save the JSON results")
+    args = parser.parse_args()
+
+    if args.video:
+        frames = video_frames(args.video, args.frames)
+    else:
+        frames = synthetic_frames(args.frames, args.width, args.height)
+
+    results = {
+        "machine": machine_info(),
+        "source": args.video or f"synthetic {args.width}x{args.height}",
+        "frames": args.frames,
+        "stages": run(frames, args.stages, args.reinit_interval),
+    }
+
+    for stage, summary in results["stages"].items():
+        if summary["count"] == 0:
+            print(f"{stage:>15}: no frames")
+            continue
+        print(f"{stage:>15}: p50 {summary['p50_ms']:7.2f}ms, p90 {summary['p90_ms']:7.2f}ms, "
+              f"p99 {summary['p99_ms']:7.2f}ms, {summary['fps']:7.1f} fps, found on {summary['found']} frames")
+    if "tracker_state" in results["stages"]:
+        print(f"full detection reasons: {results['stages']['tracker_state']['full_detection_reasons']}")
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
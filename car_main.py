@@ -18,6 +18,7 @@ videocar.start(
     motor_directions=(-1, -1),
     video_direction=-1,
 #    robot_hostname="localhost",  # if you want to use SSH tunnel (to go around firewall)
+#    web_server="asyncio",  # less CPU on the Pi, if several people watch the video
 )
 
 chasing = False
@@ -26,6 +27,8 @@ tracking = False
 last_seen_rel_x = None
 last_seen_time = 0  # never saw
 
+operator_driving = False  # is someone driving with W/A/S/D keys on the web page?
+
 
 while True:
     key = cv2.waitKey(1) & 0xFF
@@ -50,6 +53,15 @@ while True:
         tracker.init(frame, bbox)
         tracking = True
 
+    drive = videocar.get_drive_command()
+    if drive is not None:
+        videocar.set_arcade_drive(*drive)
+        operator_driving = True
+        chasing = False
+    elif operator_driving:
+        videocar.set_arcade_drive(0, 0)  # the operator let go of the keys (or the web page disconnected)
+        operator_driving = False
+
     buttons = videocar.get_buttons()
     for button in buttons:
         if button == "follow":
@@ -70,9 +82,11 @@ while True:
         elif time() > last_seen_time + 2:
             tracking = False  # if not tracking for >2s, assume we lost it
 
+    overlay = detection.Overlay()  # what to draw on this frame (drawn only when showing it)
     if x is None:
-        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame)
-        detection.print_relative_xw(frame, x, y, w, h)
+        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, overlay=overlay)
+        detection.print_relative_xw(frame, x, y, w, h, overlay=overlay)
+    videocar.mark_detection_done()  # to see the detection latency at http://localhost:8080/metrics
 
     if chasing:
         rel_x, rel_y, rel_w = detection.to_relative_xyw_deprecated(frame, x, y, w, h)
@@ -96,8 +110,8 @@ while True:
             videocar.set_arcade_drive(0, 0)
 
     status = "CHASING (press SPACE to stop)" if chasing else "NOT CHASING (press C to chase)"
-    cv2.putText(frame, status, (5, frame.shape[0] - 15), cv2.FONT_HERSHEY_PLAIN, 2, detection.GREEN, 2)
+    overlay.text(status, (5, frame.shape[0] - 15), cv2.FONT_HERSHEY_PLAIN, 2, detection.GREEN, 2)
 
-    videocar.display_web_video_frame(frame)
-    cv2.imshow("car", frame)
+    videocar.display_web_video_frame(frame, overlay=overlay)
+    cv2.imshow("car", overlay.render(frame))
 
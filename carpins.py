@@ -0,0 +1,10 @@
+"""
+How the motors of the car are wired and driven (shared by videocar and the simulator in carsim,
+so that the simulator does not need to import videocar with its web server and pigpio)
+"""
+
+RIGHT_MOTOR_PIN = 12
+LEFT_MOTOR_PIN = 13
+PWM_FREQUENCY = 50
+ZERO_THROTTLE = 75000  # duty cycle at which the motor stands still
+FULL_FORWARD = 100000  # duty cycle at full speed forward
@@ -0,0 +1,401 @@
+"""
+Closed-loop simulator for the car (no robot needed): a differential-drive car with a camera, driving around
+a synthetic scene with AprilTags (or pictures, for example faces), or around a recorded video.
+
+The simulation runs in lockstep with your control loop: every `get_video_frame()` moves the simulated time
+forward by one frame, so it runs as fast as your code can go (usually faster than real time).
+
+Example (with videocar, same code as on the real car):
+    import carsim
+    simulator = carsim.CarSimulator(carsim.SyntheticScene([carsim.apriltag_billboard(0, x=2.0, y=0.5)]))
+    videocar.start(simulation=True, simulator=simulator, motor_directions=(-1, -1), video_direction=-1)
+
+Example (batch run from the command line, to tune the gains of a tag-following controller on a headless box):
+    python carsim.py --frames 600 --turn-gain 1.5 --forward-speed 0.4
+    python carsim.py --video recording.mp4 --realtime
+"""
+import argparse
+import collections
+from time import time, sleep
+
+import cv2
+import numpy as np
+
+import carpins
+
+
+# where the car is: x and y (meters, on the floor), heading (radians, counterclockwise, 0 = along X axis)
+Pose = collections.namedtuple("Pose", ["x", "y", "heading"])
+
+
+class DifferentialDriveModel:
+    """
+    Kinematic model of a car with two driven wheels (left and right), where each motor needs some time to reach
+    the commanded speed (first-order lag)
+    """
+
+    def __init__(self, wheel_base=0.15, max_wheel_speed=0.5, motor_time_constant=0.1, pose=(0.0, 0.0, 0.0)):
+        """
+        :param wheel_base: distance between the left and right wheels (meters)
+        :param max_wheel_speed: how fast a wheel moves at full throttle (meters per second)
+        :param motor_time_constant: how quickly the motors respond (seconds to get ~63% of the way to the new speed)
+        :param pose: starting (x, y, heading)
+        """
+        self.wheel_base = wheel_base
+        self.max_wheel_speed = max_wheel_speed
+        self.motor_time_constant = motor_time_constant
+        self.pose = Pose(*pose)
+        self.left_signal, self.right_signal = 0.0, 0.0  # commanded, between -1 and +1
+        self.left_speed, self.right_speed = 0.0, 0.0  # actual, meters per second
+        self.distance_travelled = 0.0
+
+    def step(self, dt):
+        # motors catch up with the commanded speed
+        response = 1.0 - np.exp(-dt / self.motor_time_constant) if self.motor_time_constant > 0 else 1.0
+        self.left_speed += response * (self.left_signal * self.max_wheel_speed - self.left_speed)
+        self.right_speed += response * (self.right_signal * self.max_wheel_speed - self.right_speed)
+
+        # and the car moves along an arc (using the heading in the middle of the step)
+        speed = (self.left_speed + self.right_speed) / 2
+        turn_rate = (self.right_speed - self.left_speed) / self.wheel_base  # left wheel faster => turning right
+        x, y, heading = self.pose
+        middle_heading = heading + turn_rate * dt / 2
+        self.pose = Pose(
+            x + speed * dt * np.cos(middle_heading),
+            y + speed * dt * np.sin(middle_heading),
+            heading + turn_rate * dt)
+        self.distance_travelled += abs(speed) * dt
+
+
+class VirtualPigpio:
+    """
+    Pretends to be pigpio.pi for videocar: turns the duty cycles sent to the motor pins back into motor signals
+    (between -1 and +1), and gives them to the simulated car
+    """
+
+    def __init__(self, car):
+        self.car = car
+        self.connected = True
+        self.motor_directions = (1, 1)  # how the simulated motors are wired (set by CarSimulator.wire())
+
+    def hardware_PWM(self, gpio, frequency, duty_cycle):
+        signal = 0.0  # frequency 0 = no pulses = motor stopped
+        if frequency != 0:
+            signal = (duty_cycle - carpins.ZERO_THROTTLE) / (carpins.FULL_FORWARD - carpins.ZERO_THROTTLE)
+            signal = float(np.clip(signal, -1.0, +1.0))
+        if gpio == carpins.LEFT_MOTOR_PIN:
+            self.car.left_signal = signal * self.motor_directions[0]
+        elif gpio == carpins.RIGHT_MOTOR_PIN:
+            self.car.right_signal = signal * self.motor_directions[1]
+        return 0
+
+
+class PinholeCamera:
+    """
+    Camera on the car, looking forward (with no tilt)
+    """
+
+    def __init__(self, width=640, height=480, fov_degrees=62.2, mount_height=0.1):
+        """
+        :param fov_degrees: horizontal field of view (62.2 for Raspberry Pi camera v2)
+        :param mount_height: how high above the floor the camera is (meters)
+        """
+        self.width, self.height = width, height
+        self.focal = (width / 2) / np.tan(np.radians(fov_degrees) / 2)
+        self.cx, self.cy = width / 2, height / 2
+        self.mount_height = mount_height
+        self.matrix = np.array([[self.focal, 0, self.cx], [0, self.focal, self.cy], [0, 0, 1]])
+
+    def project(self, points, pose):
+        """
+        :param points: Nx3 array of (x, y, z) points in the world (meters)
+        :param pose: where the car is
+        :return: (Nx2 array of pixel coordinates, N distances along the camera axis)
+        """
+        dx, dy = points[:, 0] - pose.x, points[:, 1] - pose.y
+        cos, sin = np.cos(pose.heading), np.sin(pose.heading)
+        forward = dx * cos + dy * sin
+        left = -dx * sin + dy * cos
+        up = points[:, 2] - self.mount_height
+        depth = np.maximum(forward, 1e-6)
+        pixels = np.stack([self.cx - self.focal * left / depth, self.cy - self.focal * up / depth], axis=1)
+        return pixels, forward
+
+
+class Billboard:
+    """
+    A flat picture standing upright on the floor (like a printed AprilTag taped to a box)
+    """
+
+    def __init__(self, image, x, y, width, bottom=0.0, facing=np.pi):
+        """
+        :param image: the picture (grayscale or BGR)
+        :param x: where its center is (meters)
+        :param y: where its center is (meters)
+        :param width: how wide it is (meters), the height follows from the picture's aspect ratio
+        :param bottom: how high above the floor its lower edge is (meters)
+        :param facing: which direction it faces (radians), default = towards the car that starts at (0, 0, 0)
+        """
+        self.image = image if image.ndim == 3 else cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        self.x, self.y, self.width, self.bottom, self.facing = x, y, width, bottom, facing
+        self.height = width * image.shape[0] / image.shape[1]
+
+    def corners(self):
+        # top-left, top-right, bottom-right, bottom-left (as seen by someone standing in front of it)
+        left = np.array([np.sin(self.facing), -np.cos(self.facing), 0.0]) * self.width / 2
+        center = np.array([self.x, self.y, self.bottom + self.height / 2])
+        up = np.array([0.0, 0.0, self.height / 2])
+        return np.array([center + left + up, center - left + up, center - left - up, center + left - up])
+
+    def is_facing(self, pose):
+        to_camera = np.array([pose.x - self.x, pose.y - self.y])
+        return to_camera @ np.array([np.cos(self.facing), np.sin(self.facing)]) > 0
+
+
+def apriltag_billboard(tag_id, x, y, size=0.15, bottom=0.05, facing=np.pi, family=cv2.aruco.DICT_APRILTAG_36h11):
+    """
+    :param size: width of the black square of the tag (meters), the white margin around it is extra
+    :return: Billboard with an AprilTag (tag36h11 by default, same as the examples detect)
+    """
+    pixels = 80
+    tag = cv2.aruco.generateImageMarker(cv2.aruco.getPredefinedDictionary(family), tag_id, pixels, borderBits=1)
+    margin = pixels // 8
+    tag = cv2.copyMakeBorder(tag, margin, margin, margin, margin, cv2.BORDER_CONSTANT, value=255)
+    return Billboard(tag, x, y, size * tag.shape[1] / pixels, bottom, facing)
+
+
+class SyntheticScene:
+    """
+    Floor, walls (well, a gray background) and billboards, drawn from the point of view of the car's camera
+    """
+
+    def __init__(self, billboards, seed=0):
+        self.billboards = list(billboards)
+        self.rng = np.random.default_rng(seed)
+        self.background = None
+
+    def render(self, pose, camera):
+        if self.background is None or self.background.shape[:2] != (camera.height, camera.width):
+            self.background = self._make_background(camera)
+        frame = self.background.copy()
+
+        # draw the far billboards first, so that the near ones cover them
+        visible = []
+        for billboard in self.billboards:
+            if not billboard.is_facing(pose):
+                continue
+            pixels, depth = camera.project(billboard.corners(), pose)
+            if np.any(depth < 0.05):
+                continue  # (partly) behind the camera
+            visible.append((depth.mean(), billboard, pixels))
+        for _, billboard, pixels in sorted(visible, key=lambda item: -item[0]):
+            _draw_billboard(frame, billboard.image, pixels)
+        return frame
+
+    def _make_background(self, camera):
+        frame = np.empty((camera.height, camera.width, 3), dtype=np.uint8)
+        horizon = int(camera.cy)
+        frame[:horizon] = (170, 165, 160)  # walls
+        frame[horizon:] = (95, 105, 115)  # floor
+        noise = self.rng.integers(-12, 12, size=frame.shape, dtype=np.int16)
+        return np.clip(frame.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+
+
+def _draw_billboard(frame, image, pixels):
+    # only warp the part of the frame that the billboard covers (much faster than warping the whole frame)
+    x0, y0 = np.maximum(np.floor(pixels.min(axis=0)).astype(int), 0)
+    x1, y1 = np.minimum(np.ceil(pixels.max(axis=0)).astype(int) + 1, (frame.shape[1], frame.shape[0]))
+    if x1 <= x0 or y1 <= y0:
+        return  # outside of the frame
+    h, w = image.shape[:2]
+    source = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    target = np.float32(pixels - (x0, y0))
+    transform = cv2.getPerspectiveTransform(source, target)
+    patch = cv2.warpPerspective(image, transform, (x1 - x0, y1 - y0), flags=cv2.INTER_LINEAR)
+    mask = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.fillConvexPoly(mask, np.round(target).astype(np.int32), 255)
+    roi = frame[y0:y1, x0:x1]
+    roi[mask > 0] = patch[mask > 0]
+
+
+class VideoScene:
+    """
+    Replays a recorded video (looped), and warps it as if the camera turned and drove forward with the car:
+    turning shifts the picture sideways, driving forward zooms in (as if everything was `scene_distance` away).
+    This is only an approximation (there is no parallax, and driving sideways is ignored), but it is good enough
+    to see if a control loop turns the right way.
+    """
+
+    def __init__(self, path, scene_distance=2.0):
+        self.path = path
+        self.video = cv2.VideoCapture(path)
+        assert self.video.isOpened(), f"cannot read from {path}"
+        self.scene_distance = scene_distance
+        self.start_pose = None
+
+    def render(self, pose, camera):
+        success, frame = self.video.read()
+        if not success:
+            self.video.release()
+            self.video = cv2.VideoCapture(self.path)  # start over
+            success, frame = self.video.read()
+            assert success, f"cannot read from {self.path}"
+        if frame.shape[:2] != (camera.height, camera.width):
+            frame = cv2.resize(frame, (camera.width, camera.height), interpolation=cv2.INTER_AREA)
+        if self.start_pose is None:
+            self.start_pose = pose
+
+        # how much did we turn and drive forward since the start
+        turned = pose.heading - self.start_pose.heading
+        dx, dy = pose.x - self.start_pose.x, pose.y - self.start_pose.y
+        forward = dx * np.cos(self.start_pose.heading) + dy * np.sin(self.start_pose.heading)
+        zoom = self.scene_distance / max(self.scene_distance - forward, 0.1 * self.scene_distance)
+
+        # turning left (counterclockwise) moves the scene to the right
+        rotation = np.array([[np.cos(turned), 0, -np.sin(turned)], [0, 1, 0], [np.sin(turned), 0, np.cos(turned)]])
+        scaling = np.array([[zoom, 0, camera.cx * (1 - zoom)], [0, zoom, camera.cy * (1 - zoom)], [0, 0, 1]])
+        transform = scaling @ camera.matrix @ rotation @ np.linalg.inv(camera.matrix)
+        return cv2.warpPerspective(frame, transform, (camera.width, camera.height))
+
+
+class CarSimulator:
+    """
+    Simulated car with a camera. Has the same `read()` as videocar.CameraReader (so it can be the camera of
+    videocar), and `pins` that can be the pigpio of videocar: see `videocar.start(simulation=True, simulator=...)`.
+
+    Every `read()` moves the simulated time forward by one frame (1/fps seconds), drives the car with whatever
+    the motors were set to, and renders what the camera sees from there.
+    """
+
+    def __init__(self, scene, fps=20, camera=None, car=None, realtime=False):
+        """
+        :param scene: SyntheticScene or VideoScene
+        :param camera: PinholeCamera (default: 640x480, Raspberry Pi camera v2)
+        :param car: DifferentialDriveModel (default: small car, 0.5 m/s at full throttle)
+        :param realtime: if True, wait so that the simulated time goes as fast as real time (otherwise, faster)
+        """
+        self.scene = scene
+        self.fps = fps
+        self.camera = camera or PinholeCamera()
+        self.car = car or DifferentialDriveModel()
+        self.pins = VirtualPigpio(self.car)
+        self.realtime = realtime
+        self.video_direction = 1
+        self.time = 0.0  # simulated seconds since the start
+        self.sequence = 0
+        self.dropped_frames = 0  # never drops frames: the simulation waits for the control loop
+        self.frame = None
+        self.wall_start_time = None
+
+    def wire(self, motor_directions=(1, 1), video_direction=1):
+        """
+        Make the simulated car wired the same way as the real car (so that the same videocar.start() arguments work)
+        """
+        self.pins.motor_directions = motor_directions
+        self.video_direction = video_direction
+
+    def set_motors(self, left, right):
+        """
+        Set the motor signals directly (between -1 and +1), when not using videocar
+        """
+        self.car.left_signal, self.car.right_signal = float(left), float(right)
+
+    def read(self, wait_for_new_frame=True, timeout=1.0):
+        """
+        :return: (sequence, capture_time, frame), same as videocar.CameraReader.read()
+        """
+        if not wait_for_new_frame and self.frame is not None:
+            return self.sequence, time(), self.frame
+        if self.wall_start_time is None:
+            self.wall_start_time = time()
+        elif self.realtime:
+            sleep(max(0.0, self.wall_start_time + self.time - time()))
+
+        if self.sequence > 0:
+            self.car.step(1.0 / self.fps)
+            self.time += 1.0 / self.fps
+        self.sequence += 1
+        self.frame = self.scene.render(self.car.pose, self.camera)
+        if self.video_direction == -1:
+            self.frame = cv2.flip(self.frame, -1)  # camera installed upside down
+        return self.sequence, time(), self.frame
+
+    def isOpened(self):
+        return True
+
+    def stop(self):
+        pass
+
+    @property
+    def speedup(self):
+        """
+        :return: how much faster than real time the simulation went so far
+        """
+        elapsed = time() - self.wall_start_time if self.wall_start_time is not None else 0.0
+        return self.time / elapsed if elapsed > 0 else None
+
+
+def chase_tag(simulator, frames, turn_gain=1.5, forward_speed=0.4, stop_size=30, detector=None, show=False):
+    """
+    Drive towards the biggest AprilTag with a proportional controller, to tune the gains in batch
+    :param turn_gain: turn speed = turn_gain * (X of the tag, between -0.5 and +0.5)
+    :param stop_size: stop when the tag is this big (percent of the frame)
+    :return: dictionary with the results (when we reached the tag, how far we drove, how fast the simulation went)
+    """
+    import detection
+    import pupil_apriltags as apriltags
+    detector = detector or apriltags.Detector(families="tag36h11", quad_sigma=0.2)
+
+    reached_time, seen_frames = None, 0
+    for _ in range(frames):
+        _, _, frame = simulator.read()
+        x, y, w, h = detection.detect_biggest_apriltag(detector, frame)
+        nx, ny, size = detection.to_normalized_x_y_size(frame, x, y, w, h, draw_box=show)
+        if nx is None:
+            forward, turn = 0.0, 0.3  # look around
+        else:
+            seen_frames += 1
+            turn = float(np.clip(turn_gain * nx / 100, -1, 1))
+            forward = forward_speed if size < stop_size else 0.0
+            if forward == 0.0 and reached_time is None:
+                reached_time = simulator.time
+        forward = min(forward, 1 - abs(turn))  # same limits as videocar.set_arcade_drive()
+        simulator.set_motors(forward + turn, forward - turn)
+        if show:
+            cv2.imshow("carsim", frame)
+            cv2.waitKey(1)
+
+    return {
+        "simulated_seconds": simulator.time,
+        "speedup": simulator.speedup,
+        "reached_tag_after_seconds": reached_time,
+        "frames_with_tag": seen_frames,
+        "distance_travelled": simulator.car.distance_travelled,
+        "final_pose": {key: float(value) for key, value in simulator.car.pose._asdict().items()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="drive a simulated car towards an AprilTag, to tune the gains")
+    parser.add_argument("--video", help="video file to warp (default: synthetic scene with AprilTags)")
+    parser.add_argument("--frames", type=int, default=600)
+    parser.add_argument("--fps", type=float, default=20.0)
+    parser.add_argument("--turn-gain", type=float, default=1.5)
+    parser.add_argument("--forward-speed", type=float, default=0.4)
+    parser.add_argument("--stop-size", type=float, default=30, help="stop when the tag is this big (% of frame)")
+    parser.add_argument("--realtime", action="store_true", help="run at the speed of real time")
+    parser.add_argument("--show", action="store_true", help="show the video (needs a display)")
+    args = parser.parse_args()
+
+    if args.video:
+        scene = VideoScene(args.video)
+    else:
+        scene = SyntheticScene([apriltag_billboard(0, x=3.0, y=1.0), apriltag_billboard(1, x=4.0, y=-2.5)])
+    simulator = CarSimulator(scene, fps=args.fps, realtime=args.realtime)
+    results = chase_tag(simulator, args.frames, args.turn_gain, args.forward_speed, args.stop_size, show=args.show)
+    for key, value in results.items():
+        print(f"{key:>25}: {value}")
+
+
+if __name__ == "__main__":
+    main()
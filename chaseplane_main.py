@@ -49,14 +49,14 @@ while True:
     key = cv2.waitKey(1) & 0xFF
 
     if not tracking or key == ord(' '):
-        x, y, w, h = detection.detect_yolo_object(model, frame, valid_classnames=VALID_OBJECT_CLASSES)
-        cv2.imshow("video", frame)
+        overlay = detection.Overlay()  # the detected boxes (drawn only when showing the frame)
+        x, y, w, h = detection.detect_yolo_object(model, frame, valid_classes=VALID_OBJECT_CLASSES, overlay=overlay)
+        cv2.imshow("video", overlay.render(frame))
         key = cv2.waitKey(1) & 0xFF
         if x is None:
-            cv2.putText(frame,
-                        f"re-detection failed (classes: {VALID_OBJECT_CLASSES}), please select manually", (50, 60),
-                        cv2.FONT_HERSHEY_PLAIN, fontScale=1.25, color=(0, 200, 0), thickness=1)
-            x, y, w, h = cv2.selectROI("video", frame, False)
+            overlay.text(f"re-detection failed (classes: {VALID_OBJECT_CLASSES}), please select manually", (50, 60),
+                         cv2.FONT_HERSHEY_PLAIN, 1.25, (0, 200, 0), 1)
+            x, y, w, h = cv2.selectROI("video", overlay.render(frame), False)
         if x is not None:
             tracker.init(frame, (x, y, w, h))
             tracking = True
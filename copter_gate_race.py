@@ -1,7 +1,7 @@
 import cv2
-from djitellopy import tello
+import videocopter
 
-drone = tello.Tello()
+drone = videocopter.create_tello()  # set TELLO_ADDRESS=127.0.0.1:18889 to fly the emulator (telloemu.py)
 drone.connect()
 
 print(f"battery: {drone.get_battery()}")
@@ -15,8 +15,10 @@ def drone_land():
         print("drone has landed")
 
 def drone_send_rc_control(leftright, fwd, updown, yaw):
-    new_control = (leftright, forward_speed, updown, yaw)
+    global drone_rc_control
+    new_control = (leftright, fwd, updown, yaw)
     if new_control != drone_rc_control:
+        drone_rc_control = new_control
         print(f"drone rc: {leftright}(left), {fwd}(fwd), {updown}(up), {yaw}(yaw)")
 
 # end of simulated drone
@@ -1,5 +1,3 @@
-from djitellopy import Tello
-
 import cv2
 import pupil_apriltags as apriltags
 #from ultralytics import YOLO
@@ -16,9 +14,13 @@ tag_detector = apriltags.Detector(families="tag36h11", quad_sigma=0.2)
 tracker = detection.create_vit_tracker()
 
 
-drone = Tello()
+drone = videocopter.create_tello()  # set TELLO_ADDRESS=127.0.0.1:18889 to fly the emulator (telloemu.py)
 drone.connect()
 drone.streamon()
+frame_reader = videocopter.TelloFrameReader(drone)  # gives every new frame once (so we do not re-detect old frames)
+rc = videocopter.RcControlScheduler(drone, rate_hz=20)  # sends our latest RC command 20 times per second
+telemetry = videocopter.TelloTelemetry(drone)  # latest battery, altitude, speeds (without asking the drone every time)
+pid = videocopter.create_follow_pid_controller()  # remembers its state between frames (for drone_follow_object_pid)
 
 
 def main():
@@ -38,10 +40,11 @@ def main():
             drone.move_back(50)  # 50 centimeters
 
 
-        # 1. read one video frame from the camera
-        frame = drone.get_frame_read().frame
-        if frame is None:
-            continue  # try again, if nothing was read
+        # 1. read one new video frame from the camera
+        new_frame = frame_reader.wait_for_new_frame(timeout=0.05)
+        if new_frame is None:
+            continue  # try again, if no new frame arrived yet
+        frame = new_frame.frame
         frame_width = frame.shape[1]
 
         # 2. locate the object
@@ -56,8 +59,9 @@ def main():
         #        time_last_seen = 0  # if track was lost for more than 1s, assume we can no longer track it
 
         # -- detect a new object, if never saw it (or lost it)
+        overlay = detection.Overlay()  # what to draw on this frame (drawn only when showing it)
         if x is None:
-            x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame)
+            x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, overlay=overlay)
             # x, y, w, h = detection.detect_biggest_face(face_detector, frame)
             # x, y, w, h = detection.detect_yolo_object(model, frame, valid_classnames={"sports ball"}, lowest_conf=0.3)
 
@@ -70,8 +74,9 @@ def main():
         if x is not None:
             # if object is seen, set speed towards it
             status = "CHASING"
-            #videocopter.drone_follow_object_pids(drone, frame, bbox=(x, y, w, h))
-            videocopter.drone_follow_object_bang(drone, frame, bbox=(x, y, w, h))
+            #videocopter.drone_follow_object_pids(rc, frame, bbox=(x, y, w, h))
+            #videocopter.drone_follow_object_pid(rc, frame, bbox=(x, y, w, h), controller=pid, timestamp=new_frame.receive_time)
+            videocopter.drone_follow_object_bang(rc, frame, bbox=(x, y, w, h))
             last_seen_x = x
         elif last_seen_x is not None:
             # if not seen, try to slowly turn (ideally, in the direction where object was last seen)
@@ -79,12 +84,14 @@ def main():
             seek_turn_speed = +50  # seek to the right by default
             if last_seen_x is not None and last_seen_x < frame_width / 2:
                 seek_turn_speed = -50  # seek left if last saw it on the left
-            drone.send_rc_control(0, 0, 0, seek_turn_speed)
+            rc.send_rc_control(0, 0, 0, seek_turn_speed)
 
         # 4. print the status info on the video frame, and then show that frame
-        status = f"bat: {drone.get_battery()}%, alt: {drone.get_distance_tof()}, width: {w}, " + status
-        cv2.putText(frame, status, (5, 25), cv2.FONT_HERSHEY_PLAIN, 2, detection.GREEN, 2)
-        cv2.imshow('drone video', frame)
+        state = telemetry.snapshot()
+        if state is not None:
+            status = f"bat: {state.battery}%, alt: {state.tof}, width: {w}, " + status
+        overlay.text(status, (5, 25), cv2.FONT_HERSHEY_PLAIN, 2, detection.GREEN, 2)
+        cv2.imshow('drone video', overlay.render(frame))
 
 
 if __name__ == "__main__":
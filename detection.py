@@ -1,4 +1,8 @@
 import typing
+import collections
+import functools
+import threading
+import concurrent.futures
 
 import cv2
 import time
@@ -24,14 +28,160 @@ COCO_CLASSNAMES = [
 
 
 
-def detect_biggest_apriltag(detector, frame, only_these_ids=None, tracker=None):
-    return detect_or_track(frame, tracker, lambda: _detect_biggest_apriltag(detector, frame, only_these_ids))
+# (the last known box is looked up right away, on this thread, because the detector may run on another thread)
+def detect_biggest_apriltag(detector, frame, only_these_ids=None, tracker=None, overlay=None, capture_time=None):
+    near_xywh = _last_known_xywh(tracker)
+    return detect_or_track(frame, tracker, lambda f, o: _detect_near(
+        f, near_xywh, o,
+        lambda image, offset, o: _detect_biggest_apriltag(detector, image, only_these_ids, o)), overlay, capture_time)
 
-def detect_biggest_face(face_detector, frame, previous_xywh=None, tracker=None):
-    return detect_or_track(frame, tracker, lambda: _detect_biggest_face(face_detector, frame, previous_xywh=previous_xywh))
+def detect_biggest_face(face_detector, frame, previous_xywh=None, tracker=None, overlay=None, capture_time=None):
+    near_xywh = _last_known_xywh(tracker, previous_xywh)
+    return detect_or_track(frame, tracker, lambda f, o: _detect_near(
+        f, near_xywh, o,
+        lambda image, offset, o: _detect_biggest_face(
+            face_detector, image, overlay=o, previous_xywh=_shifted(previous_xywh, offset))), overlay, capture_time)
 
-def detect_yolo_object(yolo_model, frame, valid_classes=("person", "car"), lowest_conf=0.4, tracker=None):
-    return detect_or_track(frame, tracker, lambda: _detect_yolo_object(yolo_model, frame, valid_classes, lowest_conf))
+def detect_yolo_object(yolo_model, frame, valid_classes=("person", "car"), lowest_conf=0.4, tracker=None, overlay=None,
+                       capture_time=None):
+    return detect_or_track(
+        frame, tracker, lambda f, o: _detect_yolo_object(yolo_model, f, valid_classes, lowest_conf, o), overlay,
+        capture_time)
+
+def detect_all_apriltags(detector, frame, only_these_ids=None, overlay=None):
+    return _detect_apriltags(detector, frame, only_these_ids, overlay)
+
+def detect_all_faces(face_detector, frame):
+    gray_frame = _as_context(frame).gray
+    return [tuple(int(v) for v in box) for box in face_detector.detectMultiScale(gray_frame, scaleFactor=1.1, minNeighbors=9)]
+
+def detect_all_yolo_objects(yolo_model, frame, valid_classes=("person", "car"), lowest_conf=0.4, overlay=None):
+    return _detect_yolo_objects(yolo_model, frame, valid_classes, lowest_conf, overlay)
+
+
+class FrameContext(object):
+    """
+    A video frame together with the images made from it (grayscale, smaller), each made only once:
+    if several detectors run on the same frame, they all share the same grayscale image (and so on).
+
+    Any detect_* function accepts a FrameContext instead of a frame, for example:
+        context = detection.FrameContext(frame)
+        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, context, tracker=tracker)
+        faces = detection.detect_all_faces(face_detector, context)  # reuses the grayscale image made above
+    """
+    def __init__(self, frame):
+        self.frame = frame
+        self.cache = {}
+
+    @property
+    def shape(self):
+        return self.frame.shape
+
+    @property
+    def gray(self):
+        if "gray" not in self.cache:
+            self.cache["gray"] = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY) if self.frame.ndim == 3 else self.frame
+        return self.cache["gray"]
+
+    def pyramid(self, level, gray=False):
+        """
+        :param level: 0 = full size, 1 = half size, 2 = quarter size, ...
+        :param gray: grayscale (True) or original colors (False)
+        :return: the image at this level of the image pyramid
+        """
+        if level == 0:
+            return self.gray if gray else self.frame
+        key = ("pyramid", level, gray)
+        if key not in self.cache:
+            self.cache[key] = cv2.pyrDown(self.pyramid(level - 1, gray))
+        return self.cache[key]
+
+    def scaled(self, scale, gray=False):
+        """
+        :return: image resized by this scale (for example, 0.5 = half the width and half the height)
+        """
+        if scale == 1.0:
+            return self.gray if gray else self.frame
+        key = ("scaled", scale, gray)
+        if key not in self.cache:
+            image = self.gray if gray else self.frame
+            self.cache[key] = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        return self.cache[key]
+
+    def crop(self, x0, y0, x1, y1):
+        """
+        :return: FrameContext for a window of this frame (reusing the grayscale image, if it was already made)
+        """
+        window = FrameContext(self.frame[y0:y1, x0:x1])
+        if "gray" in self.cache:
+            window.cache["gray"] = self.cache["gray"][y0:y1, x0:x1]
+        return window
+
+    def copy(self):
+        return FrameContext(self.frame.copy())
+
+    def invalidate(self, frame=None):
+        """
+        Forget all the images made from the frame (must be called if the frame was changed),
+        and switch to a new frame if it is given
+        """
+        if frame is not None:
+            self.frame = frame
+        self.cache.clear()
+
+
+def _as_context(frame):
+    return frame if isinstance(frame, FrameContext) else FrameContext(frame)
+
+
+class Overlay(object):
+    """
+    A list of drawing commands (boxes, text, ...) for a video frame, which are only drawn when someone needs to see them:
+    detection code adds commands here instead of drawing on the frame, and the display code calls `render(frame)`
+
+    Example:
+        overlay = detection.Overlay()
+        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, tracker=tracker, overlay=overlay)
+        cv2.imshow("camera", overlay.render(frame))
+    """
+    def __init__(self, commands=None, offset=(0, 0)):
+        self.commands = commands if commands is not None else []
+        self.offset = offset
+
+    def shifted(self, dx, dy):
+        """
+        :return: overlay that adds commands to this same list, but with coordinates moved by (dx, dy)
+         (useful when detecting on a window of the frame)
+        """
+        return Overlay(self.commands, (self.offset[0] + dx, self.offset[1] + dy))
+
+    def rectangle(self, pt1, pt2, color, thickness=1):
+        self.commands.append((cv2.rectangle, (self._moved(pt1), self._moved(pt2), color, thickness)))
+
+    def polylines(self, contours, is_closed, color, thickness=1):
+        contours = [np.asarray(contour) + self.offset for contour in contours]
+        self.commands.append((cv2.polylines, (contours, is_closed, color, thickness)))
+
+    def text(self, text, org, font_face, font_scale, color, thickness=1):
+        self.commands.append((cv2.putText, (text, self._moved(org), font_face, font_scale, color, thickness)))
+
+    def clear(self):
+        self.commands.clear()
+
+    def render(self, frame, copy=True):
+        """
+        Draw all the commands on a copy of this frame (or on the frame itself, if copy=False)
+        :return: the frame with everything drawn on it
+        """
+        if frame is None:
+            return None
+        image = frame.copy() if copy else frame
+        for draw, args in self.commands:
+            draw(image, *args)
+        return image
+
+    def _moved(self, point):
+        return int(point[0] + self.offset[0]), int(point[1] + self.offset[1])
 
 
 class TrackerState(object):
@@ -40,7 +190,16 @@ class TrackerState(object):
                  display_confidence: bool = True,
                  tracker_reinit_interval: int = 40,
                  tracker_max_frames_without_object: int = 40,
-                 tracker_lowest_allowed_score: float = 0.6):
+                 tracker_lowest_allowed_score: float = 0.6,
+                 async_redetection: bool = False,
+                 motion_predictor: typing.Optional["BoxMotionPredictor"] = None):
+        """
+        :param async_redetection: run the full (slow) detector on a background thread, while the tracker keeps
+         answering every frame; when the detector is done, its result is merged into the tracker (see `reconcile`)
+        :param motion_predictor: if given, it learns how the box moves, so that `predict()` can tell where the box is
+         *now* (not where it was when the frame was captured), and if the tracker loses the object for a moment,
+         the predicted box is returned instead (while the full detector runs, to confirm or correct it)
+        """
         assert tracker is not None
         self.tracker = tracker
         self.tracking = False
@@ -49,28 +208,57 @@ class TrackerState(object):
         self.frame_count = 0
         self.tracker_comments = None
         self.full_detection_reason = None
+        self.full_detection_counts = collections.Counter()  # how many times each full_detection_reason happened
         self.display_confidence = display_confidence
         self.tracker_reinit_interval = tracker_reinit_interval
         self.tracker_max_frames_without_object = tracker_max_frames_without_object
         self.tracker_lowest_allowed_score = tracker_lowest_allowed_score
+        self.async_detector = AsyncDetector() if async_redetection else None
+        self.motion_predictor = motion_predictor
+        self.bridged_frames = 0  # frames where the tracker lost the object, and the predicted box was used instead
+        # (frame_count, bbox) of recent tracker outputs, to see how far the object moved while detector was running
+        history_size = 2 * max(tracker_reinit_interval, tracker_max_frames_without_object)
+        self.recent_boxes = collections.deque(maxlen=history_size)
 
-    def init(self, frame, bbox):
+    def init(self, frame, bbox, new_object=True):
+        """
+        :param new_object: True if this may be a different object (for example, the user clicked on it), so that
+         the motion_predictor starts over; False if the same object was just detected again
+        """
+        if new_object and self.motion_predictor is not None:
+            self.motion_predictor.reset()  # (the new object must not inherit the velocity of the old one)
         self.tracker.init(frame, bbox)
         self.time_last_seen = self.frame_count
         self.time_last_reinit = self.frame_count
         self.tracking = True
 
-    def update(self, frame):
+    def update(self, frame, capture_time=None):
+        """
+        :param capture_time: when the frame was captured (time.time()), default = now
+        """
         self.frame_count += 1
+        capture_time = time.time() if capture_time is None else capture_time
 
         if not self.tracking:
+            self.full_detection_reason = "not_tracking"
+            self.full_detection_counts[self.full_detection_reason] += 1
             return False, (None, None, None, None)
 
         x, y, w, h, cmt = update_tracker(self.tracker, frame, lowest_allowed_score=self.tracker_lowest_allowed_score)
         reason = "missing"
         if x is not None:
             self.time_last_seen = self.frame_count
+            self.recent_boxes.append((self.frame_count, (x, y, w, h)))
             reason = None
+        if self.motion_predictor is not None:
+            self.motion_predictor.update((x, y, w, h), capture_time)
+            if x is None and self.motion_predictor.can_bridge(capture_time):
+                # lost it just now: it is probably where it was going, so answer with that for now,
+                # but still ask for a full detection (nothing has confirmed that it is really there)
+                x, y, w, h = self.motion_predictor.predict(capture_time)
+                cmt = "predicted"
+                self.bridged_frames += 1
+                reason = "bridged"
         if self.frame_count >= self.time_last_reinit + self.tracker_reinit_interval:
             self.time_last_reinit = self.frame_count
             reason = "tracker_reinit_interval"
@@ -79,9 +267,455 @@ class TrackerState(object):
             reason = "tracker_max_frames_without_object"
         self.tracker_comments = cmt
         self.full_detection_reason = reason
+        if reason is not None:
+            self.full_detection_counts[reason] += 1
         can_skip_full_detection = reason is None
         return can_skip_full_detection, (x, y, w, h)
 
+    def reconcile(self, frame, detected_frame_count, bbox):
+        """
+        Re-initialize the tracker with a bounding box that the detector found on an older frame,
+        after shifting and scaling that box by how much the tracked object moved since that older frame
+        :param frame: the current video frame
+        :param detected_frame_count: `frame_count` of the frame on which the detector found the box
+        :param bbox: (x, y, w, h) found by the detector
+        :return: True if the tracker was re-initialized, False if the detection was too old to use
+        """
+        if detected_frame_count < self.time_last_reinit:
+            return False  # tracker was re-initialized after that frame, so this detection is stale
+
+        x, y, w, h = bbox
+        then = self._recent_box_at(detected_frame_count)
+        now = self._recent_box_at(self.frame_count)
+        if then is not None and now is not None and then[2] > 0 and then[3] > 0:
+            # move the center of detected box the same way as the tracked box moved, and scale it the same way
+            scale_x, scale_y = now[2] / then[2], now[3] / then[3]
+            center_x = x + w / 2 + (now[0] + now[2] / 2) - (then[0] + then[2] / 2)
+            center_y = y + h / 2 + (now[1] + now[3] / 2) - (then[1] + then[3] / 2)
+            w, h = w * scale_x, h * scale_y
+            x, y = center_x - w / 2, center_y - h / 2
+
+        frame_width, frame_height = frame.shape[1], frame.shape[0]
+        x, y = int(np.clip(x, 0, frame_width - 1)), int(np.clip(y, 0, frame_height - 1))
+        w, h = int(np.clip(w, 1, frame_width - x)), int(np.clip(h, 1, frame_height - y))
+        self.init(frame, (x, y, w, h), new_object=False)
+        return True
+
+    def predict(self, at_time=None):
+        """
+        Where the tracked box probably is at this time (for example, when the motor command is being sent),
+        if the tracker has a motion_predictor
+        :param at_time: time.time() to predict for, default = now
+        :return: (x, y, w, h) or (None, None, None, None)
+        """
+        if self.motion_predictor is None or not self.tracking:
+            return None, None, None, None
+        return self.motion_predictor.predict(at_time)
+
+    @property
+    def last_box(self):
+        """
+        The most recent (x, y, w, h) box seen by the tracker, or None if not tracking anything now
+        """
+        if not self.tracking or not self.recent_boxes:
+            return None
+        return self.recent_boxes[-1][1]
+
+    def _recent_box_at(self, frame_count):
+        # the latest tracked box seen on or before that frame
+        for seen_frame_count, box in reversed(self.recent_boxes):
+            if seen_frame_count <= frame_count:
+                return box
+        return None
+
+
+class AsyncDetector(object):
+    """
+    Runs a full detector on a snapshot of the frame in a background thread, one detection at a time
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.result = None
+
+    @property
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def submit(self, frame_count, frame, detector):
+        """
+        Start detecting on a copy of this frame, unless the previous detection is still running
+        :param detector: function(frame_context, overlay), it must not read anything that the caller keeps changing
+         (like TrackerState), because it runs on another thread
+        :return: True if started
+        """
+        if self.busy:
+            return False
+        snapshot = _as_context(frame).copy()  # the caller can keep drawing on the original frame
+        self.thread = threading.Thread(target=self._run, args=(frame_count, snapshot, detector), daemon=True)
+        self.thread.start()
+        return True
+
+    def poll(self):
+        """
+        :return: (frame_count, (x, y, w, h)) of the finished detection, or None if nothing new has finished
+        """
+        with self.lock:
+            result, self.result = self.result, None
+        return result
+
+    def _run(self, frame_count, frame, detector):
+        bbox = detector(frame, None)  # no overlay, because that frame is already gone when this is done
+        with self.lock:
+            self.result = (frame_count, bbox)
+
+
+class BoxMotionPredictor(object):
+    """
+    Constant-velocity Kalman filter on a bounding box (its center, width and height, and how fast they change),
+    to predict where the box is a bit later than the frame on which it was seen
+    (for example: the frame was captured 80ms ago, where is the object now?)
+
+    Example:
+        predictor = detection.BoxMotionPredictor()
+        predictor.update((x, y, w, h), capture_time)  # box seen on the frame captured at capture_time
+        x, y, w, h = predictor.predict()  # where it probably is now
+    """
+    def __init__(self, acceleration_noise=400.0, measurement_noise=4.0, max_bridge_seconds=0.3,
+                 max_prediction_seconds=0.5, reset_distance=2.0):
+        """
+        :param acceleration_noise: how suddenly the box can speed up (pixels per second^2, as standard deviation)
+        :param measurement_noise: how much the detected box jitters (pixels, as standard deviation)
+        :param max_bridge_seconds: how long after the last real box `can_bridge()` says yes
+        :param max_prediction_seconds: never extrapolate further than this past the last real box
+        :param reset_distance: if a new box is further than this many box sizes from the predicted one,
+         it must be another object: start over from that box
+        """
+        self.acceleration_noise = acceleration_noise
+        self.measurement_noise = measurement_noise
+        self.max_bridge_seconds = max_bridge_seconds
+        self.max_prediction_seconds = max_prediction_seconds
+        self.reset_distance = reset_distance
+        self.observation = np.hstack([np.eye(4), np.zeros((4, 4))])  # we only see (cx, cy, w, h), not velocities
+        self.reset()
+
+    def reset(self):
+        self.state = None  # (cx, cy, w, h, and their velocities per second)
+        self.covariance = None
+        self.state_time = None
+        self.last_measurement_time = None
+
+    @property
+    def initialized(self):
+        return self.state is not None
+
+    def update(self, bbox, timestamp=None):
+        """
+        :param bbox: (x, y, w, h) seen on the frame captured at `timestamp`, or (None, None, None, None) if not seen
+        :param timestamp: when that frame was captured (time.time()), default = now
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        if bbox is None or bbox[0] is None:
+            return
+        if timestamp == self.last_measurement_time:
+            return  # same frame again (for example, tracker was re-initialized on it)
+        x, y, w, h = bbox
+        measurement = np.array([x + w / 2, y + h / 2, w, h], dtype=float)
+        if self.state is None or timestamp - self.last_measurement_time > self.max_prediction_seconds:
+            self._start(measurement, timestamp)
+            return
+
+        state, covariance = self._predicted(timestamp)
+        if np.hypot(*(measurement[:2] - state[:2])) > self.reset_distance * max(state[2], state[3], 1.0):
+            self._start(measurement, timestamp)
+            return
+
+        # the usual Kalman update
+        noise = np.eye(4) * self.measurement_noise ** 2
+        innovation = measurement - self.observation @ state
+        innovation_covariance = self.observation @ covariance @ self.observation.T + noise
+        gain = covariance @ self.observation.T @ np.linalg.inv(innovation_covariance)
+        self.state = state + gain @ innovation
+        self.covariance = (np.eye(8) - gain @ self.observation) @ covariance
+        self.state_time = max(self.state_time, timestamp)
+        self.last_measurement_time = max(self.last_measurement_time, timestamp)
+
+    def predict(self, at_time=None):
+        """
+        :param at_time: time.time() to predict for, default = now
+        :return: (x, y, w, h) where the box probably is at that time, or (None, None, None, None) if never seen
+         (or if not seen for longer than max_prediction_seconds)
+        """
+        at_time = time.time() if at_time is None else at_time
+        if self.state is None or at_time - self.last_measurement_time > self.max_prediction_seconds:
+            return None, None, None, None
+        state, _ = self._predicted(at_time)
+        cx, cy, w, h = state[:4]
+        w, h = max(w, 1.0), max(h, 1.0)
+        return int(cx - w / 2), int(cy - h / 2), int(w), int(h)
+
+    def can_bridge(self, at_time=None):
+        """
+        :return: True if the last real box was seen recently enough to trust the prediction (for a short dropout)
+        """
+        at_time = time.time() if at_time is None else at_time
+        return self.state is not None and at_time - self.last_measurement_time <= self.max_bridge_seconds
+
+    @property
+    def velocity(self):
+        """
+        :return: (vx, vy, vw, vh) how fast the box center, width and height change (pixels per second)
+        """
+        return None if self.state is None else tuple(self.state[4:])
+
+    def _start(self, measurement, timestamp):
+        self.state = np.concatenate([measurement, np.zeros(4)])
+        self.covariance = np.diag([self.measurement_noise ** 2] * 4 + [(10 * self.measurement_noise) ** 2] * 4)
+        self.state_time = timestamp
+        self.last_measurement_time = timestamp
+
+    def _predicted(self, at_time):
+        dt = at_time - self.state_time
+        if dt <= 0:
+            return self.state, self.covariance  # (the frames may arrive a bit out of order, do not go back in time)
+        transition = np.eye(8)
+        transition[:4, 4:] = np.eye(4) * dt
+        # white-noise acceleration model
+        q = self.acceleration_noise ** 2
+        block = np.array([[dt ** 4 / 4, dt ** 3 / 2], [dt ** 3 / 2, dt ** 2]]) * q
+        process_noise = np.kron(block, np.eye(4))
+        return transition @ self.state, transition @ self.covariance @ transition.T + process_noise
+
+
+class Track(object):
+    """
+    One object followed by MultiTrackerState
+    """
+    def __init__(self, track_id, bbox, frame_count):
+        self.track_id = track_id
+        self.box = np.array(bbox, dtype=float)  # x, y, w, h (predicted, moved by the velocity between observations)
+        self.observed_box = self.box.copy()  # where the box was last actually seen
+        self.velocity = np.zeros(2)  # how fast the box moves, in pixels per frame
+        self.time_last_seen = frame_count
+        self.tracker = None  # cv2.TrackerVit, only created for the tracks that are being followed
+
+    @property
+    def xywh(self):
+        x, y, w, h = self.box
+        return int(x), int(y), int(w), int(h)
+
+    def observe(self, bbox, frame_count, smoothing=0.5):
+        # update the velocity from how far the box moved since it was last seen (not since it was last predicted,
+        # or else the prediction would hide half of the motion), then update the box itself
+        frames_passed = frame_count - self.time_last_seen
+        bbox = np.array(bbox, dtype=float)
+        if frames_passed > 0:  # (if seen twice on the same frame, by the tracker and by the detector, only move it)
+            last = self.observed_box
+            shift = (bbox[:2] + bbox[2:] / 2) - (last[:2] + last[2:] / 2)
+            self.velocity = smoothing * self.velocity + (1 - smoothing) * shift / frames_passed
+        self.box = bbox
+        self.observed_box = bbox.copy()
+        self.time_last_seen = frame_count
+
+
+class MultiTrackerState(object):
+    """
+    Keeps many objects tracked at once, each with a stable track_id:
+     - new detections are matched to the existing tracks by optimal assignment (using IoU and center distance)
+     - only the followed tracks (see `follow`) get an expensive ViT tracker update on every frame,
+       the others are only moved by their velocity until the next detection
+
+    Example:
+        tracks = detection.MultiTrackerState()
+        while True:
+            detections = detection.detect_all_apriltags(tag_detector, frame) if tracks.needs_detection else None
+            boxes = tracks.update(frame, detections)  # {track_id: (x, y, w, h)}
+            if not tracks.followed_ids and boxes:
+                tracks.follow(next(iter(boxes)))
+    """
+    def __init__(self,
+                 create_tracker=None,
+                 detection_interval: int = 10,
+                 max_frames_without_object: int = 40,
+                 tracker_lowest_allowed_score: float = 0.6,
+                 max_association_cost: float = 1.5,
+                 center_distance_weight: float = 1.0):
+        """
+        :param create_tracker: function that makes a new tracker for a followed track (default: create_vit_tracker)
+        :param detection_interval: how often (in frames) `needs_detection` asks for a full detection
+        :param max_frames_without_object: drop a track if it was not seen for this many frames
+        :param tracker_lowest_allowed_score: ignore ViT tracker outputs with lower confidence than this
+        :param max_association_cost: do not match a detection to a track if it costs more than this
+         (cost = 1 - IoU + center_distance_weight * center distance / track box diagonal)
+        :param center_distance_weight: how much the center distance matters, compared to IoU
+        """
+        self.create_tracker = create_tracker or create_vit_tracker
+        self.detection_interval = detection_interval
+        self.max_frames_without_object = max_frames_without_object
+        self.tracker_lowest_allowed_score = tracker_lowest_allowed_score
+        self.max_association_cost = max_association_cost
+        self.center_distance_weight = center_distance_weight
+        self.tracks = []
+        self.followed_ids = set()
+        self.frame_count = 0
+        self.time_last_detection = None
+        self.next_track_id = 1
+        self.followed_track_missing = False
+
+    @property
+    def needs_detection(self):
+        if self.time_last_detection is None or not self.tracks or self.followed_track_missing:
+            return True
+        return self.frame_count + 1 >= self.time_last_detection + self.detection_interval
+
+    def follow(self, *track_ids):
+        """
+        Follow these tracks closely (using ViT tracker on every frame), and stop following all others
+        """
+        self.followed_ids = set(track_ids)
+        for track in self.tracks:
+            if track.track_id not in self.followed_ids:
+                track.tracker = None
+
+    def boxes(self):
+        return {track.track_id: track.xywh for track in self.tracks}
+
+    def update(self, frame, detections=None):
+        """
+        :param frame: the new video frame
+        :param detections: list of (x, y, w, h) boxes found on this frame, or None if detection was skipped
+        :return: dictionary {track_id: (x, y, w, h)} of all objects tracked now
+        """
+        self.frame_count += 1
+        self.followed_track_missing = False
+
+        # 1. cheap motion prediction for every track
+        for track in self.tracks:
+            track.box[:2] += track.velocity
+
+        # 2. expensive tracker updates, but only for the followed tracks
+        for track in self.tracks:
+            if track.track_id not in self.followed_ids:
+                continue
+            if track.tracker is None:
+                track.tracker = self.create_tracker()
+                track.tracker.init(frame, track.xywh)
+                continue
+            x, y, w, h, _ = update_tracker(track.tracker, frame, self.tracker_lowest_allowed_score)
+            if x is not None:
+                track.observe((x, y, w, h), self.frame_count)
+            else:
+                self.followed_track_missing = True
+
+        # 3. match the detections to tracks, and start new tracks for detections that did not match any
+        if detections is not None:
+            self.time_last_detection = self.frame_count
+            matched = self._associate(detections)
+            for detection_index, bbox in enumerate(detections):
+                track = matched.get(detection_index)
+                if track is None:
+                    self.tracks.append(Track(self.next_track_id, bbox, self.frame_count))
+                    self.next_track_id += 1
+                    continue
+                track.observe(bbox, self.frame_count)
+                if track.tracker is not None:
+                    track.tracker.init(frame, track.xywh)  # correct the tracker drift with the detected box
+
+        # 4. forget the tracks that were not seen for too long
+        self.tracks = [
+            t for t in self.tracks if self.frame_count <= t.time_last_seen + self.max_frames_without_object
+        ]
+        self.followed_ids &= {t.track_id for t in self.tracks}
+        return self.boxes()
+
+    def _associate(self, detections):
+        """
+        :return: dictionary {detection_index: track} for the detections that matched some track
+        """
+        if not self.tracks or len(detections) == 0:
+            return {}
+        cost = association_cost(
+            np.array([t.box for t in self.tracks]), np.array(detections, dtype=float), self.center_distance_weight)
+        matched = {}
+        for track_index, detection_index in solve_assignment(cost):
+            if cost[track_index, detection_index] <= self.max_association_cost:
+                matched[detection_index] = self.tracks[track_index]
+        return matched
+
+
+def association_cost(track_boxes, detection_boxes, center_distance_weight=1.0):
+    """
+    Cost of matching every track to every detection: 1 - IoU + weight * (center distance / track box diagonal)
+    :param track_boxes: Nx4 array of (x, y, w, h)
+    :param detection_boxes: Mx4 array of (x, y, w, h)
+    :return: NxM array of costs
+    """
+    tracks, detections = track_boxes[:, None, :], detection_boxes[None, :, :]
+    overlap_x = np.clip(
+        np.minimum(tracks[..., 0] + tracks[..., 2], detections[..., 0] + detections[..., 2])
+        - np.maximum(tracks[..., 0], detections[..., 0]), 0, None)
+    overlap_y = np.clip(
+        np.minimum(tracks[..., 1] + tracks[..., 3], detections[..., 1] + detections[..., 3])
+        - np.maximum(tracks[..., 1], detections[..., 1]), 0, None)
+    intersection = overlap_x * overlap_y
+    union = tracks[..., 2] * tracks[..., 3] + detections[..., 2] * detections[..., 3] - intersection
+    iou = intersection / np.maximum(union, 1e-9)
+
+    centers_shift = (tracks[..., :2] + tracks[..., 2:] / 2) - (detections[..., :2] + detections[..., 2:] / 2)
+    diagonal = np.maximum(np.hypot(tracks[..., 2], tracks[..., 3]), 1e-9)
+    distance = np.hypot(centers_shift[..., 0], centers_shift[..., 1]) / diagonal
+    return 1.0 - iou + center_distance_weight * distance
+
+
+def solve_assignment(cost):
+    """
+    Optimal assignment (smallest total cost) of rows to columns, using the Hungarian algorithm
+    :param cost: NxM array
+    :return: list of (row, column) pairs, min(N, M) of them
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n_rows, n_cols = cost.shape
+
+    # potentials and matching, with a fake column 0 (as in the classic shortest augmenting path formulation)
+    u, v = np.zeros(n_rows + 1), np.zeros(n_cols + 1)
+    row_of_col = np.zeros(n_cols + 1, dtype=int)  # row_of_col[j] = 1-based row assigned to column j, 0 = none
+    previous_col = np.zeros(n_cols + 1, dtype=int)
+    for row in range(1, n_rows + 1):
+        row_of_col[0] = row
+        col = 0
+        min_slack = np.full(n_cols + 1, np.inf)
+        used = np.zeros(n_cols + 1, dtype=bool)
+        while row_of_col[col] != 0:
+            used[col] = True
+            current_row = row_of_col[col]
+            free = ~used
+            free[0] = False
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            improved = free[1:] & (slack < min_slack[1:])
+            min_slack[1:][improved] = slack[improved]
+            previous_col[1:][improved] = col
+            candidates = np.where(free, min_slack, np.inf)
+            next_col = int(np.argmin(candidates))
+            delta = candidates[next_col]
+            used_cols = np.nonzero(used)[0]
+            u[row_of_col[used_cols]] += delta
+            v[used_cols] -= delta
+            min_slack[free] -= delta
+            col = next_col
+        # walk back along the augmenting path
+        while col != 0:
+            col_before = previous_col[col]
+            row_of_col[col] = row_of_col[col_before]
+            col = col_before
+
+    pairs = [(row_of_col[col] - 1, col - 1) for col in range(1, n_cols + 1) if row_of_col[col] != 0]
+    if transposed:
+        pairs = [(col, row) for (row, col) in pairs]
+    return sorted(pairs)
+
 
 def create_vit_tracker(model_file="resources/object_tracking_vittrack_2023sep.onnx") -> cv2.TrackerVit:
     """
@@ -119,29 +753,88 @@ def update_tracker(tracker, frame, lowest_allowed_score=0.6):
     return None, None, None, None, None
 
 
-def _detect_biggest_apriltag(detector, frame, only_these_ids=None):
-    # make a grayscale image, so apriltags can be found on it
-    grayscale = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    april_tags = detector.detect(grayscale)
+# an AprilTag found by MultiResolutionAprilTagDetector (same fields as in pupil_apriltags, in full resolution pixels)
+ScaledAprilTag = collections.namedtuple(
+    "ScaledAprilTag", ["tag_family", "tag_id", "hamming", "decision_margin", "center", "corners"])
 
-    if len(april_tags) > 0:
-        biggest_tag_size = 0
-        boxes = []
 
-        # put all boxes into the list
-        for tag in april_tags:
-            contour = tag.corners.astype(int)
-            x, y, w, h = cv2.boundingRect(contour)
-            id_location = int(x + w - 10), int(y - 10)
-            cv2.polylines(frame, [contour], isClosed=True, color=BLUE, thickness=10)
-            cv2.putText(frame, str(tag.tag_id), id_location, cv2.FONT_HERSHEY_SIMPLEX, 1, BLUE, thickness=2)
-            if only_these_ids is not None and tag.tag_id not in only_these_ids:
-                continue  # skip, because we are only supposed to look at tags with `only_these_ids`
-            size = max([w, h])
-            biggest_tag_size = max([biggest_tag_size, size])
-            boxes.append((x, y, w, h))
+class MultiResolutionAprilTagDetector(object):
+    """
+    Finds AprilTags on a downscaled image (much faster), and then refines their corners on the full resolution image.
+    The scale is picked from the size of the last found tag (so that it stays at least `min_tag_pixels` big),
+    and if nothing is found at that scale, the next bigger scale can be tried.
+
+    Can be used instead of pupil_apriltags.Detector, for example:
+        tag_detector = MultiResolutionAprilTagDetector(apriltags.Detector(families="tag36h11", quad_sigma=0.2))
+        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame)
+    """
+    def __init__(self, detector, scales=(0.25, 0.5, 1.0), min_tag_pixels=40, escalate=True):
+        """
+        :param detector: pupil_apriltags.Detector
+        :param scales: which image scales can be used (1.0 = full resolution)
+        :param min_tag_pixels: how big (in pixels) the tag must look on the downscaled image to be found reliably
+        :param escalate: if nothing is found, try again at bigger scales (up to full resolution)
+        """
+        assert len(scales) > 0 and all(0 < scale <= 1.0 for scale in scales), f"bad scales: {scales}"
+        self.detector = detector
+        self.scales = sorted(scales)
+        self.min_tag_pixels = min_tag_pixels
+        self.escalate = escalate
+        self.last_tag_size = None  # how big was the biggest tag last time (in full resolution pixels)
+        self.last_scale = None
+
+    def choose_scale(self):
+        if self.last_tag_size is None:
+            # never seen a tag: if allowed to escalate, start cheap, otherwise look at full resolution
+            return self.scales[0] if self.escalate else self.scales[-1]
+        for scale in self.scales:
+            if self.last_tag_size * scale >= self.min_tag_pixels:
+                return scale
+        return self.scales[-1]
+
+    def detect(self, grayscale, context=None):
+        """
+        :param grayscale: full resolution grayscale image
+        :param context: FrameContext of that image, if any (to reuse the downscaled images it already has)
+        :return: list of ScaledAprilTag, with corners in full resolution coordinates
+        """
+        scale = self.choose_scale()
+        candidates = [s for s in self.scales if s >= scale] if self.escalate else [scale]
+
+        for scale in candidates:
+            self.last_scale = scale
+            image = grayscale
+            if scale < 1.0 and context is not None:
+                image = context.scaled(scale, gray=True)
+            elif scale < 1.0:
+                image = cv2.resize(grayscale, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            tags = self.detector.detect(image)
+            if len(tags) > 0:
+                result = [self._refined(grayscale, tag, scale) for tag in tags]
+                self.last_tag_size = max(np.ptp(tag.corners, axis=0).max() for tag in result)
+                return result
+
+        self.last_tag_size = None
+        return []
+
+    def _refined(self, grayscale, tag, scale):
+        corners = np.asarray(tag.corners, dtype=np.float32) / scale
+        if scale < 1.0:
+            # one downscaled pixel is 1/scale full resolution pixels, so search for the true corner that far around
+            window = int(np.ceil(1.0 / scale)) + 1
+            criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 0.05)
+            corners = cv2.cornerSubPix(grayscale, corners.reshape(-1, 1, 2), (window, window), (-1, -1), criteria)
+            corners = corners.reshape(-1, 2)
+        center = np.asarray(tag.center, dtype=np.float32) / scale
+        return ScaledAprilTag(tag.tag_family, tag.tag_id, tag.hamming, tag.decision_margin, center, corners)
+
+
+def _detect_biggest_apriltag(detector, frame, only_these_ids=None, overlay=None):
+    boxes = _detect_apriltags(detector, frame, only_these_ids, overlay)
 
-        # return the biggest box
+    # return the biggest box
+    if len(boxes) > 0:
+        biggest_tag_size = max(max([w, h]) for (x, y, w, h) in boxes)
         for (x, y, w, h) in boxes:
             size = max([w, h])
             if size == biggest_tag_size:
@@ -151,41 +844,150 @@ def _detect_biggest_apriltag(detector, frame, only_these_ids=None):
     return None, None, None, None
 
 
-def detect_or_track(frame, tracker: typing.Union[TrackerState, None], detector):
+def _detect_apriltags(detector, frame, only_these_ids=None, overlay=None):
+    """
+    :return: list of (x, y, w, h) boxes of all AprilTags found (only the ones with `only_these_ids`, if given)
+    """
+    # make a grayscale image, so apriltags can be found on it
+    context = _as_context(frame)
+    if isinstance(detector, MultiResolutionAprilTagDetector):
+        april_tags = detector.detect(context.gray, context)
+    else:
+        april_tags = detector.detect(context.gray)
+
+    # put all boxes into the list
+    boxes = []
+    for tag in april_tags:
+        contour = tag.corners.astype(int)
+        x, y, w, h = cv2.boundingRect(contour)
+        if overlay is not None:
+            id_location = int(x + w - 10), int(y - 10)
+            overlay.polylines([contour], is_closed=True, color=BLUE, thickness=10)
+            overlay.text(str(tag.tag_id), id_location, cv2.FONT_HERSHEY_SIMPLEX, 1, BLUE, thickness=2)
+        if only_these_ids is not None and tag.tag_id not in only_these_ids:
+            continue  # skip, because we are only supposed to look at tags with `only_these_ids`
+        boxes.append((x, y, w, h))
+
+    return boxes
+
+
+def _detect_near(frame, near_xywh, overlay, detect, expand=3.0, min_side=96):
+    """
+    Run the detector on a window around the place where the object was seen last time (a lot less pixels to scan),
+    and only if nothing was found there, run it on the full frame
+    :param frame: the video frame (or its FrameContext)
+    :param near_xywh: (x, y, w, h) where the object was seen last time, or None if not known
+    :param overlay: Overlay for the full frame, or None if nothing needs to be drawn
+    :param detect: function(image, (offset_x, offset_y), overlay) returning (x, y, w, h) on that image, where image
+     is either the window (which starts at offset_x, offset_y) or the full frame (offset 0, 0)
+    :param expand: the window is this many times wider and taller than the last seen box
+    :param min_side: but the window is never smaller than this (in pixels)
+    :return: (x, y, w, h) in full frame coordinates, or (None, None, None, None)
+    """
+    if near_xywh is not None and near_xywh[0] is not None:
+        x0, y0, x1, y1 = _search_window(frame, near_xywh, expand, min_side)
+        if (x1 - x0) * (y1 - y0) < frame.shape[0] * frame.shape[1]:
+            # (drawing into a separate overlay, so that what was drawn here is not drawn twice if we fall back)
+            window_overlay = Overlay().shifted(overlay.offset[0] + x0, overlay.offset[1] + y0) if overlay is not None else None
+            x, y, w, h = detect(_as_context(frame).crop(x0, y0, x1, y1), (x0, y0), window_overlay)
+            if x is not None:
+                if overlay is not None:
+                    overlay.commands.extend(window_overlay.commands)
+                return x + x0, y + y0, w, h
+    return detect(frame, (0, 0), overlay)
+
+
+def _search_window(frame, xywh, expand, min_side):
+    # a window `expand` times bigger than the box, with the same center, but not going outside of the frame
+    x, y, w, h = xywh
+    frame_width, frame_height = frame.shape[1], frame.shape[0]
+    half_width = max(w * expand, min_side) / 2
+    half_height = max(h * expand, min_side) / 2
+    center_x, center_y = x + w / 2, y + h / 2
+    x0, x1 = int(max(0, center_x - half_width)), int(min(frame_width, center_x + half_width))
+    y0, y1 = int(max(0, center_y - half_height)), int(min(frame_height, center_y + half_height))
+    return x0, y0, x1, y1
+
+
+def _last_known_xywh(tracker, previous_xywh=None):
+    if tracker is not None and tracker.last_box is not None:
+        return tracker.last_box
+    if previous_xywh is not None and previous_xywh[0] is not None:
+        return previous_xywh
+    return None
+
+
+def _shifted(xywh, offset):
+    # move a box into coordinates of a window that starts at `offset`
+    if xywh is None or xywh[0] is None:
+        return xywh
+    x, y, w, h = xywh
+    return x - offset[0], y - offset[1], w, h
+
+
+def detect_or_track(frame, tracker: typing.Union[TrackerState, None], detector, overlay=None, capture_time=None):
+    """
+    Use the tracker to locate the object, and only run the (slow) detector if the tracker needs it
+    :param frame: the video frame (or its FrameContext)
+    :param tracker: TrackerState, or None if not tracking
+    :param detector: function(frame_context, overlay) returning (x, y, w, h) or (None, None, None, None)
+    :param overlay: Overlay to add the drawings to, or None if nothing needs to be drawn
+    :param capture_time: when the frame was captured (for the tracker's motion_predictor), default = now
+    :return: (x, y, w, h) or (None, None, None, None)
+    """
     # 1. try using tracker
     skip_detection = False
     tx, ty, tw, th = None, None, None, None
     if frame is None:
         return tx, ty, tw, th
+    context = _as_context(frame)
+    frame = context.frame
     if tracker is not None:
-        skip_detection, (tx, ty, tw, th) = tracker.update(frame)
+        skip_detection, (tx, ty, tw, th) = tracker.update(frame, capture_time)
+
+    # 1b. in async mode (while still tracking) use the tracker answer on this frame, and let the detector run
+    # in the background: merge its result into the tracker once it is done, and start it again if needed
+    if tracker is not None and tracker.async_detector is not None and tracker.tracking:
+        finished = tracker.async_detector.poll()
+        if finished is not None:
+            detected_frame_count, (dx, dy, dw, dh) = finished
+            if dx is not None and tracker.reconcile(frame, detected_frame_count, (dx, dy, dw, dh)):
+                _, (tx, ty, tw, th) = tracker.update(frame, capture_time)
+        if not skip_detection:
+            tracker.async_detector.submit(tracker.frame_count, context, detector)
+        skip_detection = True
+    elif tracker is not None and tracker.async_detector is not None and tracker.async_detector.busy:
+        # lost the object, but the background detection is still running: detectors (like AprilTag or HAAR)
+        # must not be used from two threads at once, so wait for it to finish instead of detecting here too
+        skip_detection = True
 
     # 2. if this didn't work perfectly, re-detect
     if not skip_detection:
-        dx, dy, dw, dh = detector()
+        dx, dy, dw, dh = detector(context, overlay)
         if dx is not None:
             tx, ty, tw, th = dx, dy, dw, dh
             if tracker is not None:
-                tracker.init(frame, (dx, dy, dw, dh))
-                _, (tx, ty, tw, th) = tracker.update(frame)
+                tracker.init(frame, (dx, dy, dw, dh), new_object=False)
+                _, (tx, ty, tw, th) = tracker.update(frame, capture_time)
 
     # 3. if we must explain ourselves, do it now
-    if tracker.display_confidence and tracker.tracker_comments:
+    if overlay is not None and tracker is not None and tracker.display_confidence and tracker.tracker_comments and tx is not None:
         text = tracker.tracker_comments
         location = (int(tx) + 10, int(ty + th) + 15)
-        cv2.putText(frame, text, location, cv2.FONT_HERSHEY_SIMPLEX, 0.5, PURPLE, 2)
+        overlay.text(text, location, cv2.FONT_HERSHEY_SIMPLEX, 0.5, PURPLE, 2)
 
     return tx, ty, tw, th
 
 
-def _detect_biggest_face(face_detector, frame, draw_boxes=False, previous_xywh=None):
+def _detect_biggest_face(face_detector, frame, overlay=None, previous_xywh=None):
     """
     Use HAAR cascade detector to detect faces (picks the widest one, if many found)
-    :param frame: a video frame, color or grayscale
+    :param frame: a video frame, color or grayscale (or its FrameContext)
     :param face_detector: cascade face detector
+    :param overlay: if given, add boxes of all faces to this Overlay
     :return: (x, y, w, h) bounding box or (None, None, None, None)
     """
-    gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    gray_frame = _as_context(frame).gray
     faces = face_detector.detectMultiScale(gray_frame, scaleFactor=1.1, minNeighbors=9)
     if previous_xywh is not None and previous_xywh[0] is None: previous_xywh = None
 
@@ -204,13 +1006,13 @@ def _detect_biggest_face(face_detector, frame, draw_boxes=False, previous_xywh=N
                 nearest_distance = distance
                 nearest_face = x, y, w, h
 
-    if draw_boxes:
+    if overlay is not None:
         for (x, y, w, h) in faces:
             # is this the biggest face seen? green box for it, otherwise red for smaller
             if w == biggest_w:
-                cv2.rectangle(frame, (x, y), (x + w, y + h), GREEN, thickness=2)
+                overlay.rectangle((x, y), (x + w, y + h), GREEN, thickness=2)
             else:
-                cv2.rectangle(frame, (x, y), (x + w, y + h), RED, thickness=2)
+                overlay.rectangle((x, y), (x + w, y + h), RED, thickness=2)
 
     if nearest_face is not None:
         return nearest_face
@@ -220,49 +1022,208 @@ def _detect_biggest_face(face_detector, frame, draw_boxes=False, previous_xywh=N
     return None, None, None, None
 
 
-def _detect_yolo_object(yolo_model, frame, valid_classes=("person", "car"), lowest_conf=0.3):
+def _detect_yolo_object(yolo_model, frame, valid_classes=("person", "car"), lowest_conf=0.3, overlay=None):
     """
     Detect an object using a YOLO model (if multiple objects detected, picks the widest)
     :return: either (x, y, w, h) for the bounding box, or (None, None, None, None)
     """
-    boxes = []
-    biggest_width = 0
-    results = yolo_model.predict(frame)
+    xyxy = np.zeros((0, 4))
+    for result in yolo_model.predict(_as_context(frame).frame):
+        result_xyxy, conf, cls = _yolo_result_to_arrays(result)
+        keep = _yolo_keep_mask(result, conf, cls, valid_classes, lowest_conf)
+        xyxy = np.concatenate([xyxy, result_xyxy[keep]])
+        if overlay is not None:
+            _draw_yolo_boxes(overlay, result, result_xyxy, conf, cls)
 
-    for result in results:
-        for bbox in result.boxes:
-            class_name = result.names[int(bbox.cls[0])]
-            conf = float(bbox.conf)
-            x, y, x2, y2 = bbox.xyxy[0]
-            if class_name in valid_classes and conf > lowest_conf:
-                width, height = int(x2 - x), int(y2 - y)
-                boxes.append([int(x), int(y), width, height])
-                if width > biggest_width:
-                    biggest_width = width
-            text = "{}@{:.2}".format(class_name, conf)
-            location = (int(x2) + 10, int(y) + 15)
-            cv2.rectangle(frame, (int(x), int(y)), (int(x2), int(y2)), RED, 2)
-            cv2.putText(frame, text, location, cv2.FONT_HERSHEY_SIMPLEX, 0.5, WHITE, 1)
-
-    for (x, y, w, h) in boxes:
-        if w == biggest_width:
-            cv2.rectangle(frame, (x, y), (x + w, y + h), GREEN, 4)
-            return x, y, w, h
+    if len(xyxy) > 0:
+        x, y, x2, y2 = xyxy[np.argmax(xyxy[:, 2] - xyxy[:, 0])].astype(int).tolist()
+        if overlay is not None:
+            overlay.rectangle((x, y), (x2, y2), GREEN, 4)
+        return x, y, x2 - x, y2 - y
 
     # otherwise, nothing found
     return None, None, None, None
 
 
-def print_relative_xw(frame, x, y, w, h, color=BLUE):
+def _detect_yolo_objects(yolo_model, frame, valid_classes=("person", "car"), lowest_conf=0.3, overlay=None):
+    """
+    Detect objects using a YOLO model
+    :return: list of (x, y, w, h) boxes of all objects of `valid_classes` with confidence above `lowest_conf`
+    """
+    boxes = []
+    results = yolo_model.predict(_as_context(frame).frame)
+
+    for result in results:
+        boxes.extend(_yolo_result_to_boxes(result, valid_classes, lowest_conf, overlay))
+
+    return boxes
+
+
+def _yolo_result_to_boxes(result, valid_classes, lowest_conf, overlay=None):
+    # one YOLO result (for one frame) => list of (x, y, w, h) boxes, and maybe also add all boxes to the overlay
+    xyxy, conf, cls = _yolo_result_to_arrays(result)
+    if overlay is not None:
+        _draw_yolo_boxes(overlay, result, xyxy, conf, cls)
+    keep = _yolo_keep_mask(result, conf, cls, valid_classes, lowest_conf)
+    xywh = xyxy[keep].astype(int)
+    xywh[:, 2:] -= xywh[:, :2]
+    return [tuple(box) for box in xywh.tolist()]
+
+
+def _yolo_result_to_arrays(result):
+    """
+    Convert all boxes of one YOLO result to numpy at once (instead of touching each box tensor separately)
+    :return: xyxy (Nx4 float array), conf (N float array), cls (N int array)
+    """
+    boxes = result.boxes
+    xyxy = _to_numpy(boxes.xyxy).reshape(-1, 4).astype(float)
+    conf = _to_numpy(boxes.conf).reshape(-1).astype(float)
+    cls = _to_numpy(boxes.cls).reshape(-1).astype(int)
+    return xyxy, conf, cls
+
+
+def _to_numpy(tensor):
+    if hasattr(tensor, "cpu"):
+        tensor = tensor.cpu()  # torch tensor, maybe on GPU
+    return np.asarray(tensor)
+
+
+def _yolo_keep_mask(result, conf, cls, valid_classes, lowest_conf):
+    names = getattr(result, "names", None) or _COCO_NAMES
+    valid_ids = _valid_class_id_mask(names, frozenset(valid_classes))
+    known = cls < len(valid_ids)
+    return known & valid_ids[np.where(known, cls, 0)] & (conf > lowest_conf)
+
+
+_COCO_NAMES = dict(enumerate(COCO_CLASSNAMES))
+_class_id_masks = {}  # (id(names), len(names), valid_classes) => (names, mask)
+
+
+def _valid_class_id_mask(names, valid_classes):
+    # names is {class_id: class_name} of the model => boolean array, True for class ids that are in valid_classes
+    # (cached by the identity of the names dictionary: the model keeps the same one, so it is not sorted every time)
+    key = (id(names), len(names), valid_classes)
+    cached = _class_id_masks.get(key)
+    if cached is not None and cached[0] is names:
+        return cached[1]
+    mask = np.zeros(max(names) + 1, dtype=bool)
+    for class_id, class_name in names.items():
+        mask[class_id] = class_name in valid_classes
+    if len(_class_id_masks) >= 16:
+        _class_id_masks.clear()
+    _class_id_masks[key] = (names, mask)  # (keeping names alive, so that its id cannot be reused)
+    return mask
+
+
+def _draw_yolo_boxes(overlay, result, xyxy, conf, cls):
+    names = getattr(result, "names", None) or _COCO_NAMES
+    for (x, y, x2, y2), box_conf, class_id in zip(xyxy.astype(int).tolist(), conf.tolist(), cls.tolist()):
+        text = "{}@{:.2}".format(names.get(class_id, class_id), box_conf)
+        location = (x2 + 10, y + 15)
+        overlay.rectangle((x, y), (x2, y2), RED, 2)
+        overlay.text(text, location, cv2.FONT_HERSHEY_SIMPLEX, 0.5, WHITE, 1)
+
+
+def detect_yolo_objects_batch(yolo_model, frames, valid_classes=("person", "car"), lowest_conf=0.4, overlays=None):
+    """
+    Detect objects on many frames (for example, from different cameras) with one YOLO `predict` call
+    :param frames: list of video frames (can be of different sizes)
+    :param overlays: list with one Overlay per frame (to add the boxes to), or None if nothing needs to be drawn
+    :return: list with one list of (x, y, w, h) boxes per frame
+    """
+    if len(frames) == 0:
+        return []
+    results = yolo_model.predict(list(frames))
+    overlays = overlays if overlays is not None else [None] * len(frames)
+    return [
+        _yolo_result_to_boxes(result, valid_classes, lowest_conf, overlay)
+        for result, overlay in zip(results, overlays)
+    ]
+
+
+class YoloBatchScheduler(object):
+    """
+    Collects frames from many threads (for example, one thread per camera) into batches for one YOLO model:
+    a batch is sent to the model when it has `batch_size` frames, or when the oldest frame waited `max_delay` seconds.
+
+    It has the same `predict(frame)` as a YOLO model, so it can be used instead of one, for example:
+        scheduler = detection.YoloBatchScheduler(YOLO("resources/yolov8s.pt"), batch_size=4)
+        x, y, w, h = detection.detect_yolo_object(scheduler, frame, tracker=tracker)  # in each camera thread
+    """
+    def __init__(self, yolo_model, batch_size=4, max_delay=0.02):
+        """
+        :param yolo_model: the model (for example, ultralytics.YOLO)
+        :param batch_size: the biggest number of frames to send to the model at once
+        :param max_delay: how long (in seconds) a frame can wait for the batch to fill up
+        """
+        assert batch_size >= 1, f"batch_size must be at least 1, got {batch_size}"
+        self.yolo_model = yolo_model
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending = collections.deque()  # (arrival time, frame, future)
+        self.condition = threading.Condition()
+        self.batch_count = 0
+        self.frame_count = 0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, frame):
+        """
+        :return: concurrent.futures.Future, which will have the YOLO result for this frame
+        """
+        future = concurrent.futures.Future()
+        with self.condition:
+            self.pending.append((time.time(), frame, future))
+            self.condition.notify()
+        return future
+
+    def predict(self, frame, timeout=None):
+        """
+        Same as YOLO `predict` for one frame: waits for the batch with this frame to be processed
+        :return: list with one result (for this frame)
+        """
+        return [self.submit(frame).result(timeout)]
+
+    def _next_batch(self):
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.pending) > 0)
+            deadline = self.pending[0][0] + self.max_delay
+            while len(self.pending) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            frames = [frame for (_, frame, _) in batch]
+            try:
+                results = self.yolo_model.predict(frames)
+            except Exception as e:
+                for (_, _, future) in batch:
+                    future.set_exception(e)
+                continue
+            self.batch_count += 1
+            self.frame_count += len(frames)
+            for (_, _, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+def print_relative_xw(frame, x, y, w, h, color=BLUE, overlay=None):
     if x is not None and frame is not None:
         frame_width, frame_height = frame.shape[1], frame.shape[0]
         relative_x = (x + w // 2) / frame_width - 0.5  # can be between -0.5 and +0.5
         relative_width = w / frame_width
         text = f"x:{relative_x:.2}, w:{relative_width:.2}"
-        cv2.putText(frame, text, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 0.9, color)
+        if overlay is not None:
+            overlay.text(text, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 0.9, color)
+        else:
+            cv2.putText(frame, text, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 0.9, color)
 
 
-def to_normalized_x_y_size(frame, x, y, w, h, draw_box=False):
+def to_normalized_x_y_size(frame, x, y, w, h, draw_box=False, overlay=None):
     """
     Convert the x, y, width and height of a detected object into [-0.5; +0.5] space,
     so robot can use them in navigation
@@ -272,6 +1233,7 @@ def to_normalized_x_y_size(frame, x, y, w, h, draw_box=False):
     :param w: width of the detected object box (in pixels)
     :param h: height of the detected object box (in pixels)
     :param draw_box: annotate the frame with the bounding box
+    :param overlay: if given, add the bounding box to this Overlay instead of drawing it on the frame right away
     :return: (X, Y, Size), with X and Y remapped to [-50; +50] space (X, Y = center of the box), Size between 0 and 100
     """
     if x is None:
@@ -284,8 +1246,12 @@ def to_normalized_x_y_size(frame, x, y, w, h, draw_box=False):
 
     if draw_box:
         text = "nx:{:.0f}, ny:{:.0f}, size: {:.0f}".format(norm_x, norm_y, norm_size)
-        cv2.putText(frame, text, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 1.0, WHITE, 2)
-        cv2.rectangle(frame, (int(x), int(y)), (int(x + w), int(y + h)), GREEN, thickness=2)
+        if overlay is not None:
+            overlay.text(text, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 1.0, WHITE, 2)
+            overlay.rectangle((x, y), (x + w, y + h), GREEN, thickness=2)
+        else:
+            cv2.putText(frame, text, (x, y - 10), cv2.FONT_HERSHEY_PLAIN, 1.0, WHITE, 2)
+            cv2.rectangle(frame, (int(x), int(y)), (int(x + w), int(y + h)), GREEN, thickness=2)
 
     return norm_x, norm_y, norm_size
 
@@ -3,13 +3,16 @@ from time import time
 import pupil_apriltags as apriltags
 #from ultralytics import YOLO
 import detection
+import pipeline
 
 # what kind of objects can we detect?
 face_detector = cv2.CascadeClassifier('resources/haarcascade_frontalface_default.xml')
 tag_detector = apriltags.Detector(families="tag36h11", quad_sigma=0.2)
+#tag_detector = detection.MultiResolutionAprilTagDetector(tag_detector)  # faster: finds tags on a smaller image first
 #model = YOLO("resources/yolov8s.pt")  # model to detect common objects like "person", "car", "cellphone" (see "COCO")
 
 tracker = detection.TrackerState(detection.create_vit_tracker(), display_confidence=True)
+#tracker = detection.TrackerState(detection.create_vit_tracker(), motion_predictor=detection.BoxMotionPredictor())  # rides over short tracker dropouts
 
 
 camera = cv2.VideoCapture(0)
@@ -22,19 +25,44 @@ time_last_seen = 0
 # location of the target
 x, y, w, h = None, None, None, None
 
+# in pipeline mode, camera capture and detection run on their own threads (see pipeline.py),
+# and this main loop only shows the results (so a slow detector does not make the video lag behind)
+PIPELINE_MODE = False
+
+if PIPELINE_MODE:
+    detection_pipeline = pipeline.DetectionPipeline(
+        read_frame=lambda: camera.read()[1],
+        detect=lambda f: detection.detect_biggest_apriltag(tag_detector, f, tracker=tracker),
+    ).start()
+
+    while True:
+        result = detection_pipeline.get_result(timeout=1.0)
+        if result is None:
+            continue  # no new results yet
+
+        overlay = detection.Overlay()  # (drawn on a copy, so the published result.frame itself stays unchanged)
+        x, y, w, h = result.bbox
+        nx, ny, size = detection.to_normalized_x_y_size(result.frame, x, y, w, h, draw_box=True, overlay=overlay)
+        latency = f"frame {result.frame_id}, latency: {int(1000 * (time() - result.capture_ts))}ms"
+        overlay.text(latency, (5, 25), cv2.FONT_HERSHEY_PLAIN, 1.5, detection.GREEN, 2)
+        cv2.imshow("camera", overlay.render(result.frame))
+        cv2.waitKey(1)
+
 while True:
     success, frame = camera.read()
     if not success:
         continue
 
+    overlay = detection.Overlay()  # what to draw on this frame (drawn only when showing it)
+
     if detecting:
-        #x, y, w, h = detection.detect_biggest_face(face_detector, frame, tracker=tracker, previous_xywh=(x, y, w, h))
-        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, tracker=tracker)
+        #x, y, w, h = detection.detect_biggest_face(face_detector, frame, tracker=tracker, previous_xywh=(x, y, w, h), overlay=overlay)
+        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, tracker=tracker, overlay=overlay)
         #x, y, w, h = detection.detect_yolo_object(model, frame, valid_classnames={"cell phone"}, lowest_conf=0.3)
-        #x, y, w, h = detection.detect_yolo_object(model, frame, tracker=tracker, valid_classes={"cell phone"}, lowest_conf=0.3)
+        #x, y, w, h = detection.detect_yolo_object(model, frame, tracker=tracker, valid_classes={"cell phone"}, lowest_conf=0.3, overlay=overlay)
 
-    nx, ny, size = detection.to_normalized_x_y_size(frame, x, y, w, h, draw_box=True)
-    cv2.imshow("camera", frame)
+    nx, ny, size = detection.to_normalized_x_y_size(frame, x, y, w, h, draw_box=True, overlay=overlay)
+    cv2.imshow("camera", overlay.render(frame))
 
     key = cv2.waitKey(1) & 0xFF
     if key == ord('d'):
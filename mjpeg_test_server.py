@@ -0,0 +1,97 @@
+"""
+Stands in for `libcamera-vid --codec mjpeg --listen -o tcp://0.0.0.0:8000` on the car:
+streams JPEG frames back to back over TCP, so videocar can be tested without a Raspberry Pi.
+
+Examples:
+    python mjpeg_test_server.py                          # synthetic frames (moving box and frame counter)
+    python mjpeg_test_server.py --source recording.mp4   # frames from a video file (looped)
+    python mjpeg_test_server.py --source frames/         # all .jpg files in a folder (looped)
+
+and then, in another terminal:
+    videocar.start(robot_hostname="localhost", camera_backend="mjpeg", video_scale=2)
+"""
+import argparse
+import os
+import socketserver
+from time import time, sleep
+
+import cv2
+import numpy as np
+
+
+def synthetic_jpegs(width, height, quality):
+    index = 0
+    while True:
+        frame = np.full((height, width, 3), 90, dtype=np.uint8)
+        x = int((width - 80) * (0.5 + 0.45 * np.sin(index / 20)))
+        cv2.rectangle(frame, (x, height // 2 - 40), (x + 80, height // 2 + 40), (0, 200, 255), thickness=-1)
+        cv2.putText(frame, f"frame {index}", (10, 30), cv2.FONT_HERSHEY_PLAIN, 2, (255, 255, 255), 2)
+        yield cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        index += 1
+
+
+def video_jpegs(path, quality):
+    while True:
+        video = cv2.VideoCapture(path)
+        assert video.isOpened(), f"cannot read from {path}"
+        while True:
+            success, frame = video.read()
+            if not success:
+                break
+            yield cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])[1].tobytes()
+        video.release()
+
+
+def folder_jpegs(path):
+    files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith((".jpg", ".jpeg")))
+    assert len(files) > 0, f"no .jpg files in {path}"
+    jpegs = []
+    for file in files:
+        with open(file, "rb") as f:
+            jpegs.append(f.read())
+    while True:
+        yield from jpegs
+
+
+def make_handler(source, fps):
+    class StreamHandler(socketserver.BaseRequestHandler):
+        def handle(self):
+            print(f"client connected: {self.client_address}")
+            jpegs = source()
+            next_frame_time = time()
+            try:
+                for jpeg in jpegs:
+                    self.request.sendall(jpeg)
+                    next_frame_time += 1.0 / fps
+                    sleep(max(0.0, next_frame_time - time()))
+            except OSError:
+                pass
+            print(f"client disconnected: {self.client_address}")
+    return StreamHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stream JPEGs over TCP, like libcamera-vid --codec mjpeg")
+    parser.add_argument("--source", help="video file or folder with .jpg files (default: synthetic frames)")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--fps", type=float, default=20.0)
+    parser.add_argument("--width", type=int, default=640, help="width of synthetic frames")
+    parser.add_argument("--height", type=int, default=480, help="height of synthetic frames")
+    parser.add_argument("--quality", type=int, default=80, help="JPEG quality")
+    args = parser.parse_args()
+
+    if args.source is None:
+        source = lambda: synthetic_jpegs(args.width, args.height, args.quality)
+    elif os.path.isdir(args.source):
+        source = lambda: folder_jpegs(args.source)
+    else:
+        source = lambda: video_jpegs(args.source, args.quality)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer(("0.0.0.0", args.port), make_handler(source, args.fps)) as server:
+        print(f"streaming MJPEG on tcp://0.0.0.0:{args.port} at {args.fps} fps")
+        server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
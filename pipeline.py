@@ -0,0 +1,149 @@
+import collections
+import threading
+import traceback
+
+from time import time, sleep
+
+
+# what the consumer of the pipeline gets for every processed frame
+PipelineResult = collections.namedtuple("PipelineResult", ["frame_id", "capture_ts", "bbox", "frame"])
+
+
+class DropOldestQueue(object):
+    """
+    A bounded queue that never blocks the producer: if it is full, the oldest item is thrown away
+    (so the consumer always gets the freshest items, and the latency does not grow when the consumer is slow)
+    """
+    def __init__(self, maxsize=1):
+        assert maxsize >= 1, f"maxsize must be at least 1, got {maxsize}"
+        self.items = collections.deque(maxlen=maxsize)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.condition:
+            if len(self.items) == self.items.maxlen:
+                self.dropped += 1  # the deque will push the oldest item out
+            self.items.append(item)
+            self.condition.notify()
+
+    def get(self, timeout=None):
+        """
+        :param timeout: how long to wait for an item (in seconds), None = wait forever
+        :return: the oldest item still in the queue, or None if timed out (or if the queue was closed)
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items or self.closed, timeout):
+                return None
+            if not self.items:
+                return None
+            return self.items.popleft()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class DetectionPipeline(object):
+    """
+    Runs camera capture and detection on two background threads, so they do not pay for each other's latency:
+     - capture thread keeps reading frames and only keeps the latest one
+     - inference thread takes the latest frame, runs `detect(frame)` on it and publishes the result
+     - consumer (your main loop) calls `get_result()` and gets PipelineResult(frame_id, capture_ts, bbox, frame)
+     - if `detect(frame)` raises, the error is printed and that frame gets an empty bbox (None, None, None, None),
+       so the consumer keeps getting results (and `last_error` / `detection_errors` tell what went wrong)
+
+    Example:
+        pipeline = pipeline.DetectionPipeline(
+            read_frame=lambda: camera.read()[1],
+            detect=lambda frame: detection.detect_biggest_apriltag(tag_detector, frame, tracker=tracker))
+        pipeline.start()
+        while True:
+            result = pipeline.get_result(timeout=1.0)
+            if result is None:
+                continue
+            x, y, w, h = result.bbox
+    """
+    def __init__(self, read_frame, detect, frame_queue_size=1, result_queue_size=2):
+        """
+        :param read_frame: function that returns the next video frame (or None, if there is no frame yet)
+        :param detect: function that takes a frame and returns the (x, y, w, h) bounding box
+        :param frame_queue_size: how many captured frames can wait for detection (older frames are dropped)
+        :param result_queue_size: how many results can wait for the consumer (older results are dropped)
+        """
+        self.read_frame = read_frame
+        self.detect = detect
+        self.frames = DropOldestQueue(frame_queue_size)
+        self.results = DropOldestQueue(result_queue_size)
+        self.frame_count = 0
+        self.detection_count = 0
+        self.detection_errors = 0
+        self.last_error = None
+        self.running = False
+        self.threads = []
+
+    def start(self):
+        assert not self.running, "DetectionPipeline.start() called twice"
+        self.running = True
+        self.threads = [
+            threading.Thread(target=self._capture_loop, daemon=True),
+            threading.Thread(target=self._inference_loop, daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self, timeout=1.0):
+        self.running = False
+        self.frames.close()
+        self.results.close()
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def get_result(self, timeout=None):
+        """
+        :param timeout: how long to wait for the next result (in seconds), None = wait forever
+        :return: PipelineResult(frame_id, capture_ts, bbox, frame) or None if nothing arrived within the timeout
+        """
+        return self.results.get(timeout)
+
+    @property
+    def dropped_frames(self):
+        return self.frames.dropped
+
+    @property
+    def dropped_results(self):
+        return self.results.dropped
+
+    def _capture_loop(self):
+        while self.running:
+            frame = self.read_frame()
+            if frame is None:
+                sleep(0.001)  # no frame yet, do not spin
+                continue
+            self.frame_count += 1
+            self.frames.put((self.frame_count, time(), frame))
+
+    def _inference_loop(self):
+        while self.running:
+            item = self.frames.get(timeout=0.25)
+            if item is None:
+                continue
+            frame_id, capture_ts, frame = item
+            try:
+                bbox = self.detect(frame)
+            except Exception as e:
+                if self.detection_errors == 0 or repr(e) != repr(self.last_error):
+                    print(f"WARNING: detection failed on frame {frame_id} (will keep going):")
+                    traceback.print_exc()
+                self.detection_errors += 1
+                self.last_error = e
+                bbox = (None, None, None, None)
+            self.detection_count += 1
+            self.results.put(PipelineResult(frame_id, capture_ts, bbox, frame))
@@ -0,0 +1,380 @@
+"""
+Pretends to be a Tello drone on your computer (no drone or Wi-Fi needed), so the copter scripts can run closed-loop:
+ - answers Tello SDK commands (command, takeoff, land, streamon, rc, forward 50, cw 90, battery?, ...)
+ - flies: integrates the rc velocities and the moves into a position, height and yaw
+ - sends the state packets (port 8890), like a real Tello
+ - streams video (port 11111) of a simple 3D scene with AprilTags, as seen from where the drone is
+
+Example:
+    python telloemu.py                 # in one terminal
+    TELLO_ADDRESS=127.0.0.1:18889 python watchdog_drone.py    # in another one (see videocopter.create_tello)
+
+    python telloemu.py --benchmark     # measure command round trip, frame latency and control loop throughput
+
+Note: the video is sent as JPEG frames (OpenCV can decode them from the same udp:// address as the H.264 of
+a real Tello), because OpenCV usually cannot encode H.264.
+
+Why port 18889 and not 8889: djitellopy binds port 8889 on all addresses of this computer for the responses,
+so the emulator cannot listen on 8889 of the same computer (it can on another computer, or in a container).
+"""
+import argparse
+import socket
+import collections
+from threading import Thread, Lock
+from time import time, sleep
+
+import cv2
+import numpy as np
+
+import carsim
+
+
+EMULATOR_COMMAND_PORT = 18889
+CLIENT_STATE_PORT = 8890  # same as djitellopy.Tello.STATE_UDP_PORT
+CLIENT_VIDEO_PORT = 11111  # same as djitellopy.Tello.VS_UDP_PORT
+VIDEO_PACKET_SIZE = 1400  # bytes of video per UDP packet
+MAX_SPEED = 100.0  # cm/s at rc velocity 100
+MAX_YAW_RATE = 100.0  # degrees per second at rc yaw velocity 100
+VELOCITY_TIME_CONSTANT = 0.3  # seconds for the drone to get ~63% of the way to the new velocity
+TAKEOFF_HEIGHT = 80  # cm
+FRAME_NUMBER_BITS = 24  # frame number is painted on the top of every frame as black and white blocks (see below)
+FRAME_NUMBER_BLOCK = 8  # pixels
+
+# one maneuver from a command like "forward 50": body velocities (cm/s), yaw rate (degrees/s), until when
+Maneuver = collections.namedtuple("Maneuver", ["forward", "right", "up", "yaw_rate", "end_time"])
+
+
+def default_scene():
+    # three AprilTags (ids 0, 1, 2) on the wall in front of the drone, at about the takeoff height
+    return carsim.SyntheticScene([
+        carsim.apriltag_billboard(0, x=3.0, y=0.0, size=0.3, bottom=0.6),
+        carsim.apriltag_billboard(1, x=3.0, y=1.5, size=0.3, bottom=0.6),
+        carsim.apriltag_billboard(2, x=3.0, y=-1.5, size=0.3, bottom=0.6),
+    ])
+
+
+class TelloEmulator:
+    """
+    Emulated Tello: listens for SDK commands on (host, command_port), and sends state and video back to whoever
+    sent the commands
+    """
+
+    def __init__(self, host="127.0.0.1", command_port=EMULATOR_COMMAND_PORT, scene=None, fps=30,
+                 width=960, height=720, fov_degrees=70.0, state_rate_hz=10.0, physics_rate_hz=100.0):
+        self.scene = scene or default_scene()
+        self.fps = fps
+        self.camera = carsim.PinholeCamera(width, height, fov_degrees)
+        self.state_period = 1.0 / state_rate_hz
+        self.physics_period = 1.0 / physics_rate_hz
+
+        self.lock = Lock()
+        self.x, self.y, self.z, self.yaw = 0.0, 0.0, 0.0, 0.0  # cm, cm, cm, degrees (clockwise, like Tello)
+        self.velocity = np.zeros(3)  # forward, right, up (cm/s, relative to the drone)
+        self.yaw_rate = 0.0
+        self.rc = (0, 0, 0, 0)  # left_right, forward_backward, up_down, yaw (as sent by "rc a b c d")
+        self.maneuver = None
+        self.flying = False
+        self.streaming = False
+        self.battery = 100.0
+        self.flight_time = 0.0
+        self.client_host = None
+
+        # counters, to see how busy the drone was kept
+        self.commands_received = 0
+        self.rc_received = 0
+        self.frames_sent = 0
+        self.frame_send_times = collections.deque(maxlen=1000)  # (frame number, time sent)
+
+        self.command_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.command_socket.bind((host, command_port))
+        self.command_socket.settimeout(0.5)
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.running = True
+        self.threads = [Thread(target=loop, daemon=True)
+                        for loop in (self._command_loop, self._physics_loop, self._state_loop, self._video_loop)]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(1.0)
+        self.command_socket.close()
+        self.send_socket.close()
+
+    @property
+    def pose(self):
+        """
+        :return: carsim.Pose of the drone (meters, and heading in radians counterclockwise)
+        """
+        with self.lock:
+            return carsim.Pose(self.x / 100, self.y / 100, -np.radians(self.yaw))
+
+    def state_string(self):
+        with self.lock:
+            forward, right, up = self.velocity
+            heading = -np.radians(self.yaw)
+            vgx = forward * np.cos(heading) + right * np.sin(heading)
+            vgy = forward * np.sin(heading) - right * np.cos(heading)
+            yaw = int((self.yaw + 180) % 360 - 180)
+            return (f"mid:-1;x:0;y:0;z:0;mpry:0,0,0;pitch:{int(-forward / 10)};roll:{int(right / 10)};yaw:{yaw};"
+                    f"vgx:{int(vgx / 10)};vgy:{int(vgy / 10)};vgz:{int(-up / 10)};templ:60;temph:62;"
+                    f"tof:{int(self.z) + 10};h:{int(self.z)};bat:{int(self.battery)};baro:{self.z / 100:.2f};"
+                    f"time:{int(self.flight_time)};agx:0.00;agy:0.00;agz:-1000.00;\r\n")
+
+    def _command_loop(self):
+        while self.running:
+            try:
+                data, address = self.command_socket.recvfrom(1024)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            self.client_host = address[0]
+            command = data.decode("utf-8", errors="replace").strip()
+            self.commands_received += 1
+            if command.startswith("rc "):
+                self.rc_received += 1
+                self._set_rc(command)
+                continue  # Tello does not answer rc commands
+            response = self._execute(command)
+            self.command_socket.sendto(response.encode("utf-8"), address)
+
+    def _set_rc(self, command):
+        try:
+            rc = tuple(int(np.clip(int(value), -100, 100)) for value in command.split()[1:5])
+        except ValueError:
+            return
+        if len(rc) == 4:
+            with self.lock:
+                self.rc = rc
+
+    def _execute(self, command):
+        name, *args = command.split()
+        value = float(args[0]) if args and _is_number(args[0]) else 0.0
+        if name in ("command", "streamon", "streamoff", "speed", "emergency", "flip", "go", "curve", "wifi", "ap"):
+            if name in ("streamon", "streamoff"):
+                self.streaming = name == "streamon"
+            if name == "emergency":
+                with self.lock:
+                    self.flying, self.z, self.maneuver = False, 0.0, None
+            return "ok"
+        if name == "takeoff":
+            with self.lock:
+                self.flying = True
+            self._fly(up=TAKEOFF_HEIGHT / 2, seconds=2.0)
+            return "ok"
+        if name == "land":
+            with self.lock:
+                height = self.z
+            self._fly(up=-max(height, 1.0) / 2, seconds=2.0)
+            with self.lock:
+                self.flying, self.z = False, 0.0
+            return "ok"
+        moves = {"forward": (1, 0, 0), "back": (-1, 0, 0), "right": (0, 1, 0), "left": (0, -1, 0),
+                 "up": (0, 0, 1), "down": (0, 0, -1)}
+        if name in moves:
+            if not self.flying:
+                return "error Not flying"
+            forward, right, up = (direction * 50.0 for direction in moves[name])  # 50 cm/s
+            self._fly(forward, right, up, seconds=value / 50.0)
+            return "ok"
+        if name in ("cw", "ccw"):
+            if not self.flying:
+                return "error Not flying"
+            self._fly(yaw_rate=90.0 if name == "cw" else -90.0, seconds=value / 90.0)
+            return "ok"
+        queries = {
+            "battery?": lambda: int(self.battery), "speed?": lambda: 50, "time?": lambda: f"{int(self.flight_time)}s",
+            "height?": lambda: f"{int(self.z / 10)}dm", "tof?": lambda: f"{int(self.z) + 10}mm",
+            "temp?": lambda: "60~62C", "attitude?": lambda: f"pitch:0;roll:0;yaw:{int(self.yaw)};",
+            "baro?": lambda: f"{self.z / 100:.2f}", "wifi?": lambda: 90, "sdk?": lambda: 20, "sn?": lambda: "EMULATOR",
+        }
+        if name in queries:
+            return str(queries[name]())
+        return f"unknown command: {command}"
+
+    def _fly(self, forward=0.0, right=0.0, up=0.0, yaw_rate=0.0, seconds=1.0):
+        # like a real Tello, only answer when the move is done
+        with self.lock:
+            self.maneuver = Maneuver(forward, right, up, yaw_rate, time() + seconds)
+        sleep(seconds)
+        with self.lock:
+            self.maneuver = None
+
+    def _physics_loop(self):
+        last_time = time()
+        while self.running:
+            sleep(self.physics_period)
+            now = time()
+            dt, last_time = now - last_time, now
+            with self.lock:
+                if self.maneuver is not None:
+                    target = np.array([self.maneuver.forward, self.maneuver.right, self.maneuver.up])
+                    target_yaw_rate = self.maneuver.yaw_rate
+                    response = 1.0  # moves are flown exactly
+                elif self.flying:
+                    left_right, forward_backward, up_down, yaw = self.rc
+                    target = np.array([forward_backward, left_right, up_down]) * MAX_SPEED / 100
+                    target_yaw_rate = yaw * MAX_YAW_RATE / 100
+                    response = 1.0 - np.exp(-dt / VELOCITY_TIME_CONSTANT)
+                else:
+                    target, target_yaw_rate, response = np.zeros(3), 0.0, 1.0
+                self.velocity += response * (target - self.velocity)
+                self.yaw_rate += response * (target_yaw_rate - self.yaw_rate)
+
+                forward, right, up = self.velocity
+                heading = -np.radians(self.yaw)
+                self.x += (forward * np.cos(heading) + right * np.sin(heading)) * dt
+                self.y += (forward * np.sin(heading) - right * np.cos(heading)) * dt
+                self.z = max(0.0, self.z + up * dt)
+                self.yaw += self.yaw_rate * dt
+                if self.flying:
+                    self.flight_time += dt
+                self.battery = max(0.0, self.battery - dt * (0.1 if self.flying else 0.01))
+
+    def _state_loop(self):
+        while self.running:
+            sleep(self.state_period)
+            if self.client_host is not None:
+                self.send_socket.sendto(self.state_string().encode("ascii"), (self.client_host, CLIENT_STATE_PORT))
+
+    def _video_loop(self):
+        next_frame_time = time()
+        frame_number = 0
+        while self.running:
+            next_frame_time += 1.0 / self.fps
+            sleep(max(0.0, next_frame_time - time()))
+            if not self.streaming or self.client_host is None:
+                continue
+            with self.lock:
+                self.camera.mount_height = max(self.z, 5.0) / 100  # camera height = drone height
+            frame = self.scene.render(self.pose, self.camera)
+            frame_number += 1
+            stamp_frame_number(frame, frame_number)
+            jpg = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 80])[1].tobytes()
+            address = (self.client_host, CLIENT_VIDEO_PORT)
+            for start in range(0, len(jpg), VIDEO_PACKET_SIZE):
+                self.send_socket.sendto(jpg[start:start + VIDEO_PACKET_SIZE], address)
+            self.frames_sent += 1
+            self.frame_send_times.append((frame_number, time()))
+
+
+def stamp_frame_number(frame, number):
+    # paint the frame number in the top left corner as black/white blocks (to measure the video latency later)
+    for bit in range(FRAME_NUMBER_BITS):
+        x = bit * FRAME_NUMBER_BLOCK
+        frame[:FRAME_NUMBER_BLOCK, x:x + FRAME_NUMBER_BLOCK] = 255 if (number >> bit) & 1 else 0
+
+
+def read_frame_number(frame):
+    """
+    :return: frame number painted by the emulator on this frame (see stamp_frame_number)
+    """
+    half = FRAME_NUMBER_BLOCK // 2
+    row = frame[half, half::FRAME_NUMBER_BLOCK][:FRAME_NUMBER_BITS]
+    bits = np.asarray(row).reshape(len(row), -1).mean(axis=1) > 127
+    return int(sum(1 << bit for bit, is_set in enumerate(bits) if is_set))
+
+
+def _is_number(text):
+    try:
+        float(text)
+        return True
+    except ValueError:
+        return False
+
+
+def benchmark(emulator, address, seconds=10.0):
+    """
+    Connect to the emulator with djitellopy (like the copter scripts do), and measure:
+     - command round trip (how long "battery?" takes)
+     - frame latency (from the emulator sending a frame, until TelloFrameReader gives it to us)
+     - control loop throughput (AprilTag detection + RC commands, frames per second and RC packets per second)
+    """
+    import pupil_apriltags as apriltags
+    import detection
+    import videocopter
+
+    drone = videocopter.create_tello(address)
+    drone.connect()
+
+    round_trips, raw_round_trips = [], []
+    for _ in range(20):
+        sleep(drone.TIME_BTW_COMMANDS)  # or else djitellopy waits before sending, and we measure that
+        t = time()
+        drone.send_read_command("battery?")  # djitellopy checks for the response every 0.1s, so expect ~100ms
+        round_trips.append(time() - t)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as raw_socket:  # same command without djitellopy
+        raw_socket.settimeout(1.0)
+        for _ in range(20):
+            t = time()
+            raw_socket.sendto(b"battery?", drone.address)
+            raw_socket.recvfrom(1024)
+            raw_round_trips.append(time() - t)
+
+    drone.streamon()
+    frame_reader = videocopter.TelloFrameReader(drone)
+    rc = videocopter.RcControlScheduler(drone, rate_hz=20)
+    drone.takeoff()
+    tag_detector = apriltags.Detector(families="tag36h11", quad_sigma=0.2)
+
+    latencies, processed, seen = [], 0, 0
+    rc_at_start, start = emulator.rc_received, time()
+    while time() < start + seconds:
+        new_frame = frame_reader.wait_for_new_frame(timeout=0.5)
+        if new_frame is None:
+            continue
+        send_times = dict(emulator.frame_send_times)
+        number = read_frame_number(new_frame.frame)
+        if number in send_times:
+            latencies.append(new_frame.receive_time - send_times[number])
+        x, y, w, h = detection.detect_biggest_apriltag(tag_detector, new_frame.frame)
+        processed += 1
+        if x is not None:
+            seen += 1
+            videocopter.drone_follow_object_bang(rc, new_frame.frame, bbox=(x, y, w, h))
+        else:
+            rc.send_rc_control(0, 0, 0, 30)  # look around
+    elapsed = time() - start
+    rc.stop()
+    drone.land()
+    drone.end()
+
+    ms = lambda values: f"p50 {1000 * np.percentile(values, 50):.2f}ms, p90 {1000 * np.percentile(values, 90):.2f}ms" \
+        if values else "n/a"
+    print(f"command round trip: {ms(round_trips)} (djitellopy), {ms(raw_round_trips)} (UDP only)")
+    print(f"     frame latency: {ms(latencies)} (JPEG decode included)")
+    print(f"      control loop: {processed / elapsed:.1f} frames/s (tag seen on {seen}), "
+          f"{(emulator.rc_received - rc_at_start) / elapsed:.1f} rc packets/s, dropped {frame_reader.dropped_frames}")
+    pose = emulator.pose
+    print(f"    drone ended at: x {pose.x:.2f}m, y {pose.y:.2f}m, yaw {emulator.yaw:.0f} degrees")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="emulate a Tello drone (SDK commands, state and video) locally")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=EMULATOR_COMMAND_PORT, help="command port (8889 on a real Tello)")
+    parser.add_argument("--fps", type=float, default=30.0)
+    parser.add_argument("--benchmark", action="store_true", help="connect to it and measure latencies")
+    parser.add_argument("--seconds", type=float, default=10.0, help="how long to run the benchmark control loop")
+    args = parser.parse_args()
+
+    emulator = TelloEmulator(args.host, args.port, fps=args.fps)
+    print(f"emulated Tello listening on {args.host}:{args.port} (use TELLO_ADDRESS={args.host}:{args.port})")
+    if args.benchmark:
+        benchmark(emulator, f"{args.host}:{args.port}", args.seconds)
+        emulator.stop()
+        return
+    try:
+        while True:
+            sleep(5)
+            pose = emulator.pose
+            print(f"flying: {emulator.flying}, x: {pose.x:.2f}m, y: {pose.y:.2f}m, h: {emulator.z:.0f}cm, "
+                  f"yaw: {emulator.yaw:.0f}, commands: {emulator.commands_received}, frames: {emulator.frames_sent}")
+    except KeyboardInterrupt:
+        emulator.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import time
+
+import numpy as np
+
+import detection
+
+
+def test_track_velocity_converges_to_constant_speed():
+    tracks = detection.MultiTrackerState()
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    for step in range(30):
+        tracks.update(frame, detections=[(100 + 4 * step, 200, 50, 50)])  # moves 4 pixels right on every frame
+
+    assert len(tracks.tracks) == 1
+    assert np.allclose(tracks.tracks[0].velocity, [4, 0], atol=0.01)
+
+
+def test_track_velocity_with_skipped_detections():
+    tracks = detection.MultiTrackerState()
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    for step in range(60):
+        detections = [(100 + 3 * step, 200 - 2 * step, 50, 50)] if step % 3 == 0 else None  # every 3rd frame
+        tracks.update(frame, detections)
+
+    assert np.allclose(tracks.tracks[0].velocity, [3, -2], atol=0.01)
+
+
+class _LosingTracker(object):
+    # finds the box on the first frame after init, and then loses it
+    def __init__(self):
+        self.updates_since_init = 0
+
+    def init(self, frame, bbox):
+        self.bbox = bbox
+        self.updates_since_init = 0
+
+    def update(self, frame):
+        self.updates_since_init += 1
+        return self.updates_since_init == 1, self.bbox
+
+    def getTrackingScore(self):
+        return 1.0
+
+
+def test_async_detector_is_never_used_from_two_threads_at_once():
+    running, overlaps = [], []
+
+    def slow_detector(frame, overlay):
+        if running:
+            overlaps.append(1)
+        running.append(1)
+        time.sleep(0.05)
+        running.pop()
+        return 10, 10, 20, 20
+
+    tracker = detection.TrackerState(
+        _LosingTracker(), tracker_reinit_interval=1, tracker_max_frames_without_object=1, async_redetection=True)
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+    for _ in range(50):
+        detection.detect_or_track(frame, tracker, slow_detector)
+        time.sleep(0.005)
+
+    assert overlaps == []
+
+
+class _ScriptedTracker(object):
+    # returns the boxes from `script` one by one (None = lost)
+    def __init__(self, script):
+        self.script = list(script)
+
+    def init(self, frame, bbox):
+        pass
+
+    def update(self, frame):
+        bbox = self.script.pop(0)
+        return bbox is not None, bbox or (0, 0, 0, 0)
+
+    def getTrackingScore(self):
+        return 1.0
+
+
+def test_bridged_box_still_asks_for_full_detection():
+    boxes = [(10 + 5 * i, 50, 20, 20) for i in range(5)] + [None]
+    tracker = detection.TrackerState(_ScriptedTracker(boxes), motion_predictor=detection.BoxMotionPredictor())
+    tracker.init(np.zeros((120, 160, 3), dtype=np.uint8), boxes[0])
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+    for i in range(5):
+        tracker.update(frame, capture_time=0.1 * i)
+
+    can_skip, (x, y, w, h) = tracker.update(frame, capture_time=0.5)  # tracker lost it
+
+    assert x is not None and tracker.tracker_comments == "predicted"
+    assert not can_skip
+    assert tracker.full_detection_reason == "bridged"
+
+
+def test_tracker_init_forgets_the_velocity_of_the_old_object():
+    boxes = [(10 + 5 * i, 50, 20, 20) for i in range(5)]
+    tracker = detection.TrackerState(_ScriptedTracker(boxes), motion_predictor=detection.BoxMotionPredictor())
+    frame = np.zeros((120, 160, 3), dtype=np.uint8)
+    tracker.init(frame, boxes[0])
+    for i in range(5):
+        tracker.update(frame, capture_time=0.1 * i)
+    assert tracker.motion_predictor.initialized
+
+    tracker.init(frame, (100, 60, 20, 20))  # user clicked on another object
+    assert not tracker.motion_predictor.initialized
+
+
+def test_box_motion_predictor_learns_constant_speed():
+    predictor = detection.BoxMotionPredictor()
+    for i in range(30):  # 30 fps, moving 120 pixels per second right and 60 per second down
+        t = i / 30
+        predictor.update((100 + 120 * t, 80 + 60 * t, 40, 30), timestamp=t)
+
+    vx, vy, vw, vh = predictor.velocity
+    assert abs(vx - 120) < 5 and abs(vy - 60) < 5
+    assert abs(vw) < 5 and abs(vh) < 5
+
+    last_t = 29 / 30
+    x, y, w, h = predictor.predict(at_time=last_t + 0.1)  # 100ms later
+    assert abs(x - (100 + 120 * (last_t + 0.1))) <= 2
+    assert abs(y - (80 + 60 * (last_t + 0.1))) <= 2
+    assert (w, h) == (40, 30)
+
+
+def test_box_motion_predictor_bridging_expires():
+    predictor = detection.BoxMotionPredictor(max_bridge_seconds=0.3, max_prediction_seconds=0.5)
+    assert not predictor.can_bridge(at_time=0.0)  # never seen anything
+    predictor.update((10, 10, 20, 20), timestamp=1.0)
+
+    assert predictor.can_bridge(at_time=1.2)
+    assert not predictor.can_bridge(at_time=1.4)
+    assert predictor.predict(at_time=1.4)[0] is not None  # can still predict...
+    assert predictor.predict(at_time=1.6) == (None, None, None, None)  # ...but not too far
+
+
+def test_yolo_class_mask_is_cached_per_names_dict():
+    names = {0: "person", 1: "bicycle", 2: "car"}
+    mask = detection._valid_class_id_mask(names, frozenset({"car"}))
+    assert mask.tolist() == [False, False, True]
+    assert detection._valid_class_id_mask(names, frozenset({"car"})) is mask
+
+    renamed = {0: "car", 1: "bicycle", 2: "person"}  # a different model, different mask
+    assert detection._valid_class_id_mask(renamed, frozenset({"car"})).tolist() == [True, False, False]
+
+    cls = np.array([0, 2, 7])  # class id 7 is unknown to this model
+    conf = np.array([0.9, 0.9, 0.9])
+    result = type("Result", (), {"names": names})()
+    keep = detection._yolo_keep_mask(result, conf, cls, {"car"}, lowest_conf=0.5)
+    assert keep.tolist() == [False, True, False]
+
+
+def test_detect_near_draws_the_window_attempt_only_when_it_is_used():
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+
+    def detect(image, offset, overlay, found_in_window):
+        overlay.rectangle((0, 0), (10, 10), detection.RED)
+        if offset == (0, 0):
+            return 300, 200, 10, 10
+        return (5, 5, 10, 10) if found_in_window else (None, None, None, None)
+
+    # window missed => only the full frame attempt is drawn
+    overlay = detection.Overlay()
+    xywh = detection._detect_near(frame, (300, 200, 10, 10), overlay, lambda i, o, ov: detect(i, o, ov, False))
+    assert xywh == (300, 200, 10, 10)
+    assert [args[0] for _, args in overlay.commands] == [(0, 0)]
+
+    # window hit => its drawings are kept, moved into full frame coordinates
+    overlay = detection.Overlay()
+    x, y, w, h = detection._detect_near(frame, (300, 200, 10, 10), overlay, lambda i, o, ov: detect(i, o, ov, True))
+    x0, y0, _, _ = detection._search_window(frame, (300, 200, 10, 10), 3.0, 96)
+    assert (x, y) == (x0 + 5, y0 + 5)
+    assert [args[0] for _, args in overlay.commands] == [(x0, y0)]
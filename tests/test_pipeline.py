@@ -0,0 +1,19 @@
+import pipeline
+
+
+def test_detection_errors_do_not_stop_the_pipeline():
+    def detect(frame):
+        if frame % 2 == 0:
+            raise ValueError("bad frame")
+        return 1, 2, 3, 4
+
+    frames = iter(range(1, 1000))
+    detection_pipeline = pipeline.DetectionPipeline(read_frame=lambda: next(frames, None), detect=detect,
+                                                    frame_queue_size=100, result_queue_size=100).start()
+    bboxes = [detection_pipeline.get_result(timeout=1.0).bbox for _ in range(10)]
+    detection_pipeline.stop()
+
+    assert (1, 2, 3, 4) in bboxes
+    assert (None, None, None, None) in bboxes
+    assert detection_pipeline.detection_errors > 0
+    assert isinstance(detection_pipeline.last_error, ValueError)
@@ -0,0 +1,280 @@
+import asyncio
+import socket
+import threading
+from time import time, sleep
+
+import cv2
+import numpy as np
+import pytest
+
+import videocar
+
+
+LEFT, RIGHT = videocar.LEFT_MOTOR_PIN, videocar.RIGHT_MOTOR_PIN
+
+
+class FlakyPigpio(videocar.FakePigpio):
+    # FakePigpio whose hardware_PWM raises the first `failures` times, or always for `failing_duty_cycle`
+    def __init__(self, failures=0, failing_duty_cycle=None):
+        super().__init__()
+        self.failures = failures
+        self.failing_duty_cycle = failing_duty_cycle
+        self.attempts = []
+
+    def hardware_PWM(self, gpio, frequency, duty_cycle):
+        self.attempts.append((gpio, frequency, duty_cycle))
+        if self.failures > 0 or duty_cycle == self.failing_duty_cycle:
+            self.failures -= 1
+            raise ConnectionError("pigpio connection dropped")
+        return super().hardware_PWM(gpio, frequency, duty_cycle)
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time() + timeout
+    while not condition():
+        assert time() < deadline, "timed out"
+        sleep(0.005)
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(videocar, "MOTOR_RETRY_SECONDS", 0.01)
+
+
+def test_motor_sender_gets_the_latest_command_through_after_pigpio_recovers():
+    pins = FlakyPigpio(failures=3)
+    metrics = videocar.VideocarMetrics()
+    sender = videocar.MotorCommandSender(pins, metrics)
+    sender.post({LEFT: 80000, RIGHT: 80000})
+    wait_until(lambda: metrics.motor_command_errors >= 1)
+    sender.post({LEFT: 85000, RIGHT: 70000})  # does not raise, even though pigpio is failing
+
+    wait_until(lambda: {LEFT, RIGHT} <= {gpio for _, gpio, _, _ in pins.calls})
+    wait_until(lambda: sender.error is None)
+    last_sent = {gpio: duty_cycle for _, gpio, _, duty_cycle in pins.calls}
+    assert last_sent == {LEFT: 85000, RIGHT: 70000}
+    assert metrics.motor_command_errors == 3
+    assert not metrics.motor_commands_failing
+    assert "videocar_motor_command_errors_total 3" in metrics.to_prometheus()
+
+
+def test_motor_sender_never_sends_an_old_command_after_hard_stop():
+    pins = FlakyPigpio(failing_duty_cycle=90000)  # so this command stays pending and keeps being retried
+    sender = videocar.MotorCommandSender(pins)
+    sender.post({LEFT: 90000, RIGHT: 90000})
+    wait_until(lambda: len(pins.attempts) >= 2)
+
+    sender.hard_stop((LEFT, RIGHT), videocar.ZERO_THROTTLE)
+    attempts_at_stop = len(pins.attempts)
+    sleep(0.1)  # (enough for a few retries, if there were any left)
+
+    assert len(pins.attempts) == attempts_at_stop
+    assert [(gpio, duty_cycle) for _, gpio, _, duty_cycle in pins.calls] == [
+        (LEFT, videocar.ZERO_THROTTLE), (RIGHT, videocar.ZERO_THROTTLE), (LEFT, 0), (RIGHT, 0)]
+
+
+def test_motor_sender_hard_stop_tries_every_pin_and_raises():
+    pins = FlakyPigpio(failures=1000)  # pigpio is down
+    sender = videocar.MotorCommandSender(pins)
+    with pytest.raises(ConnectionError):
+        sender.hard_stop((LEFT, RIGHT), videocar.ZERO_THROTTLE)
+
+    assert [(gpio, duty_cycle) for gpio, _, duty_cycle in pins.attempts] == [
+        (LEFT, videocar.ZERO_THROTTLE), (RIGHT, videocar.ZERO_THROTTLE), (LEFT, 0), (RIGHT, 0)]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def test_async_server_survives_malformed_requests():
+    errors = []
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(lambda loop, context: errors.append(context))
+        port = _free_port()
+        server = asyncio.ensure_future(videocar._serve_async("127.0.0.1", port))
+        await asyncio.sleep(0.2)
+        for request in (b"POST /click HTTP/1.1\r\nContent-Length: 100\r\n\r\n{\"x\"",  # body shorter than said
+                        b"GARBAGE\r\n\r\n",  # no target on the request line
+                        b"POST /button HTTP/1.1\r\nContent-Length: 7\r\n\r\n[1, 2 ]"):  # JSON but not a button
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(request)
+            await writer.drain()
+            writer.write_eof()
+            await reader.read()  # until the server closes the connection
+            writer.close()
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)  # and it still serves pages
+        writer.write(b"GET /nothing HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        server.cancel()
+        return response
+
+    response = asyncio.run(scenario())
+    assert response.startswith(b"HTTP/1.1 404")
+    assert errors == []
+
+
+def _client_frame(opcode, payload, fin=True, mask=b"\x37\xfa\x21\x3d"):
+    # a frame like the browser sends it (always masked)
+    length = len(payload)
+    if length < 126:
+        header = bytes([(0x80 if fin else 0) | opcode, 0x80 | length])
+    elif length < 65536:
+        header = bytes([(0x80 if fin else 0) | opcode, 0x80 | 126]) + length.to_bytes(2, "big")
+    else:
+        header = bytes([(0x80 if fin else 0) | opcode, 0x80 | 127]) + length.to_bytes(8, "big")
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    return header + mask + masked
+
+
+def test_websocket_decoder_unmasks_a_text_frame():
+    decoder = videocar._WebSocketDecoder()
+    assert decoder.feed(_client_frame(videocar.WEBSOCKET_TEXT, b'{"kind": "drive"}')) == [
+        (videocar.WEBSOCKET_TEXT, b'{"kind": "drive"}')]
+
+
+def test_websocket_decoder_waits_for_the_rest_of_a_frame():
+    decoder = videocar._WebSocketDecoder()
+    data = _client_frame(videocar.WEBSOCKET_TEXT, b"hello") + _client_frame(videocar.WEBSOCKET_TEXT, b"world")
+    messages = []
+    for i in range(len(data)):  # one byte at a time
+        messages += decoder.feed(data[i:i + 1])
+    assert messages == [(videocar.WEBSOCKET_TEXT, b"hello"), (videocar.WEBSOCKET_TEXT, b"world")]
+
+
+@pytest.mark.parametrize("length", [125, 126, 1000, 65535, 65536, 70000])
+def test_websocket_decoder_extended_lengths(length):
+    payload = bytes(i % 251 for i in range(length))
+    decoder = videocar._WebSocketDecoder()
+    assert decoder.feed(_client_frame(videocar.WEBSOCKET_TEXT, payload)) == [(videocar.WEBSOCKET_TEXT, payload)]
+
+
+def test_websocket_decoder_joins_fragments_with_a_ping_in_between():
+    decoder = videocar._WebSocketDecoder()
+    data = (_client_frame(videocar.WEBSOCKET_TEXT, b"dri", fin=False)
+            + _client_frame(videocar.WEBSOCKET_PING, b"?")  # control frames can come between the fragments
+            + _client_frame(videocar.WEBSOCKET_CONTINUATION, b"v", fin=False)
+            + _client_frame(videocar.WEBSOCKET_CONTINUATION, b"e"))
+    assert decoder.feed(data) == [(videocar.WEBSOCKET_PING, b"?"), (videocar.WEBSOCKET_TEXT, b"drive")]
+
+
+def test_websocket_decoder_stops_at_close_frame():
+    decoder = videocar._WebSocketDecoder()
+    data = (_client_frame(videocar.WEBSOCKET_TEXT, b"last")
+            + _client_frame(videocar.WEBSOCKET_CLOSE, (1000).to_bytes(2, "big"))
+            + _client_frame(videocar.WEBSOCKET_TEXT, b"after close"))
+    assert decoder.feed(data) == [(videocar.WEBSOCKET_TEXT, b"last"), (videocar.WEBSOCKET_CLOSE, b"\x03\xe8")]
+    assert decoder.closed
+    assert decoder.feed(b"") == []
+
+
+def _jpeg(color, width=64, height=48):
+    frame = np.full((height, width, 3), color, dtype=np.uint8)
+    return cv2.imencode(".jpg", frame)[1].tobytes()
+
+
+def test_mjpeg_reader_finds_jpegs_split_across_reads(monkeypatch):
+    camera_end, reader_end = socket.socketpair()
+    monkeypatch.setattr(videocar, "create_connection", lambda address, timeout: reader_end)
+    reader = videocar.MjpegSocketReader("camera", 8000)
+    try:
+        for color in (40, 200):
+            data = b"\x00garbage\xff" + _jpeg(color) + b"more garbage"
+            for start in range(0, len(data), 97):  # JPEG split into many small pieces
+                camera_end.sendall(data[start:start + 97])
+                sleep(0.001)
+            sequence, capture_time, frame = reader.read(timeout=2.0)
+            assert frame is not None and frame.shape == (48, 64, 3)
+            assert abs(int(frame.mean()) - color) <= 2
+    finally:
+        reader.stop()
+        camera_end.close()
+    assert reader_end.fileno() == -1  # stop() closed the socket
+
+
+def test_mjpeg_reader_stop_during_reconnect_closes_the_new_socket(monkeypatch):
+    camera_end, first_socket = socket.socketpair()
+    _, second_socket = socket.socketpair()
+    reconnecting = threading.Event()
+
+    def create_connection(address, timeout):
+        if not reconnecting.is_set() and first_socket.fileno() != -1:
+            return first_socket
+        reconnecting.set()
+        sleep(0.3)  # slow to connect, and stop() is called meanwhile
+        return second_socket
+
+    monkeypatch.setattr(videocar, "create_connection", create_connection)
+    reader = videocar.MjpegSocketReader("camera", 8000)
+    camera_end.close()  # camera stream ended, so the reader reconnects (after 1s)
+    assert reconnecting.wait(timeout=3.0)
+    reader.stop()
+    reader.thread.join(1.0)
+
+    assert not reader.thread.is_alive()
+    assert reader.socket is None
+    assert second_socket.fileno() == -1
+
+
+@pytest.mark.parametrize("args, expected", [
+    ({}, (None, videocar.DEFAULT_JPEG_QUALITY, True)),
+    ({"width": "320", "q": "60", "adaptive": "0"}, (320, 60, False)),
+    ({"width": "0"}, (videocar.MIN_STREAM_WIDTH, videocar.DEFAULT_JPEG_QUALITY, True)),
+    ({"width": "-5", "q": "0"}, (videocar.MIN_STREAM_WIDTH, 1, True)),
+    ({"width": "abc", "q": "500"}, (None, 100, True)),
+])
+def test_stream_args(args, expected):
+    assert videocar._stream_args(args) == expected
+
+
+def _jpeg_width(jpeg):
+    return cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR).shape[1]
+
+
+@pytest.mark.parametrize("width, expected_width", [
+    (None, 640), (0, 160), (-5, 160), (250, 224), (320, 320), (639, 608), (640, 640), (99999, 640)])
+def test_broadcaster_rounds_and_clamps_the_width(width, expected_width):
+    broadcaster = videocar.FrameBroadcaster()
+    broadcaster.publish(np.zeros((480, 640, 3), dtype=np.uint8))
+    _, jpeg = broadcaster.wait_for_jpeg(0, timeout=0, width=width, quality=50)
+    assert _jpeg_width(jpeg) == expected_width
+
+
+def test_broadcaster_jpeg_cache_stays_bounded():
+    broadcaster = videocar.FrameBroadcaster()
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    for version in range(1, 200):  # every frame, a viewer asks for another profile
+        broadcaster.publish(frame)
+        broadcaster.wait_for_jpeg(version - 1, timeout=0, width=160 + 32 * (version % 15), quality=version % 100)
+        assert len(broadcaster.jpegs) <= 2
+
+
+class _ScriptedCamera(object):
+    # has the same read() as CameraReader: gives a frame, or times out, as the script says
+    def __init__(self, script):
+        self.script = list(script)
+        self.sequence = 0
+        self.dropped_frames = 0
+
+    def read(self, wait_for_new_frame=True, timeout=1.0):
+        if not self.script.pop(0):
+            return None, None, None  # timed out
+        self.sequence += 1
+        return self.sequence, time(), np.zeros((48, 64, 3), dtype=np.uint8)
+
+
+def test_processing_metrics_count_only_returned_frames():
+    camera = _ScriptedCamera([True, False, False, True, False, True])
+    robot = videocar.RobotContainer(None, camera=camera)
+    frames = [robot.get_video_frame() for _ in range(6)]
+
+    assert sum(frame is not None for frame in frames) == 3
+    prometheus = robot.metrics.to_prometheus()
+    assert "videocar_frames_processed_total 3\n" in prometheus
+    assert "videocar_frames_captured_total 3\n" in prometheus
+    assert robot.metrics.to_json()["frames_processed"] == 3
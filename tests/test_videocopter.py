@@ -0,0 +1,99 @@
+from time import time, sleep
+
+import numpy as np
+
+import videocopter
+
+
+class FakeDrone(object):
+    # records the RC commands (with the time when they were sent), like djitellopy.Tello would send them
+    def __init__(self):
+        self.rc_commands = []
+        self.took_off = False
+
+    def send_rc_control(self, left_right, forward_backward, up_down, yaw):
+        self.rc_commands.append((time(), (left_right, forward_backward, up_down, yaw)))
+
+    def takeoff(self):
+        self.took_off = True
+
+    def get_battery(self):
+        return 87
+
+
+def test_rc_scheduler_sends_at_a_fixed_rate():
+    drone = FakeDrone()
+    rc = videocopter.RcControlScheduler(drone, rate_hz=50, stale_after=0.5)
+    start = time()
+    while time() < start + 0.5:
+        rc.send_rc_control(10, 20, 0, -5)  # the vision loop updates the setpoint much faster than the rate
+        sleep(0.001)
+    rc.stop()
+
+    times = np.array([t for t, _ in drone.rc_commands])
+    assert 20 <= len(times) <= 30  # about 50 per second, not one per update
+    assert abs(np.median(np.diff(times)) - 0.02) < 0.005
+    assert all(command == (10, 20, 0, -5) for _, command in drone.rc_commands)
+
+
+def test_rc_scheduler_hovers_three_times_after_going_stale_and_then_stays_silent():
+    drone = FakeDrone()
+    rc = videocopter.RcControlScheduler(drone, rate_hz=50, stale_after=0.1, hover_packets=3)
+    rc.send_rc_control(0, 50, 0, 0)
+    sleep(0.4)  # nobody updates the setpoint (vision loop got stuck)
+    count = len(drone.rc_commands)
+    sleep(0.2)
+
+    commands = [command for _, command in drone.rc_commands]
+    assert len(drone.rc_commands) == count  # silence after the hovers
+    assert commands[-3:] == [(0, 0, 0, 0)] * 3
+    assert all(command == (0, 50, 0, 0) for command in commands[:-3])
+    assert drone.rc_commands[-3][0] - drone.rc_commands[0][0] >= 0.1  # (hovering only started once stale)
+
+    rc.send_rc_control(0, 10, 0, 0)  # a new setpoint wakes it up again
+    sleep(0.05)
+    rc.stop()
+    assert drone.rc_commands[-1][1] == (0, 10, 0, 0)
+
+
+def test_rc_scheduler_passes_everything_else_to_the_drone():
+    drone = FakeDrone()
+    rc = videocopter.RcControlScheduler(drone)
+    rc.takeoff()
+    battery = rc.get_battery()
+    rc.stop()
+    assert drone.took_off and battery == 87
+
+
+def test_pid_integral_starts_over_after_a_long_gap():
+    pid = videocopter.PIDController(kp=0.0, ki=1.0, max_dt=0.5)
+    for step in range(10):
+        pid.update(1.0, timestamp=0.1 * step)
+    assert np.isclose(pid.integral, 0.9)
+
+    output = pid.update(0.0, timestamp=100.0)  # the object was lost for a long time
+    assert pid.integral == 0.0
+    assert output == 0.0
+
+
+def test_pid_integral_keeps_growing_without_gaps():
+    pid = videocopter.PIDController(kp=0.0, ki=1.0, max_dt=0.5)
+    for step in range(10):
+        pid.update(1.0, timestamp=0.4 * step)
+    assert np.isclose(pid.integral, 3.6)
+
+
+def test_pid_vector_gains_match_scalar_controllers():
+    gains = dict(kp=[2.0, 0.5], ki=[1.0, 0.2], kd=[0.1, 0.3], integral_limit=[5.0, 1.0], output_limit=[3.0, 2.0],
+                 max_output_rate=[20.0, 10.0])
+    vector_pid = videocopter.PIDController(**gains)
+    scalar_pids = [videocopter.PIDController(**{name: values[axis] for name, values in gains.items()})
+                   for axis in range(2)]
+    rng = np.random.default_rng(0)
+    timestamp = 0.0
+    for _ in range(100):
+        timestamp += rng.uniform(0.02, 0.8)  # some of these are longer than max_dt
+        error = rng.uniform(-2, 2, size=2)
+        vector_output = vector_pid.update(error, timestamp)
+        scalar_outputs = [pid.update(error[axis], timestamp) for axis, pid in enumerate(scalar_pids)]
+        assert np.allclose(vector_output, scalar_outputs)
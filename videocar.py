@@ -1,13 +1,23 @@
 from flask import Flask, Response, request, json, render_template_string
-from socket import gethostname
+from socket import gethostname, create_connection, SHUT_RDWR
 from time import time, sleep
-from threading import Thread
+from threading import Thread, Condition, Lock
+from bisect import bisect_left
+from itertools import accumulate
+from collections import deque, namedtuple
+from hashlib import sha1
+from base64 import b64encode
+from urllib.parse import urlsplit, parse_qs
 
 import cv2
 import pigpio
 import atexit
+import asyncio
 import numpy as np
 
+from detection import Overlay
+from carpins import RIGHT_MOTOR_PIN, LEFT_MOTOR_PIN, PWM_FREQUENCY, ZERO_THROTTLE, FULL_FORWARD
+
 # on host "raspberrypi" this should be installed
 """
 ## install pigpio (for *reliable* access to GPIO pins from python code)
@@ -104,14 +114,23 @@ def stop_all_motors():
     robot_container.stop_all_motors()
 
 
-def display_web_video_frame(f, comment=None):
+def display_web_video_frame(f, comment=None, overlay=None):
     assert robot_container is not None, "videotank.start() must be called first"
-    robot_container.display_video_frame(f, comment)
+    robot_container.display_video_frame(f, comment, overlay)
 
 
-def get_video_frame():
+def get_video_frame(wait_for_new_frame=True):
     assert robot_container is not None, "videotank.start() must be called first"
-    return robot_container.get_video_frame()
+    return robot_container.get_video_frame(wait_for_new_frame)
+
+
+def mark_detection_done():
+    """
+    Call this when you are done detecting objects on the frame from get_video_frame(), to measure that latency
+    (see /metrics)
+    """
+    assert robot_container is not None, "videotank.start() must be called first"
+    robot_container.mark_detection_done()
 
 
 def get_clicks():
@@ -124,21 +143,47 @@ def get_buttons():
     return robot_container.get_buttons()
 
 
-def start(simulation=False, robot_hostname=None, motor_directions=(1, 1,), video_direction=1):
+def get_drive_command(max_age_seconds=None):
+    """
+    :param max_age_seconds: ignore drive commands older than this (None = DRIVE_COMMAND_TIMEOUT_SECONDS)
+    :return: (forward_speed, right_turn_speed) that the operator is sending from the web page (W/A/S/D or arrow keys),
+     or None if the operator is not driving now
+    """
+    assert robot_container is not None, "videotank.start() must be called first"
+    return robot_container.get_drive_command(max_age_seconds)
+
+
+def start(simulation=False, robot_hostname=None, motor_directions=(1, 1,), video_direction=1,
+          camera_backend="opencv", video_scale=1, pins=None, web_server="flask", simulator=None):
+    """
+    :param simulator: in simulation, drive this simulated car (carsim.CarSimulator) instead of using webcam 0
+    :param pins: use this object instead of connecting to pigpio (for example, FakePigpio for testing)
+    :param web_server: "flask" (one thread per connection) or "asyncio" (all connections on one thread, and
+     the video viewers only wake up when there is a new frame: less CPU on the Pi with many viewers)
+    :param camera_backend: "opencv" (decode the camera stream with cv2.VideoCapture) or "mjpeg" (read the JPEGs
+     from the camera socket directly, and only decode the ones that are actually used: less CPU)
+    :param video_scale: with "mjpeg" backend, decode frames at 1/2, 1/4 or 1/8 of their size (faster)
+    """
     global in_simulation, robot_container, webserver_thread
     assert in_simulation is None, "videotank.start() called twice"
     assert webserver_thread is None, "somehow starting webserver twice"
+    assert web_server in ("flask", "asyncio"), f"unknown web_server: {web_server}"
 
-    webserver_thread = Thread(target=_run_webserver)
+    webserver_thread = Thread(target=_run_webserver if web_server == "flask" else _run_async_webserver)
     webserver_thread.daemon = True
     webserver_thread.start()
 
     if simulation:
         in_simulation = True
+        if simulator is not None:
+            simulator.wire(motor_directions, video_direction)  # simulated car is wired like the real one
         robot_container = RobotContainer(
             motor_directions=motor_directions,
             video_direction=video_direction,
-            hostname=None)
+            hostname=None,
+            pins=simulator.pins if simulator is not None else pins,
+            camera=simulator,
+            synchronous_motors=simulator is not None)  # (lockstep: the motors are set before the next frame)
         # no robot hostname, if running in simulation
     else:
         in_simulation = False
@@ -147,7 +192,10 @@ def start(simulation=False, robot_hostname=None, motor_directions=(1, 1,), video
         robot_container = RobotContainer(
             motor_directions=motor_directions,
             video_direction=video_direction,
-            hostname=robot_hostname or HOSTNAME)
+            hostname=robot_hostname or HOSTNAME,
+            camera_backend=camera_backend,
+            video_scale=video_scale,
+            pins=pins)
 
     # send motors a stop signal for 0.1s
     print("sending motors a stop signal")
@@ -170,14 +218,86 @@ def _run_webserver():
     webserver.run(host="0.0.0.0", port=8080, debug=False, use_reloader=False)
 
 
-def _gen_frames():
+def _gen_frames(width=None, quality=None, adaptive=True):
+    """
+    :param width: resize the video to this width (None = full resolution)
+    :param quality: JPEG quality (between 1 and 100, None = DEFAULT_JPEG_QUALITY)
+    :param adaptive: if sending a frame to this viewer takes too long, lower the quality (and then the resolution),
+     and go back up once the viewer keeps up again
+    """
+    version = 0
+    profile = _StreamProfile(width, quality or DEFAULT_JPEG_QUALITY)
     while True:
-        if robot_container is None or robot_container.frame_to_display is None:
+        if robot_container is None:
             sleep(0.25)
             continue
-        success, jpg = cv2.imencode('.jpg', robot_container.frame_to_display)
-        encoded = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpg.tobytes() + b'\r\n'
-        yield encoded
+        # wait for a newer frame than the one we sent last time (viewers with same profile get the same JPEG bytes)
+        broadcaster = robot_container.video_broadcaster
+        version, jpg = broadcaster.wait_for_jpeg(version, timeout=1.0, width=profile.width, quality=profile.quality)
+        if jpg is None:
+            continue
+        encoded = b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpg + b'\r\n'
+        t = time()
+        yield encoded  # this blocks for as long as it takes to send the frame to the viewer
+        if adaptive:
+            profile.adapt(time() - t, broadcaster.frame_width)
+
+
+def _stream_args(args):
+    """
+    :param args: query parameters of a /video_feed request (for example, {"width": "320", "q": "60"})
+    :return: (width, quality, adaptive), with width at least MIN_STREAM_WIDTH (or None) and quality from 1 to 100
+    """
+    width = _int_or_none(args.get("width"))
+    quality = _int_or_none(args.get("q"))
+    adaptive = _int_or_none(args.get("adaptive")) != 0
+    if width is not None:
+        width = max(MIN_STREAM_WIDTH, width)
+    quality = DEFAULT_JPEG_QUALITY if quality is None else int(np.clip(quality, 1, 100))
+    return width, quality, adaptive
+
+
+def _int_or_none(text):
+    try:
+        return int(text)
+    except (TypeError, ValueError):
+        return None
+
+
+class _StreamProfile:
+    """
+    Resolution and quality of the web video for one viewer, stepping down when the viewer falls behind
+    """
+
+    def __init__(self, width, quality):
+        self.requested_width, self.requested_quality = width, quality
+        self.width, self.quality = width, quality
+        self.fast_frames = 0
+
+    def adapt(self, send_seconds, frame_width):
+        """
+        :param send_seconds: how long it took to send the last frame to the viewer
+        :param frame_width: width of the frames from the camera (to know where the full resolution is)
+        """
+        if send_seconds > SLOW_SEND_SECONDS:
+            self.fast_frames = 0
+            width = min(self.width or frame_width, frame_width)
+            if self.quality > MIN_JPEG_QUALITY:
+                self.quality = max(MIN_JPEG_QUALITY, self.quality - JPEG_QUALITY_STEP)
+            elif width > MIN_STREAM_WIDTH:
+                self.width = max(MIN_STREAM_WIDTH, width // 2)
+        elif send_seconds < FAST_SEND_SECONDS:
+            self.fast_frames += 1
+            if self.fast_frames >= FAST_FRAMES_TO_STEP_UP:
+                self.fast_frames = 0
+                if self.width != self.requested_width:
+                    self.width = self.width * 2
+                    if self.requested_width is None and self.width >= frame_width:
+                        self.width = None
+                    elif self.requested_width is not None:
+                        self.width = min(self.width, self.requested_width)
+                elif self.quality < self.requested_quality:
+                    self.quality = min(self.requested_quality, self.quality + JPEG_QUALITY_STEP)
 
 
 # we can maybe later have more than one robot_container, but we only have one webserver
@@ -210,6 +330,23 @@ function saveMouseDown(event) {
   mouseDownY = event.offsetY;
 }
 
+// all the clicks, buttons and drive commands go over one WebSocket (and over HTTP POST if it is not connected)
+var control = null;
+
+function connectControl() {
+  control = new WebSocket((location.protocol == "https:" ? "wss://" : "ws://") + location.host + "/control");
+  control.onclose = function() { control = null; setTimeout(connectControl, 1000); };
+}
+connectControl();
+
+function sendControl(message, fallbackUrl) {
+  if (control != null && control.readyState == WebSocket.OPEN) {
+    control.send(JSON.stringify(message));
+  } else if (fallbackUrl != null) {
+    fetch(fallbackUrl, {method:"POST", body: JSON.stringify(message)});
+  }
+}
+
 function sendSelectedRegion(event) {
   // Get the coordinates of the click relative to the document.
   var mouseUpX = event.offsetX;
@@ -219,12 +356,34 @@ function sendSelectedRegion(event) {
   var x = Math.min(mouseDownX, mouseUpX);
   var y = Math.min(mouseDownY, mouseUpY);
   //document.getElementById("coordinates").innerHTML = "x: " + x + ", y: " + y + ", w: " + w + " h: " + h;
-  response = fetch("{{ url_for('click') }}", {method:"POST", body: JSON.stringify({ x: x, y: y, w: w, h: h })});
+  sendControl({ type: "click", x: x, y: y, w: w, h: h }, "{{ url_for('click') }}");
 }
 
 function sendButtonClick(text) {
-  response = fetch("{{ url_for('button') }}", {method:"POST", body: JSON.stringify({ text: text })});
+  sendControl({ type: "button", text: text }, "{{ url_for('button') }}");
+}
+
+// drive with W/A/S/D or arrow keys: while any of them is held, the drive command is repeated 10 times per second
+var keysDown = {};
+var driveKeys = { w: [1, 0], ArrowUp: [1, 0], s: [-1, 0], ArrowDown: [-1, 0], a: [0, -1], ArrowLeft: [0, -1], d: [0, 1], ArrowRight: [0, 1] };
+
+function sendDrive() {
+  var forward = 0, turn = 0;
+  for (var key in keysDown) { forward += driveKeys[key][0]; turn += driveKeys[key][1]; }
+  sendControl({ type: "drive", forward: 0.5 * forward, turn: 0.5 * turn }, null);
 }
+setInterval(function() { if (Object.keys(keysDown).length > 0) sendDrive(); }, 100);
+
+document.addEventListener("keydown", function(event) {
+  if (driveKeys[event.key] == null || keysDown[event.key]) return;
+  keysDown[event.key] = true;
+  sendDrive();
+});
+document.addEventListener("keyup", function(event) {
+  if (driveKeys[event.key] == null) return;
+  delete keysDown[event.key];
+  sendDrive();  // if it was the last key, this sends a stop
+});
 
 // add event listeners for clicks and drags
 document.getElementById('videobar').ondragstart = function() { return false; };
@@ -242,59 +401,934 @@ document.getElementById("videobar").addEventListener("touchend", sendSelectedReg
 
 @webserver.route('/video_feed')
 def video_feed():
-    return Response(_gen_frames(), mimetype='multipart/x-mixed-replace; boundary=frame')
+    # for example, /video_feed?width=320&q=60 (and &adaptive=0 to never change them)
+    frames = _gen_frames(*_stream_args(request.args))
+    return Response(frames, mimetype='multipart/x-mixed-replace; boundary=frame')
+
+
+@webserver.route('/metrics')
+def metrics():
+    # Prometheus text format, or /metrics?format=json
+    if robot_container is None:
+        return Response("videocar.start() was not called yet\n", status=503, mimetype='text/plain')
+    if request.args.get('format') == 'json':
+        return Response(json.dumps(robot_container.metrics.to_json()), mimetype='application/json')
+    return Response(robot_container.metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
 
 
 @webserver.route('/click', methods=['GET', 'POST'])
 def click():
-    try:
-        point = json.loads(request.get_data())
-        robot_container.points_clicked.append(point)
-    except:
-        print("WARNING: got a click, but could not decode it")
+    _put_operator_input("click", request.get_data())
     return ""
 
 
 @webserver.route('/button', methods=['GET', 'POST'])
 def button():
-    try:
-        pressed = json.loads(request.get_data())
-        robot_container.buttons_clicked.append(pressed["text"])
-    except:
-        print("WARNING: got a click, but could not decode it")
+    _put_operator_input("button", request.get_data())
     return ""
 
 
+def _put_operator_input(kind, body):
+    """
+    Give a click or button press from the web page (POST /click or /button, JSON body) to the control loop
+    (used by both the Flask and the asyncio web servers)
+    """
+    if robot_container is None:
+        return
+    try:
+        message = json.loads(body)
+        robot_container.operator_input.put(kind, message["text"] if kind == "button" else message)
+    except (ValueError, KeyError, TypeError):
+        print(f"WARNING: got a {kind}, but could not decode it")
+
+
+@webserver.route('/control', websocket=True)
+def control():
+    """
+    WebSocket: the web page keeps this one connection open, and sends all clicks, buttons and drive commands over it.
+
+    Only works with the werkzeug development server (which `webserver.run()` starts, see _run_webserver):
+    it takes over the raw socket from environ["werkzeug.socket"], and then ends the request by raising
+    ConnectionError from _WebSocketClosedResponse (which werkzeug treats as "client went away").
+    Under another WSGI server there is no "werkzeug.socket", and this returns 400 (the web page then falls back
+    to POST /click and /button); the asyncio web server has its own WebSocket code (_serve_websocket_async).
+    """
+    sock = request.environ.get("werkzeug.socket")
+    key = request.headers.get("Sec-WebSocket-Key")
+    if sock is None or key is None or request.headers.get("Upgrade", "").lower() != "websocket":
+        return Response("expected a WebSocket connection\n", status=400, mimetype="text/plain")
+    sock.sendall(_websocket_handshake(key))
+    decoder = _WebSocketDecoder()
+    while not decoder.closed:
+        try:
+            data = sock.recv(4096)
+        except OSError:
+            break
+        if not data:
+            break
+        for opcode, payload in decoder.feed(data):
+            reply = _on_websocket_message(opcode, payload)
+            if reply is not None:
+                sock.sendall(reply)
+    try:
+        sock.shutdown(SHUT_RDWR)  # so that werkzeug does not wait for another request on this connection
+    except OSError:
+        pass
+    return _WebSocketClosedResponse()
+
+
+def _websocket_handshake(key):
+    accept = b64encode(sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+    return ("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+            f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode()
+
+
+def _websocket_frame(opcode, payload=b""):
+    length = len(payload)
+    if length < 126:
+        header = bytes([0x80 | opcode, length])
+    elif length < 65536:
+        header = bytes([0x80 | opcode, 126]) + length.to_bytes(2, "big")
+    else:
+        header = bytes([0x80 | opcode, 127]) + length.to_bytes(8, "big")
+    return header + payload
+
+
+def _on_websocket_message(opcode, payload):
+    """
+    :return: bytes to send back (or None)
+    """
+    if opcode == WEBSOCKET_PING:
+        return _websocket_frame(WEBSOCKET_PONG, payload)
+    if opcode == WEBSOCKET_CLOSE:
+        return _websocket_frame(WEBSOCKET_CLOSE, payload[:2])
+    if opcode == WEBSOCKET_TEXT and robot_container is not None:
+        try:
+            message = json.loads(payload.decode())
+            kind = message.pop("type")
+            if kind == "click":
+                robot_container.operator_input.put("click", message)
+            elif kind == "button":
+                robot_container.operator_input.put("button", message["text"])
+            elif kind == "drive":
+                drive = (float(message["forward"]), float(message["turn"]))
+                robot_container.operator_input.put("drive", drive, latest_only=True)
+        except:
+            print(f"WARNING: got a control message, but could not decode it: {payload[:100]}")
+    return None
+
+
+class _WebSocketDecoder:
+    """
+    Splits the bytes that the browser sends over a WebSocket into messages (RFC 6455, no extensions)
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.fragments = None  # (opcode, bytes so far) of a message that came in several frames
+        self.closed = False
+
+    def feed(self, data):
+        """
+        :return: list of (opcode, payload) of the messages that are now complete
+        """
+        self.buffer += data
+        messages = []
+        while not self.closed:
+            frame = self._take_frame()
+            if frame is None:
+                break
+            fin, opcode, payload = frame
+            if opcode == WEBSOCKET_CONTINUATION and self.fragments is not None:
+                self.fragments = (self.fragments[0], self.fragments[1] + payload)
+                if fin:
+                    messages.append(self.fragments)
+                    self.fragments = None
+            elif fin or opcode >= WEBSOCKET_CLOSE:  # control frames are never split
+                messages.append((opcode, payload))
+                self.closed = opcode == WEBSOCKET_CLOSE
+            else:
+                self.fragments = (opcode, payload)
+        return messages
+
+    def _take_frame(self):
+        buffer = self.buffer
+        if len(buffer) < 2:
+            return None
+        fin, opcode = bool(buffer[0] & 0x80), buffer[0] & 0x0F
+        masked, length, offset = bool(buffer[1] & 0x80), buffer[1] & 0x7F, 2
+        if length >= 126:
+            size = 2 if length == 126 else 8
+            if len(buffer) < offset + size:
+                return None
+            length, offset = int.from_bytes(buffer[offset:offset + size], "big"), offset + size
+        mask = buffer[offset:offset + 4] if masked else None
+        offset += 4 if masked else 0
+        if len(buffer) < offset + length:
+            return None
+        payload = np.frombuffer(bytes(buffer[offset:offset + length]), dtype=np.uint8)
+        if masked:  # browsers always mask what they send
+            payload = payload ^ np.resize(np.frombuffer(bytes(mask), dtype=np.uint8), length)
+        del buffer[:offset + length]
+        return fin, opcode, payload.tobytes()
+
+
+class _NewFrameSignal:
+    """
+    Wakes up the video streaming coroutines of the asyncio web server when a new frame is published (from any thread)
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.event = asyncio.Event()
+        self.broadcaster = None
+
+    def listen_to(self, broadcaster):
+        if self.broadcaster is not broadcaster:
+            self.broadcaster = broadcaster
+            broadcaster.add_listener(self.notify_threadsafe)
+
+    def notify_threadsafe(self):
+        self.loop.call_soon_threadsafe(self._notify)
+
+    def _notify(self):
+        self.event.set()
+        self.event = asyncio.Event()  # whoever waits after this, waits for the next frame
+
+    async def wait(self):
+        await self.event.wait()
+
+
+def _run_async_webserver():
+    asyncio.run(_serve_async(port=8080))
+
+
+async def _serve_async(host="0.0.0.0", port=8080):
+    # same pages as the Flask web server, but all the connections are served by one event loop on one thread
+    new_frame = _NewFrameSignal(asyncio.get_running_loop())
+    with webserver.test_request_context("/"):
+        index_page = index().encode()  # same page as Flask serves (it never changes)
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:  # keep-alive: the browser can send many requests over the same connection
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    break
+                lines = head.decode("latin-1").split("\r\n")
+                method, target = lines[0].split(" ")[:2]
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        name, value = line.split(":", 1)
+                        headers[name.strip().lower()] = value.strip()
+                url = urlsplit(target)
+                args = {name: values[-1] for name, values in parse_qs(url.query).items()}
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                if url.path == "/video_feed":
+                    await _stream_video_async(writer, new_frame, args)
+                    break
+                if url.path == "/control" and headers.get("upgrade", "").lower() == "websocket":
+                    await _serve_websocket_async(reader, writer, headers["sec-websocket-key"])
+                    break
+                if url.path == "/":
+                    writer.write(_http_response("200 OK", index_page, "text/html; charset=utf-8"))
+                elif url.path in ("/click", "/button"):
+                    _put_operator_input(url.path[1:], body)
+                    writer.write(_http_response("200 OK"))
+                elif url.path == "/metrics" and robot_container is not None:
+                    if args.get("format") == "json":
+                        content = json.dumps(robot_container.metrics.to_json()).encode()
+                        writer.write(_http_response("200 OK", content, "application/json"))
+                    else:
+                        content = robot_container.metrics.to_prometheus().encode()
+                        writer.write(_http_response("200 OK", content, "text/plain; version=0.0.4"))
+                else:
+                    writer.write(_http_response("404 Not Found", b"not found\n"))
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError, KeyError, IndexError):
+            pass  # viewer went away (or sent something we do not understand, like a short body or no request line)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+async def _stream_video_async(writer, new_frame, args):
+    # same query parameters as the Flask /video_feed, for example /video_feed?width=320&q=60&adaptive=0
+    width, quality, adaptive = _stream_args(args)
+    profile = _StreamProfile(width, quality)
+    loop = asyncio.get_running_loop()
+    writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=frame\r\n"
+                 b"Cache-Control: no-cache\r\nConnection: close\r\n\r\n")
+    version = 0
+    while True:
+        if robot_container is None:
+            await asyncio.sleep(0.25)
+            continue
+        broadcaster = robot_container.video_broadcaster
+        new_frame.listen_to(broadcaster)
+        while broadcaster.version <= version:
+            await new_frame.wait()  # sleeping until there is a new frame, not polling
+        # encoding happens on a worker thread, so it does not block the other connections
+        version, jpg = await loop.run_in_executor(
+            None, broadcaster.wait_for_jpeg, version, 0, profile.width, profile.quality)
+        if jpg is None:
+            continue
+        t = time()
+        writer.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpg + b'\r\n')
+        await writer.drain()  # this waits for as long as it takes to send the frame to the viewer
+        if adaptive:
+            profile.adapt(time() - t, broadcaster.frame_width)
+
+
+async def _serve_websocket_async(reader, writer, key):
+    writer.write(_websocket_handshake(key))
+    decoder = _WebSocketDecoder()
+    while not decoder.closed:
+        data = await reader.read(4096)
+        if not data:
+            break
+        for opcode, payload in decoder.feed(data):
+            reply = _on_websocket_message(opcode, payload)
+            if reply is not None:
+                writer.write(reply)
+        await writer.drain()
+
+
+def _http_response(status, body=b"", content_type="text/plain"):
+    head = f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n\r\n"
+    return head.encode() + body
+
+
+class _WebSocketClosedResponse(Response):
+    # the connection was taken over by the WebSocket, so werkzeug must not write an HTTP response to it
+    # (it treats ConnectionError as "client went away", and just closes the connection);
+    # this relies on how the werkzeug development server works, see control()
+    def __call__(self, environ, start_response):
+        raise ConnectionError("WebSocket closed")
+
+
 # constants
-RIGHT_MOTOR_PIN = 12
-LEFT_MOTOR_PIN = 13
-PWM_FREQUENCY = 50
-ZERO_THROTTLE = 75000
-FULL_FORWARD = 100000
+MOTOR_RETRY_SECONDS = 0.5  # if sending a motor command to pigpio failed, try again after this long
 HOSTNAME = 'raspberrypi'
 THIS_HOST = gethostname()
 
 GREEN = (0, 255, 127)
 WHITE = (255, 255, 255)
 FPS_WINDOW_SECONDS = 5.0  # measure FPS over this window of time
+MJPEG_DECODE_FLAGS = {  # scale => how to decode a JPEG at that scale
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+
+# web video quality
+DEFAULT_JPEG_QUALITY = 95  # same as OpenCV default
+MIN_JPEG_QUALITY = 30
+JPEG_QUALITY_STEP = 10
+MIN_STREAM_WIDTH = 160
+STREAM_WIDTH_STEP = 32  # requested widths are rounded down to this (so viewers share the encoded JPEGs more often)
+SLOW_SEND_SECONDS = 0.15  # if sending one frame to a viewer takes longer, the viewer is falling behind
+FAST_SEND_SECONDS = 0.02  # if it is faster than this for FAST_FRAMES_TO_STEP_UP frames, step the quality back up
+FAST_FRAMES_TO_STEP_UP = 50
+
+# operator input
+DRIVE_COMMAND_TIMEOUT_SECONDS = 0.5  # the web page repeats drive commands every 0.1s, so older ones are stale
+OPERATOR_INPUT_QUEUE_SIZE = 1000
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_CONTINUATION, WEBSOCKET_TEXT, WEBSOCKET_CLOSE, WEBSOCKET_PING, WEBSOCKET_PONG = 0x0, 0x1, 0x8, 0x9, 0xA
+
+# metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.2, 0.3, 0.5, 1.0, 2.5)  # seconds
+LATENCY_STAGES = (  # latency from the moment when the frame was captured, until...
+    "frame_read",  # ... the frame was returned by get_video_frame()
+    "detection_done",  # ... mark_detection_done() was called
+    "motor_command_sent",  # ... a motor command computed from that frame was sent to pigpio
+    "web_frame_encoded",  # ... that frame was encoded for the web video
+)
 
 
 # state
+OperatorInput = namedtuple("OperatorInput", ["kind", "value", "timestamp"])
+
+
+class OperatorInputQueue:
+    """
+    Clicks, buttons and drive commands from the web page, with the time when they arrived.
+    Can be used from any thread: the web server puts them in, the main loop takes them out (and nothing gets lost).
+    """
+
+    def __init__(self, maxsize=OPERATOR_INPUT_QUEUE_SIZE):
+        self.lock = Lock()
+        self.items = deque(maxlen=maxsize)
+        self.latest = {}  # kind => newest OperatorInput of that kind
+
+    def put(self, kind, value, latest_only=False):
+        """
+        :param latest_only: for continuous commands (like driving), where only the newest one matters:
+         do not queue it, just remember it as the latest
+        """
+        item = OperatorInput(kind, value, time())
+        with self.lock:
+            if not latest_only:
+                self.items.append(item)
+            self.latest[kind] = item
+
+    def take(self, kind):
+        """
+        :return: list of OperatorInput of this kind (oldest first), which are then removed from the queue
+        """
+        with self.lock:
+            taken = [item for item in self.items if item.kind == kind]
+            if taken:
+                self.items = deque((item for item in self.items if item.kind != kind), maxlen=self.items.maxlen)
+            return taken
+
+    def latest_value(self, kind, max_age_seconds):
+        """
+        :return: value of the newest input of this kind, if it arrived within max_age_seconds (otherwise None)
+        """
+        with self.lock:
+            item = self.latest.get(kind)
+        if item is None or time() - item.timestamp > max_age_seconds:
+            return None
+        return item.value
+
+
+class LatencyHistogram:
+    """
+    Counts latencies in buckets (like a Prometheus histogram), can be updated from any thread
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = Lock()
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # the last one is for latencies above all the buckets
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self.lock:
+            self.bucket_counts[index] += 1
+            self.count += 1
+            self.sum += seconds
+            self.max = max(self.max, seconds)
+
+    def snapshot(self):
+        """
+        :return: (cumulative counts for every bucket + the "+Inf" one, count, sum, max)
+        """
+        with self.lock:
+            return list(accumulate(self.bucket_counts)), self.count, self.sum, self.max
+
+
+class RateMeter:
+    """
+    Events per second, averaged over the recent `window_seconds` (same formula as the fps shown on the video)
+    """
+
+    def __init__(self, window_seconds=FPS_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self.rate = 0.0
+        self.total = 0
+        self.last_time = time()
+
+    def tick(self, events=1):
+        now = time()
+        dt = (now - self.last_time) / self.window_seconds
+        self.rate = self.rate / (1 + dt) + events / self.window_seconds
+        self.last_time = now
+        self.total += events
+
+
+class VideocarMetrics:
+    """
+    Where does the time go between a frame being captured and the motors reacting to it (served at /metrics)
+    """
+
+    def __init__(self):
+        self.latency = {stage: LatencyHistogram() for stage in LATENCY_STAGES}
+        self.pigpio_call = LatencyHistogram()  # how long one hardware_PWM() call takes
+        self.capture_fps = RateMeter()  # frames from the camera (including the ones that were dropped)
+        self.processing_fps = RateMeter()  # frames returned by get_video_frame()
+        self.dropped_frames = 0
+        self.motor_command_errors = 0  # failed hardware_PWM() calls
+        self.motor_commands_failing = False  # True while the motor commands are not getting through to pigpio
+
+    def observe_since_capture(self, stage, capture_time):
+        if capture_time is not None:
+            self.latency[stage].observe(time() - capture_time)
+
+    def to_json(self):
+        result = {
+            "capture_fps": self.capture_fps.rate,
+            "processing_fps": self.processing_fps.rate,
+            "frames_captured": self.capture_fps.total,
+            "frames_processed": self.processing_fps.total,
+            "dropped_frames": self.dropped_frames,
+            "motor_command_errors": self.motor_command_errors,
+            "motor_commands_failing": self.motor_commands_failing,
+            "latency_seconds": {},
+        }
+        histograms = dict(self.latency, pigpio_call=self.pigpio_call)
+        for name, histogram in histograms.items():
+            counts, count, total, slowest = histogram.snapshot()
+            result["latency_seconds"][name] = {
+                "count": count,
+                "mean": total / count if count > 0 else None,
+                "max": slowest,
+                "buckets": {str(le): n for le, n in zip(histogram.buckets + ("+Inf",), counts)},
+            }
+        return result
+
+    def to_prometheus(self):
+        lines = [
+            "# TYPE videocar_capture_fps gauge",
+            f"videocar_capture_fps {self.capture_fps.rate}",
+            "# TYPE videocar_processing_fps gauge",
+            f"videocar_processing_fps {self.processing_fps.rate}",
+            "# TYPE videocar_frames_captured_total counter",
+            f"videocar_frames_captured_total {self.capture_fps.total}",
+            "# TYPE videocar_frames_processed_total counter",
+            f"videocar_frames_processed_total {self.processing_fps.total}",
+            "# TYPE videocar_dropped_frames_total counter",
+            f"videocar_dropped_frames_total {self.dropped_frames}",
+            "# TYPE videocar_motor_command_errors_total counter",
+            f"videocar_motor_command_errors_total {self.motor_command_errors}",
+            "# TYPE videocar_motor_commands_failing gauge",
+            f"videocar_motor_commands_failing {int(self.motor_commands_failing)}",
+        ]
+        lines.append("# TYPE videocar_latency_seconds histogram")
+        for stage, histogram in self.latency.items():
+            lines += self._prometheus_histogram("videocar_latency_seconds", histogram, f'stage="{stage}",')
+        lines.append("# TYPE videocar_pigpio_call_seconds histogram")
+        lines += self._prometheus_histogram("videocar_pigpio_call_seconds", self.pigpio_call)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _prometheus_histogram(name, histogram, labels=""):
+        counts, count, total, _ = histogram.snapshot()
+        lines = [f'{name}_bucket{{{labels}le="{le}"}} {n}' for le, n in zip(histogram.buckets + ("+Inf",), counts)]
+        labels = "{" + labels.rstrip(",") + "}" if labels else ""
+        lines.append(f"{name}_sum{labels} {total}")
+        lines.append(f"{name}_count{labels} {count}")
+        return lines
+
+
+class FrameBroadcaster:
+    """
+    Keeps the latest frame for the web video: every new frame gets a new version number, and it is encoded
+    to JPEG only once (by whichever viewer asks first), and all the other viewers get the same bytes
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.condition = Condition()
+        self.encoding = Lock()  # only one viewer encodes at a time, the others wait and reuse its result
+        self.version = 0
+        self.frame_and_overlay = None
+        self.capture_time = None
+        self.rendered = None  # (version, image) of the last frame with overlay drawn on it
+        self.frame_width = None  # width of the last published frame
+        self.jpegs = {}  # (width, quality) => (version, bytes) of the last frame encoded with that profile
+        self.listeners = []  # functions to call when a new frame is published
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def publish(self, frame, overlay=None, capture_time=None):
+        with self.condition:
+            self.version += 1
+            self.frame_and_overlay = (frame, overlay)
+            self.frame_width = frame.shape[1]
+            self.capture_time = capture_time
+            self.condition.notify_all()
+        for callback in self.listeners:
+            callback()
+
+    def wait_for_jpeg(self, last_version, timeout=None, width=None, quality=DEFAULT_JPEG_QUALITY):
+        """
+        Wait until there is a frame with a version newer than last_version
+        :param width: resize the frame to this width (None = do not resize; it never gets bigger than the frame,
+         or smaller than MIN_STREAM_WIDTH)
+        :param quality: JPEG quality (between 1 and 100)
+        :return: (version, JPEG bytes), or (last_version, None) if no new frame arrived within the timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.version > last_version, timeout):
+                return last_version, None
+        with self.encoding:
+            with self.condition:
+                version, (frame, overlay), capture_time = self.version, self.frame_and_overlay, self.capture_time
+            if width is not None:
+                width = max(MIN_STREAM_WIDTH, width - width % STREAM_WIDTH_STEP)
+                if width >= frame.shape[1]:
+                    width = None
+            profile = (width, int(np.clip(quality, 1, 100)))
+            jpeg = self.jpegs.get(profile)
+            if jpeg is not None and jpeg[0] == version:
+                return jpeg  # someone else already encoded this version with this profile
+
+            if self.rendered is None or self.rendered[0] != version:
+                self.rendered = (version, overlay.render(frame) if overlay is not None else frame)
+            image = self.rendered[1]
+            if width is not None and width != image.shape[1]:
+                height = max(1, int(image.shape[0] * width / image.shape[1]))
+                image = cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+            success, jpg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, profile[1]])
+            if not success:
+                return version, None
+            if self.metrics is not None:
+                self.metrics.observe_since_capture("web_frame_encoded", capture_time)
+            # forget the profiles that nobody asked for since an older frame (viewers who left, or stepped down)
+            self.jpegs = {p: jpeg for p, jpeg in self.jpegs.items() if jpeg[0] >= version - 1}
+            self.jpegs[profile] = (version, jpg.tobytes())
+            return self.jpegs[profile]
+
+
+class CameraReader:
+    """
+    Reads frames from the camera on a background thread, and keeps only the newest one
+    (so whoever asks for a frame gets the freshest one right away, instead of the oldest one sitting in the queue)
+    """
+
+    def __init__(self, camera):
+        self.camera = camera
+        self.condition = Condition()
+        self.frame = None
+        self.sequence = 0  # number of the newest frame
+        self.capture_time = None  # when the newest frame was read
+        self.last_returned_sequence = 0
+        self.dropped_frames = 0  # frames replaced by a newer one before anyone asked for them
+        self.running = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def read(self, wait_for_new_frame=True, timeout=1.0):
+        """
+        :param wait_for_new_frame: if True, wait until there is a frame newer than the one returned last time,
+         otherwise return the newest frame right away (even if it was already returned before)
+        :param timeout: how long to wait (in seconds)
+        :return: (sequence, capture_time, frame), or (None, None, None) if no frame arrived within the timeout
+        """
+        with self.condition:
+            if wait_for_new_frame:
+                has_frame = lambda: self.sequence > self.last_returned_sequence
+            else:
+                has_frame = lambda: self.frame is not None
+            if not self.condition.wait_for(has_frame, timeout):
+                return None, None, None
+            self.last_returned_sequence = self.sequence
+            return self.sequence, self.capture_time, self.frame
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1.0)
+
+    def _run(self):
+        while self.running:
+            success, frame = self.camera.read()
+            capture_time = time()
+            if not success:
+                sleep(0.01)  # camera is not giving frames now, do not spin
+                continue
+            with self.condition:
+                if self.sequence > self.last_returned_sequence:
+                    self.dropped_frames += 1
+                self.frame, self.capture_time = frame, capture_time
+                self.sequence += 1
+                self.condition.notify_all()
+
+
+class MjpegSocketReader:
+    """
+    Reads the MJPEG stream of `libcamera-vid --codec mjpeg --listen -o tcp://0.0.0.0:8000` straight from the socket:
+    finds where each JPEG starts and ends in the stream, keeps only the newest one, and decodes only the frames
+    that someone actually asks for (optionally at 1/2, 1/4 or 1/8 of the size, which is much faster to decode).
+
+    Has the same `read()` as CameraReader.
+    """
+
+    def __init__(self, hostname, port=8000, scale=1, connect_timeout=1.0):
+        assert scale in MJPEG_DECODE_FLAGS, f"scale must be one of {list(MJPEG_DECODE_FLAGS)}, not {scale}"
+        self.address = (hostname, port)
+        self.decode_flag = MJPEG_DECODE_FLAGS[scale]
+        self.connect_timeout = connect_timeout
+        self.socket = None
+        self.condition = Condition()
+        self.jpeg = None
+        self.sequence = 0
+        self.capture_time = None
+        self.last_returned_sequence = 0
+        self.dropped_frames = 0  # JPEGs replaced by a newer one before anyone asked for them (and never decoded)
+        self.running = True
+        self.socket_lock = Lock()  # so that stop() and a reconnect cannot miss each other
+        self._connect()
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def isOpened(self):
+        return self.socket is not None
+
+    def read(self, wait_for_new_frame=True, timeout=1.0):
+        """
+        :return: (sequence, capture_time, frame), or (None, None, None) if no frame arrived within the timeout
+        """
+        with self.condition:
+            if wait_for_new_frame:
+                has_frame = lambda: self.sequence > self.last_returned_sequence
+            else:
+                has_frame = lambda: self.jpeg is not None
+            if not self.condition.wait_for(has_frame, timeout):
+                return None, None, None
+            self.last_returned_sequence = self.sequence
+            sequence, capture_time, jpeg = self.sequence, self.capture_time, self.jpeg
+        frame = cv2.imdecode(np.frombuffer(jpeg, dtype=np.uint8), self.decode_flag)  # decoding outside of the lock
+        if frame is None:
+            return None, None, None
+        return sequence, capture_time, frame
+
+    def stop(self):
+        with self.socket_lock:
+            self.running = False
+            sock = self.socket
+        if sock is not None:
+            try:
+                sock.shutdown(SHUT_RDWR)  # wakes up the recv() in the reading thread
+            except OSError:
+                pass  # not connected anymore
+        self.thread.join(1.0)
+        self._close_socket()
+
+    def _connect(self):
+        with self.socket_lock:
+            if not self.running:
+                return
+        try:
+            sock = create_connection(self.address, timeout=self.connect_timeout)
+            sock.settimeout(None)
+        except OSError:
+            sock = None
+        with self.socket_lock:
+            if not self.running and sock is not None:
+                sock.close()  # stop() was called while we were connecting
+                sock = None
+            self.socket = sock
+
+    def _close_socket(self):
+        with self.socket_lock:
+            sock, self.socket = self.socket, None
+        if sock is not None:
+            sock.close()
+
+    def _run(self):
+        buffer = bytearray()
+        while self.running:
+            sock = self.socket
+            if sock is None:
+                sleep(1)  # sleep 1s before reconnecting
+                self._connect()
+                buffer.clear()
+                continue
+            try:
+                chunk = sock.recv(65536)
+            except OSError:
+                chunk = b""
+            if not chunk:
+                self._close_socket()  # camera stream ended (for example, libcamera-vid restarted), reconnect
+                continue
+            buffer += chunk
+            self._take_complete_jpegs(buffer)
+        self._close_socket()
+
+    def _take_complete_jpegs(self, buffer):
+        newest, skipped = None, 0
+        while True:
+            start = buffer.find(b"\xff\xd8")
+            if start < 0:
+                del buffer[:-1]  # no JPEG start yet (but keep the last byte, it can be half of the start marker)
+                break
+            end = buffer.find(b"\xff\xd9", start + 2)
+            if end < 0:
+                del buffer[:start]  # this JPEG is not complete yet
+                break
+            if newest is not None:
+                skipped += 1  # an even newer JPEG is already here, so this one will never be decoded
+            newest = bytes(buffer[start:end + 2])
+            del buffer[:end + 2]
+        if newest is not None:
+            with self.condition:
+                self.dropped_frames += skipped
+                if self.sequence > self.last_returned_sequence:
+                    self.dropped_frames += 1  # the previous JPEG was never asked for
+                self.jpeg, self.capture_time = newest, time()
+                self.sequence += skipped + 1
+                self.condition.notify_all()
+
+
+class FakePigpio:
+    """
+    Pretends to be pigpio.pi (for testing without a Raspberry Pi): every call takes `latency` seconds,
+    and all the calls are recorded in `calls` as (time, gpio, frequency, duty cycle)
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.connected = True
+        self.calls = []
+
+    def hardware_PWM(self, gpio, frequency, duty_cycle):
+        sleep(self.latency)
+        self.calls.append((time(), gpio, frequency, duty_cycle))
+        return 0
+
+
+class MotorCommandSender:
+    """
+    Sends motor duty cycles to pigpio on a background thread, so the caller never waits for the network:
+     - `post()` only remembers the desired duty cycles (of both motors at once) and returns right away
+     - if many commands are posted while one is being sent, only the latest one gets sent
+     - a duty cycle that is already set on that pin is not sent again
+     - if sending fails (for example, the connection to pigpio dropped), it keeps retrying the latest command;
+       the failure is printed, kept in `error`, and counted in the metrics (see /metrics)
+
+    With synchronous=True, `post()` sends right away instead (for the lockstep simulation, where the motors must
+    be set before the next simulated frame, no matter how the threads get scheduled).
+    """
+
+    def __init__(self, pins, metrics=None, synchronous=False):
+        self.pins = pins
+        self.metrics = metrics
+        self.synchronous = synchronous
+        self.condition = Condition()
+        self.sending = Lock()  # held while talking to pigpio
+        self.pending = {}  # pin => (duty cycle to send, capture time of the frame that this command came from)
+        self.sent = {}  # pin => duty cycle that was sent last
+        self.error = None  # the last error from pigpio, if the last attempt to send failed
+        self.thread = None
+        if not synchronous:
+            self.thread = Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def post(self, duty_cycles, capture_time=None):
+        """
+        :param duty_cycles: dictionary {pin: duty cycle}, for example the left and right motor pins together
+         (so that they are always queued together, and never one without the other)
+        :param capture_time: capture time of the frame that this command came from (for the latency metrics)
+        """
+        with self.condition:
+            for pin, duty_cycle in duty_cycles.items():
+                self.pending[pin] = (duty_cycle, capture_time)
+            self.condition.notify()
+        if self.synchronous:
+            self._send_pending()
+
+    def hard_stop(self, pins, stop_duty_cycle):
+        """
+        Stop the motors right now (and wait until it is done): first send the regular stop signal,
+        wait 0.1s for it to get there, and then stop sending pulses to these pins at all
+        (if pigpio fails, still tries every pin and then raises the first error)
+        """
+        errors = []
+        with self.sending:
+            with self.condition:
+                for pin in pins:
+                    self.pending.pop(pin, None)  # whatever was not sent yet must not be sent after the stop
+            for pin in pins:
+                errors += self._try_hardware_PWM(pin, PWM_FREQUENCY, stop_duty_cycle)
+            print("mandatory 0.1s pause when stopping all motors")
+            sleep(0.1)  # let the regular stop signal get there first
+            for pin in pins:
+                errors += self._try_hardware_PWM(pin, 0, 0)
+                self.sent[pin] = None
+        if errors:
+            raise ConnectionError(f"could not stop all motors: {errors[0]}") from errors[0]
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.pending) > 0)
+            if not self._send_pending():
+                sleep(MOTOR_RETRY_SECONDS)
+
+    def _send_pending(self):
+        """
+        :return: True if everything pending was sent, False if some of it failed (and is pending again, for a retry)
+        """
+        failed = False
+        with self.sending:
+            with self.condition:
+                pending, self.pending = self.pending, {}
+            for pin, (duty_cycle, capture_time) in pending.items():
+                if self.sent.get(pin) == duty_cycle:
+                    continue  # already set
+                if self._try_hardware_PWM(pin, PWM_FREQUENCY, duty_cycle):
+                    failed = True
+                    self.sent.pop(pin, None)  # (so that it gets sent again, even if it is the same)
+                    with self.condition:
+                        self.pending.setdefault(pin, (duty_cycle, capture_time))  # retry, unless there is newer
+                    continue
+                self.sent[pin] = duty_cycle
+                if self.metrics is not None:
+                    self.metrics.observe_since_capture("motor_command_sent", capture_time)
+        return not failed
+
+    def _try_hardware_PWM(self, pin, frequency, duty_cycle):
+        """
+        :return: empty list if it worked, or [the error] if it did not (the error is also printed and remembered)
+        """
+        try:
+            self._hardware_PWM(pin, frequency, duty_cycle)
+        except Exception as e:
+            if self.error is None:
+                print(f"WARNING: could not send a motor command to pigpio (pin {pin}), will keep retrying: {e}")
+            self.error = e
+            if self.metrics is not None:
+                self.metrics.motor_command_errors += 1
+                self.metrics.motor_commands_failing = True
+            return [e]
+        if self.error is not None:
+            print(f"motor commands are getting through to pigpio again (pin {pin})")
+            self.error = None
+            if self.metrics is not None:
+                self.metrics.motor_commands_failing = False
+        return []
+
+    def _hardware_PWM(self, pin, frequency, duty_cycle):
+        t = time()
+        self.pins.hardware_PWM(pin, frequency, duty_cycle)
+        if self.metrics is not None:
+            self.metrics.pigpio_call.observe(time() - t)
+
+
 class RobotContainer:
 
-    def __init__(self, hostname, motor_directions=(1, 1), video_direction=1):
+    def __init__(self, hostname, motor_directions=(1, 1), video_direction=1, camera_backend="opencv", video_scale=1,
+                 pins=None, camera=None, synchronous_motors=False):
+        assert camera_backend in ("opencv", "mjpeg"), f"unknown camera_backend: {camera_backend}"
+        assert video_scale == 1 or camera_backend == "mjpeg", "video_scale only works with camera_backend='mjpeg'"
         assert len(motor_directions) == 2, "we have two motors and must have two directions"
         assert motor_directions[0] != 0 and motor_directions[1] != 0, f"{motor_directions}"
         self.motor_directions = (np.sign(motor_directions[0]), np.sign(motor_directions[1]))
         self.video_direction = video_direction
         self.right_speed = 0.0
         self.left_speed = 0.0
-        self.recent_fps = 0.0
-        self.last_get_video_frame_time = 0.0
-        self.pins = None
+        self.metrics = VideocarMetrics()
+        self.pins = pins
 
         # connect the pins
-        while True:
+        while pins is None:
             if hostname is None:
                 print("pins not connected, because we are in simulation")
                 break
@@ -303,34 +1337,54 @@ class RobotContainer:
             if self.pins.connected:
                 break
             sleep(1)  # sleep 1s before reconnecting
+        self.motor_sender = None
+        if self.pins is not None:
+            self.motor_sender = MotorCommandSender(self.pins, self.metrics, synchronous=synchronous_motors)
 
-        # connect the camera
-        while True:
+        # connect the camera (unless we were given one that already has a CameraReader-like read())
+        self.camera = camera
+        while camera is None:
             if hostname is None:
                 self.camera = cv2.VideoCapture(0)  # using camera 0 in simulation
                 break
-            self.camera = cv2.VideoCapture("tcp://" + hostname + ":8000")
+            if camera_backend == "mjpeg":
+                self.camera = MjpegSocketReader(hostname, 8000, scale=video_scale)
+            else:
+                self.camera = cv2.VideoCapture("tcp://" + hostname + ":8000")
             print("camera {}".format("CONNECTED" if self.camera.isOpened() else "NOT CONNECTED"))
             if self.camera.isOpened():
                 break
+            if camera_backend == "mjpeg":
+                self.camera.stop()
             sleep(1)  # sleep 1s before reconnecting
-
-        self.frame_to_display = None
-        self.points_clicked = []
-        self.buttons_clicked = []
+        if camera is not None or isinstance(self.camera, MjpegSocketReader):
+            self.camera_reader = self.camera
+        else:
+            self.camera_reader = CameraReader(self.camera)
+        self.last_frame_sequence = None
+        self.last_frame_capture_time = None
+
+        self.video_broadcaster = FrameBroadcaster(self.metrics)
+        self.operator_input = OperatorInputQueue()
         atexit.register(self.stop_all_motors)
 
     def set_left_motor(self, speed):
         self.left_speed = np.clip(speed, -1.0, +1.0)
-        if self.pins is not None:
-            signal = self.left_speed * self.motor_directions[0]
-            return self.pins.hardware_PWM(LEFT_MOTOR_PIN, PWM_FREQUENCY, _to_duty_cycle(signal))
+        self._post_motors(left=True)
 
     def set_right_motor(self, speed):
         self.right_speed = np.clip(speed, -1.0, +1.0)
-        if self.pins is not None:
-            signal = self.right_speed * self.motor_directions[1]
-            return self.pins.hardware_PWM(RIGHT_MOTOR_PIN, PWM_FREQUENCY, _to_duty_cycle(signal))
+        self._post_motors(right=True)
+
+    def _post_motors(self, left=False, right=False):
+        if self.motor_sender is None:
+            return
+        duty_cycles = {}
+        if left:
+            duty_cycles[LEFT_MOTOR_PIN] = _to_duty_cycle(self.left_speed * self.motor_directions[0])
+        if right:
+            duty_cycles[RIGHT_MOTOR_PIN] = _to_duty_cycle(self.right_speed * self.motor_directions[1])
+        self.motor_sender.post(duty_cycles, self.last_frame_capture_time)
 
     def set_arcade_drive(self, forward_speed, right_turn_speed):
         # make sure the speeds are realistic
@@ -339,9 +1393,10 @@ class RobotContainer:
         right_turn_speed = np.clip(right_turn_speed, -1.0, +1.0)
         max_forward_speed = 1 - abs(right_turn_speed)
         forward_speed = np.clip(forward_speed, -max_forward_speed, max_forward_speed)
-        # now set those realistic speeds
-        self.set_left_motor(forward_speed + right_turn_speed)
-        self.set_right_motor(forward_speed - right_turn_speed)
+        # now set those realistic speeds (both at once)
+        self.left_speed = np.clip(forward_speed + right_turn_speed, -1.0, +1.0)
+        self.right_speed = np.clip(forward_speed - right_turn_speed, -1.0, +1.0)
+        self._post_motors(left=True, right=True)
 
     def stop_right_motor(self):
         self.set_right_motor(0)
@@ -350,65 +1405,52 @@ class RobotContainer:
         self.set_left_motor(0)
 
     def stop_all_motors(self):
-        self.stop_left_motor()
-        self.stop_right_motor()
-        if self.pins is not None:  # then, if supported, send a hard stop signal (no pulses)
-            print("mandatory 0.1s pause when stopping all motors")
-            sleep(0.1)  # but let the regular stop signal get there first
-            self.pins.hardware_PWM(LEFT_MOTOR_PIN, 0, 0)
-            self.pins.hardware_PWM(RIGHT_MOTOR_PIN, 0, 0)
+        self.left_speed, self.right_speed = 0.0, 0.0
+        if self.motor_sender is not None:  # regular stop signal, and then a hard stop signal (no pulses)
+            self.motor_sender.hard_stop((LEFT_MOTOR_PIN, RIGHT_MOTOR_PIN), _to_duty_cycle(0))
 
-    def display_video_frame(self, frame, comment):
-        self.frame_to_display = frame
+    def display_video_frame(self, frame, comment, overlay=None):
+        # nothing is drawn here: the overlay only gets rendered (on a copy of the frame) if someone watches the video
+        overlay = Overlay(list(overlay.commands)) if overlay is not None else Overlay()
         text = f"mtr%: {int(100 * self.left_speed)} {int(100 * self.right_speed)}"
-        text += f", cam: {int(self.recent_fps)} fps"
-        cv2.putText(self.frame_to_display, text, (5, 30), cv2.FONT_HERSHEY_DUPLEX, 1, WHITE, 1)
+        text += f", cam: {int(self.metrics.processing_fps.rate)} fps"
+        overlay.text(text, (5, 30), cv2.FONT_HERSHEY_DUPLEX, 1, WHITE, 1)
         if comment is not None:
-            cv2.putText(self.frame_to_display, comment, (5, frame.shape[0] - 10), cv2.FONT_HERSHEY_DUPLEX, 0.5, WHITE, 1)
+            overlay.text(comment, (5, frame.shape[0] - 10), cv2.FONT_HERSHEY_DUPLEX, 0.5, WHITE, 1)
+        self.video_broadcaster.publish(frame, overlay, self.last_frame_capture_time)
+
+    def mark_detection_done(self):
+        self.metrics.observe_since_capture("detection_done", self.last_frame_capture_time)
 
 
     def get_clicks(self):
-        result = self.points_clicked
-        self.points_clicked = []
-        return result
+        return [item.value for item in self.operator_input.take("click")]
 
 
     def get_buttons(self):
-        result = self.buttons_clicked
-        self.buttons_clicked = []
-        return result
-
-
-    def get_video_frame(self):
-        # update the fps counter
-        now = time()
-        dt = (now - self.last_get_video_frame_time) / FPS_WINDOW_SECONDS
-        self.recent_fps = self.recent_fps / (1 + dt) + 1 / FPS_WINDOW_SECONDS
-        self.last_get_video_frame_time = now
-
-        # if in simulation, do not bother fast-forwarding to the latest frame
-        if in_simulation:
-            self.camera.grab()
-            success, frame = self.camera.retrieve()
-            if not success:
-                return None
-            if self.video_direction == -1:
-                frame = cv2.flip(frame, -1)  # 180 degree flip (if camera is installed upside down)
-            return frame
-
-        # otherwise, catch up by discarding the old frames sitting in the queue
-        t = time()
-        while True:
-            self.camera.grab()
-            after = time()
-            if after - t > 0.010:
-                break  # if this took us more than 10ms to get next frame, it was fresh
-            t = after
-        success, frame = self.camera.retrieve()  # and decode just that last frame
-        if success:
-            if self.video_direction == -1:
-                frame = cv2.flip(frame, -1)  # 180 degree flip (if camera is installed upside down)
-            return frame
+        return [item.value for item in self.operator_input.take("button")]
+
+
+    def get_drive_command(self, max_age_seconds=None):
+        if max_age_seconds is None:
+            max_age_seconds = DRIVE_COMMAND_TIMEOUT_SECONDS
+        return self.operator_input.latest_value("drive", max_age_seconds)
+
+
+    def get_video_frame(self, wait_for_new_frame=True):
+        # the camera reader thread always has the latest frame (older frames are dropped, instead of sitting in a queue)
+        sequence, capture_time, frame = self.camera_reader.read(wait_for_new_frame)
+        if frame is None:
+            return None
+        self.metrics.processing_fps.tick()  # (only counting the frames that were actually returned)
+        if sequence > (self.last_frame_sequence or 0):
+            self.metrics.capture_fps.tick(sequence - (self.last_frame_sequence or 0))
+        self.metrics.dropped_frames = self.camera_reader.dropped_frames
+        self.last_frame_sequence, self.last_frame_capture_time = sequence, capture_time
+        self.metrics.observe_since_capture("frame_read", capture_time)
+        if self.video_direction == -1:
+            frame = cv2.flip(frame, -1)  # 180 degree flip (if camera is installed upside down)
+        return frame
 
 
 robot_container = None
@@ -1,13 +1,405 @@
 from djitellopy import Tello
+from threading import Thread, Condition
+from time import time, sleep
+import collections
+import os
 import numpy as np
 
 import detection
 
 
+def create_tello(address=None):
+    """
+    Create a Tello, or a Tello that talks to the emulator (see telloemu.py) instead of a real drone
+    :param address: "host" or "host:port" of the drone (if None, uses the TELLO_ADDRESS environment variable,
+     and if that is not set either, the real drone at 192.168.10.1:8889)
+    :return: djitellopy Tello (call .connect() on it, like always)
+    """
+    address = address or os.environ.get("TELLO_ADDRESS")
+    if not address:
+        return Tello()
+    host, _, port = address.partition(":")
+    drone = Tello(host=host)
+    if port:
+        drone.address = (host, int(port))  # djitellopy always uses port 8889 for commands, but the emulator may not
+    return drone
+
+
+# one video frame from the drone: its number, when it was received (time.time()), and the image
+TelloFrame = collections.namedtuple("TelloFrame", ["sequence", "receive_time", "frame"])
+
+
+class TelloFrameReader:
+    """
+    Gives you every new video frame from the drone exactly once (with its sequence number and receive time),
+    so your loop does not run detection again and again on the same old frame when it is faster than the video.
+
+    Example:
+        frame_reader = videocopter.TelloFrameReader(drone)  # after drone.streamon()
+        while True:
+            new_frame = frame_reader.wait_for_new_frame(timeout=0.1)
+            if new_frame is None:
+                continue  # no new frame yet
+            frame = new_frame.frame
+    """
+
+    def __init__(self, drone: Tello, poll_interval=0.002):
+        """
+        :param drone: a djitellopy.Tello (with video stream already on)
+        :param poll_interval: how often to check if djitellopy received a new frame (in seconds)
+        """
+        self.frame_read = drone.get_frame_read()
+        self.poll_interval = poll_interval
+        self.condition = Condition()
+        self.latest = None  # TelloFrame
+        self.last_returned_sequence = 0
+        self.dropped_frames = 0  # frames replaced by a newer one before anyone asked for them
+        self.running = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def wait_for_new_frame(self, timeout=1.0):
+        """
+        :param timeout: how long to wait for a frame newer than the one returned last time (in seconds)
+        :return: TelloFrame(sequence, receive_time, frame), or None if no new frame arrived within the timeout
+        """
+        with self.condition:
+            has_new_frame = lambda: self.latest is not None and self.latest.sequence > self.last_returned_sequence
+            if not self.condition.wait_for(has_new_frame, timeout):
+                return None
+            self.last_returned_sequence = self.latest.sequence
+            return self.latest
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1.0)
+
+    def _run(self):
+        # djitellopy's reader thread puts every new frame into a new array, so a different array = a new frame
+        last_frame = None
+        while self.running:
+            frame = self.frame_read.frame
+            if frame is None or frame is last_frame:
+                sleep(self.poll_interval)
+                continue
+            last_frame = frame
+            with self.condition:
+                sequence = 1 if self.latest is None else self.latest.sequence + 1
+                if sequence - 1 > self.last_returned_sequence:
+                    self.dropped_frames += 1
+                self.latest = TelloFrame(sequence, time(), frame)
+                self.condition.notify_all()
+
+
+# what the drone reported about itself (see TelloTelemetry): height and ToF distance in cm, angles in degrees,
+# velocities and accelerations as the drone reports them, and the rates derived from them (per second)
+TelemetrySnapshot = collections.namedtuple("TelemetrySnapshot", [
+    "sequence", "receive_time", "battery", "tof", "height", "pitch", "roll", "yaw",
+    "vgx", "vgy", "vgz", "agx", "agy", "agz", "is_flying",
+    "height_rate", "tof_rate", "yaw_rate", "battery_per_minute",
+])
+
+
+class TelloTelemetry:
+    """
+    Keeps the latest state of the drone (battery, ToF distance, attitude, velocities, height) as a snapshot,
+    updated in the background from the state stream that the drone sends ~10 times per second.
+
+    `snapshot()` costs nothing (no network, no parsing), so your loop can call it on every frame:
+        telemetry = videocopter.TelloTelemetry(drone)
+        state = telemetry.snapshot()
+        if state is not None:
+            print(state.battery, state.tof, state.height_rate)
+    """
+
+    def __init__(self, drone: Tello, poll_interval=0.01, rate_smoothing_seconds=0.2):
+        """
+        :param drone: a djitellopy.Tello (connected)
+        :param poll_interval: how often to check if a new state packet arrived (in seconds)
+        :param rate_smoothing_seconds: the derived rates are averaged over about this much time
+        """
+        self.drone = drone
+        self.poll_interval = poll_interval
+        self.rate_smoothing_seconds = rate_smoothing_seconds
+        self.latest = None  # TelemetrySnapshot
+        self.first_battery = None  # (time, battery) of the first state packet, to see how fast battery drains
+        self.running = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def snapshot(self):
+        """
+        :return: the latest TelemetrySnapshot (or None, if the drone did not send its state yet)
+        """
+        return self.latest
+
+    def stop(self):
+        self.running = False
+        self.thread.join(1.0)
+
+    def _run(self):
+        # djitellopy parses every state packet into a new dictionary, so a different dictionary = a new packet
+        last_state = None
+        while self.running:
+            state = self.drone.get_current_state()
+            if not state or state is last_state:
+                sleep(self.poll_interval)
+                continue
+            last_state = state
+            self.latest = self._make_snapshot(state, time(), self.latest)
+
+    def _make_snapshot(self, state, now, previous):
+        battery = state.get("bat")
+        if self.first_battery is None and battery is not None:
+            self.first_battery = (now, battery)
+        battery_per_minute = None
+        if self.first_battery is not None and battery is not None and now - self.first_battery[0] > 10:
+            battery_per_minute = 60 * (battery - self.first_battery[1]) / (now - self.first_battery[0])
+
+        rates = {"height_rate": 0.0, "tof_rate": 0.0, "yaw_rate": 0.0}
+        if previous is not None and now > previous.receive_time:
+            dt = now - previous.receive_time
+            weight = dt / (dt + self.rate_smoothing_seconds)
+            changes = {
+                "height_rate": _difference(state.get("h"), previous.height),
+                "tof_rate": _difference(state.get("tof"), previous.tof),
+                "yaw_rate": _difference(state.get("yaw"), previous.yaw),
+            }
+            if changes["yaw_rate"] is not None:
+                changes["yaw_rate"] = (changes["yaw_rate"] + 180) % 360 - 180  # turning across +180/-180
+            for name, change in changes.items():
+                old_rate = getattr(previous, name)
+                rates[name] = old_rate if change is None else old_rate + weight * (change / dt - old_rate)
+
+        return TelemetrySnapshot(
+            sequence=1 if previous is None else previous.sequence + 1,
+            receive_time=now,
+            battery=battery,
+            tof=state.get("tof"),
+            height=state.get("h"),
+            pitch=state.get("pitch"),
+            roll=state.get("roll"),
+            yaw=state.get("yaw"),
+            vgx=state.get("vgx"),
+            vgy=state.get("vgy"),
+            vgz=state.get("vgz"),
+            agx=state.get("agx"),
+            agy=state.get("agy"),
+            agz=state.get("agz"),
+            is_flying=self.drone.is_flying,
+            battery_per_minute=battery_per_minute,
+            **rates)
+
+
+def _difference(value, previous_value):
+    if value is None or previous_value is None:
+        return None
+    return value - previous_value
+
+
+class RcControlScheduler:
+    """
+    Owns the RC channel of the drone: sends the latest setpoint to the drone at a fixed rate on its own thread,
+    so the drone gets steady commands no matter how fast or slow your vision loop is.
+    If nobody updated the setpoint for `stale_after` seconds (vision loop got stuck?), the drone is told to hover.
+
+    It has the same `send_rc_control()` as djitellopy.Tello (but that only updates the setpoint and returns
+    right away), and everything else goes to the drone, so you can pass it wherever a drone is expected:
+        rc = videocopter.RcControlScheduler(drone, rate_hz=20)
+        videocopter.drone_follow_object_pids(rc, frame, bbox)
+    """
+
+    def __init__(self, drone: Tello, rate_hz=20, stale_after=0.5, hover_packets=3):
+        """
+        :param drone: a djitellopy.Tello
+        :param rate_hz: how many RC commands per second to send
+        :param stale_after: if the setpoint was not updated for this many seconds, hover
+        :param hover_packets: how many times to send "hover" after the setpoint went stale (UDP packets can get lost),
+         after that nothing is sent until there is a new setpoint (so that takeoff/land/move commands are not disturbed)
+        """
+        self.drone = drone
+        self.period = 1.0 / rate_hz
+        self.stale_after = stale_after
+        self.hover_packets = hover_packets
+        self.condition = Condition()
+        self.setpoint = None  # (left_right, forward_backward, up_down, yaw)
+        self.setpoint_time = 0.0
+        self.hover_packets_left = 0
+        self.sent_count = 0
+        self.running = True
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def send_rc_control(self, left_right_velocity, forward_backward_velocity, up_down_velocity, yaw_velocity):
+        """
+        Update the setpoint (velocities between -100 and +100), it will be sent with the next tick
+        """
+        with self.condition:
+            self.setpoint = (left_right_velocity, forward_backward_velocity, up_down_velocity, yaw_velocity)
+            self.setpoint_time = time()
+            self.hover_packets_left = self.hover_packets
+            self.condition.notify()
+
+    def hover(self):
+        self.send_rc_control(0, 0, 0, 0)
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        self.thread.join(1.0)
+
+    def __getattr__(self, name):
+        # takeoff(), land(), get_battery(), ... go straight to the drone
+        return getattr(self.drone, name)
+
+    def _run(self):
+        next_tick = time()
+        while self.running:
+            with self.condition:
+                # nothing to send? then sleep until there is a new setpoint
+                self.condition.wait_for(lambda: self.hover_packets_left > 0 or not self.running)
+                if not self.running:
+                    break
+                setpoint = self.setpoint
+                if time() - self.setpoint_time > self.stale_after:
+                    setpoint = (0, 0, 0, 0)  # setpoint is stale, hover
+                    self.hover_packets_left -= 1
+            self.drone.send_rc_control(*setpoint)
+            self.sent_count += 1
+
+            next_tick = max(next_tick + self.period, time() - self.period)  # do not try to catch up after a pause
+            sleep(max(0.0, next_tick - time()))
+
+
+class PIDController:
+    """
+    PID controller for several axes at once (for example, the four RC axes of the drone, or forward and turn of
+    the car), which remembers its state between frames and uses the real time between them (so the same gains
+    work at 30 fps and at 8 fps).
+
+    Every parameter can be one number (same for all axes) or one number per axis.
+
+    Example:
+        pid = videocopter.PIDController(kp=[90, 6, 150, 90], kd=[10, 0, 10, 10], output_limit=[50, 100, 50, 100])
+        while True:
+            new_frame = frame_reader.wait_for_new_frame()
+            ...
+            speeds = pid.update(errors, timestamp=new_frame.receive_time)
+    """
+
+    def __init__(self, kp, ki=0.0, kd=0.0, integral_limit=None, derivative_smoothing_seconds=0.1,
+                 output_limit=None, max_output_rate=None, max_dt=0.5):
+        """
+        :param kp: proportional gain
+        :param ki: integral gain
+        :param kd: derivative gain
+        :param integral_limit: the integral term (ki * integral) never goes beyond +/- this (None = no limit)
+        :param derivative_smoothing_seconds: the derivative is low-pass filtered over about this much time
+         (because the detected boxes jitter from frame to frame)
+        :param output_limit: the output never goes beyond +/- this (None = no limit)
+        :param max_output_rate: the output cannot change faster than this per second (None = no limit)
+        :param max_dt: if more time than this passed since the previous update (say, the object was lost for a while),
+         the integral and derivative terms do not use that time gap, they start over
+        """
+        self.kp, self.ki, self.kd = np.asarray(kp, float), np.asarray(ki, float), np.asarray(kd, float)
+        self.integral_limit = None if integral_limit is None else np.asarray(integral_limit, float)
+        self.derivative_smoothing_seconds = derivative_smoothing_seconds
+        self.output_limit = None if output_limit is None else np.asarray(output_limit, float)
+        self.max_output_rate = None if max_output_rate is None else np.asarray(max_output_rate, float)
+        self.max_dt = max_dt
+        self.reset()
+
+    def reset(self):
+        self.integral = 0.0
+        self.derivative = 0.0
+        self.last_error = None
+        self.last_output = None
+        self.last_timestamp = None
+
+    def update(self, error, timestamp=None):
+        """
+        :param error: how far from the target we are, on every axis (target minus measurement)
+        :param timestamp: when the measurement was made (for example, TelloFrame.receive_time), default = now
+        :return: numpy array with the output for every axis
+        """
+        error = np.asarray(error, float)
+        timestamp = time() if timestamp is None else timestamp
+        dt = None if self.last_timestamp is None else timestamp - self.last_timestamp
+        if dt is not None and not 0 < dt <= self.max_dt:
+            dt = None  # first update after a long pause (or timestamps went backwards): start over
+            self.integral = 0.0
+            self.derivative = 0.0
+            self.last_output = None
+
+        if dt is not None and np.any(self.ki != 0):
+            self.integral = self.integral + error * dt
+            if self.integral_limit is not None:
+                # clamp the integral so that the integral term stays within the limit (anti-windup)
+                limit = np.divide(self.integral_limit, np.abs(self.ki), out=np.full_like(error, np.inf),
+                                  where=self.ki != 0)
+                self.integral = np.clip(self.integral, -limit, limit)
+        if dt is not None and self.last_error is not None:
+            weight = dt / (dt + self.derivative_smoothing_seconds)
+            self.derivative = self.derivative + weight * ((error - self.last_error) / dt - self.derivative)
+
+        output = self.kp * error + self.ki * self.integral + self.kd * self.derivative
+        if self.output_limit is not None:
+            output = np.clip(output, -self.output_limit, self.output_limit)
+        if self.max_output_rate is not None and self.last_output is not None and dt is not None:
+            max_change = self.max_output_rate * dt
+            output = np.clip(output, self.last_output - max_change, self.last_output + max_change)
+
+        self.last_error, self.last_output, self.last_timestamp = error, output, timestamp
+        return output
+
+
+def create_follow_pid_controller():
+    """
+    :return: PIDController for drone_follow_object_pid() (starting gains: same proportional gains as
+     drone_follow_object_pids, plus some damping)
+    """
+    return PIDController(
+        kp=[90, 6.0, 150, 90],  # left_right, forward_backward, up_down, yaw
+        ki=[0, 0.5, 20, 0],
+        kd=[10, 0.5, 15, 10],
+        integral_limit=[0, 20, 15, 0],
+        output_limit=[50, 100, 50, 100],
+        max_output_rate=[400, 300, 400, 600],  # per second
+    )
+
+
+def drone_follow_object_pid(drone: Tello, frame, bbox, controller: PIDController, timestamp=None, target_width=0.2):
+    """
+    Sets Tello speed to follow the detected object, using a PID controller that remembers its state between frames
+    :param drone: a djitellopy.Tello (or RcControlScheduler)
+    :param frame: frame of the video
+    :param bbox: bounding box of the object to follow, on the frame
+    :param controller: for example, from create_follow_pid_controller()
+    :param timestamp: when the frame was received (for example, TelloFrame.receive_time), default = now
+    :param target_width: how wide should the object be for the drone to stop approaching it
+    :return: (left_right, forward_backward, up_down, yaw) speeds that were sent
+    """
+    x, y, w, h = bbox
+    relative_x, relative_y, relative_width = detection.to_relative_xyw_deprecated(frame, x, y, w, h)
+
+    # too far (object narrower than target) => positive error => fly forward
+    forward_error = 1 / max(relative_width, 0.01 * target_width) - 1 / target_width
+    errors = [relative_x, forward_error, relative_y, relative_x]
+    speeds = [int(speed) for speed in controller.update(errors, timestamp)]
+
+    #  - if the object is too far to the side of the video (right or left), going fast is not allowed
+    if relative_x < -0.25 or relative_x > 0.25:
+        speeds[1] = min(25, speeds[1])
+
+    drone.send_rc_control(*speeds)
+    return tuple(speeds)
+
+
 def drone_follow_object_pids(drone: Tello, frame, bbox, target_width=0.2, kp_fwd=6.0, kp_turn=90, kp_updown=150):
     """
     Sets Tello speed to follow the detected object, using a very primitive PID logic
-    :param drone: a djitellopy.Tello
+    :param drone: a djitellopy.Tello (or RcControlScheduler)
     :param frame: frame of the video
     :param bbox: bounding box of the object to follow, on the frame
     :param target_width: how wide should the object be for the drone to stop approaching it
@@ -56,7 +448,7 @@ def drone_follow_object_pids(drone: Tello, frame, bbox, target_width=0.2, kp_fwd
 def drone_follow_object_bang(drone: Tello, frame, bbox, target_width=0.2, max_up_speed=50, max_left_speed=40, max_fwd_speed=90):
     """
     Sets Tello speed to follow the detected object, using a very primitive PID logic
-    :param drone: a djitellopy.Tello
+    :param drone: a djitellopy.Tello (or RcControlScheduler)
     :param frame: frame of the video
     :param bbox: bounding box of the object to follow, on the frame
     :param target_width: how wide should the object be for the drone to stop approaching it
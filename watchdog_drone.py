@@ -1,7 +1,7 @@
-from djitellopy import Tello
 import detection
 import cv2
 import pupil_apriltags as apriltags
+import videocopter
 #from ultralytics import YOLO
 
 # what kind of objects can we detect?
@@ -12,9 +12,11 @@ tag_detector = apriltags.Detector(families="tag36h11", quad_sigma=0.2)
 
 
 # start the drone
-drone = Tello()
+drone = videocopter.create_tello()  # set TELLO_ADDRESS=127.0.0.1:18889 to fly the emulator (telloemu.py)
 drone.connect()
 drone.streamon()
+frame_reader = videocopter.TelloFrameReader(drone)  # gives every new frame once (so we do not re-detect old frames)
+rc = videocopter.RcControlScheduler(drone, rate_hz=20)  # sends our latest RC command 20 times per second
 x, y, w, h = None, None, None, None
 
 # everything below happens in a loop
@@ -26,15 +28,19 @@ while True:
     elif key == ord('t'):
         drone.takeoff()  # T = takeoff
 
-    # 1. get one video frame from drone camera
-    frame = drone.get_frame_read().frame
+    # 1. get one new video frame from drone camera (if there is no new frame yet, try again)
+    new_frame = frame_reader.wait_for_new_frame(timeout=0.05)
+    if new_frame is None:
+        continue
+    frame = new_frame.frame
 
     # 2. detect an object on that frame
-    x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, tracker=tracker)
-    #x, y, w, h = detection.detect_biggest_face(face_detector, frame, previous_xywh=(x, y, w, h), tracker=tracker)
+    overlay = detection.Overlay()  # what to draw on this frame (drawn only when showing it)
+    x, y, w, h = detection.detect_biggest_apriltag(tag_detector, frame, tracker=tracker, overlay=overlay, capture_time=new_frame.receive_time)
+    #x, y, w, h = detection.detect_biggest_face(face_detector, frame, previous_xywh=(x, y, w, h), tracker=tracker, overlay=overlay)
 
-    nx, ny, size = detection.to_normalized_x_y_size(frame, x, y, w, h, draw_box=True)
-    cv2.imshow("drone video", frame)
+    nx, ny, size = detection.to_normalized_x_y_size(frame, x, y, w, h, draw_box=True, overlay=overlay)
+    cv2.imshow("drone video", overlay.render(frame))
 
     # 3. if the object is not detected, try again
     if nx is None:
@@ -58,4 +64,4 @@ while True:
 
     # exercise 4: can you think if a way to fly the drone forward when the object is right in front of us? (nx > -15 and nx < -15 and ny < 20 and ny > -15)
 
-    drone.send_rc_control(roll_velocity, forward_velocity, up_down_velocity, turn_velocity)
+    rc.send_rc_control(roll_velocity, forward_velocity, up_down_velocity, turn_velocity)